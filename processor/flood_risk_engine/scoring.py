@@ -0,0 +1,296 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Flood Scoring Engine
+# Một nguồn duy nhất cho severity (sensor) và risk score (crowd report),
+# dùng chung bởi backend và processor/flood_risk_engine.
+# Bản vendored: processor/flood_risk_engine/scoring.py - phải giống hệt file
+# này (tests/test_scoring.py kiểm tra); sửa ở đây rồi copy sang.
+# API batch (NumPy) nhận mảng mức nước / trend / threshold và tính cả mảng
+# trong một lần gọi (rescore, backfill); hàm scalar chỉ là batch một phần tử.
+# ======================================================
+
+import re
+import unicodedata
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+# ======================================================
+# SENSOR SEVERITY
+# ======================================================
+
+SEVERITY_LEVELS = ("Low", "Moderate", "High", "Severe")
+# Mức nước tuyệt đối (m, ngữ cảnh Việt Nam): <0.2 Low, 0.2-0.5 Moderate, 0.5-1.0 High, ≥1.0 Severe
+SEVERITY_BOUNDS = np.array([0.2, 0.5, 1.0])
+# Vượt ngưỡng cảnh báo địa phương → tối thiểu High
+THRESHOLD_MIN_INDEX = 2
+# Đang tăng > 5cm/h → nâng một bậc
+TREND_RISING = 0.05
+
+_SEVERITY_NAMES = np.array(SEVERITY_LEVELS)
+
+
+def _as_array(values: Any, size: int) -> np.ndarray:
+    """Float array broadcast tới `size` phần tử; None (toàn bộ hoặc từng phần tử) → NaN."""
+    if values is None:
+        return np.full(size, np.nan)
+    return np.broadcast_to(np.asarray(values, dtype=np.float64), (size,))
+
+
+def sensor_severity_index(
+    levels: Sequence[float],
+    thresholds: Optional[Sequence[Optional[float]]] = None,
+    trends: Optional[Sequence[Optional[float]]] = None
+) -> np.ndarray:
+    """
+    Vectorized severity (chỉ số trong SEVERITY_LEVELS) cho cả mảng sensor.
+
+    Args:
+        levels: Mức nước (m)
+        thresholds: Ngưỡng cảnh báo từng sensor (None/≤0 = không có)
+        trends: Tốc độ thay đổi mức nước (m/h, None = không rõ)
+    """
+    levels = np.asarray(levels, dtype=np.float64).reshape(-1)
+    size = len(levels)
+    index = np.searchsorted(SEVERITY_BOUNDS, levels, side="right")
+
+    thresholds = _as_array(thresholds, size)
+    with np.errstate(invalid="ignore"):
+        exceeded = (thresholds > 0) & (levels >= thresholds)
+        index = np.where(exceeded, np.maximum(index, THRESHOLD_MIN_INDEX), index)
+        rising = _as_array(trends, size) > TREND_RISING
+    index = np.where(rising, np.minimum(index + 1, len(SEVERITY_LEVELS) - 1), index)
+    return index.astype(np.int8)
+
+
+def sensor_severities(
+    levels: Sequence[float],
+    thresholds: Optional[Sequence[Optional[float]]] = None,
+    trends: Optional[Sequence[Optional[float]]] = None
+) -> np.ndarray:
+    """Vectorized severity names ("Low" ... "Severe") cho cả mảng sensor."""
+    return _SEVERITY_NAMES[sensor_severity_index(levels, thresholds, trends)]
+
+
+def sensor_severity(level: float, threshold: Optional[float] = None, trend: Optional[float] = None) -> str:
+    """Severity của một sensor (batch một phần tử)."""
+    return SEVERITY_LEVELS[sensor_severity_index([level], [threshold], [trend])[0]]
+
+
+# ======================================================
+# CROWD REPORT RISK SCORE
+# ======================================================
+
+RISK_LEVELS = SEVERITY_LEVELS
+# risk score > ngưỡng → Moderate / High / Severe
+RISK_BOUNDS = np.array([0.35, 0.55, 0.75])
+# Trọng số: mức nước quan trọng nhất, rồi mô tả, ảnh, verified
+RISK_WEIGHTS = {"water_level": 0.50, "text": 0.25, "photo": 0.15, "verified": 0.10}
+VERIFIED_BOOST = 0.15
+
+SEVERITY_KEYWORDS = (
+    # Tiếng Việt
+    "nguy hiểm", "nghiêm trọng", "ngập sâu", "kẹt xe", "không qua được",
+    "nước chảy mạnh", "ngập nặng", "tràn bờ", "sụp đổ", "cứu", "giúp",
+    "chết người", "cuốn trôi", "mắc kẹt", "ngập đến", "ngang người",
+    "ngập lụt", "khẩn cấp", "nguy cấp",
+    # English
+    "danger", "severe", "overflow", "stuck", "blocked", "deep",
+    "emergency", "flood", "help", "rescue", "dangerous",
+)
+
+# "30cm", "0.5 m", "1,2 mét" trong mô tả (report không có waterLevel).
+# Đơn vị phải đứng riêng (sau nó không phải chữ cái): "Quận 7 mưa", "2 máy bơm" không phải độ sâu
+_DEPTH_RE = re.compile(r"([0-9]+(?:[.,][0-9]+)?)\s*(cm|mét|met|m)(?![^\W\d_])")
+
+_RISK_NAMES = np.array(RISK_LEVELS)
+
+
+def _round(values: np.ndarray, digits: int = 3) -> np.ndarray:
+    """
+    Vectorized round() khớp với round() của Python.
+
+    np.round nhân 10^n rồi làm tròn nên lệch ở giá trị sát .5 (vd. 0.7875);
+    các phần tử đó (hiếm) được làm tròn lại bằng round() để điểm batch và
+    điểm từng report luôn giống hệt nhau.
+    """
+    scaled = values * 10.0 ** digits
+    rounded = np.round(scaled) / 10.0 ** digits
+    ties = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if ties.any():
+        rounded[ties] = [round(value, digits) for value in values[ties].tolist()]
+    return rounded
+
+
+def normalize_text(text: Optional[str]) -> str:
+    """Lowercase + NFC (mô tả gõ từ macOS/iOS có thể ở dạng dấu tách rời NFD)."""
+    return unicodedata.normalize("NFC", text).lower() if text else ""
+
+
+def strip_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt: "ngập sâu" → "ngap sau" (đ → d)."""
+    decomposed = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+class KeywordMatcher:
+    """
+    Precompiled keyword matcher over normalized text.
+
+    - Một regex alternation (dài trước) cho mọi keyword + dạng không dấu
+      ("ngap sau" = "ngập sâu"), quét text một lần trong C
+    - Lookahead `(?=(...))` thử tại mọi vị trí; keyword dài nhất bắt được
+      tại một vị trí kéo theo các keyword là chuỗi con của nó ("dangerous"
+      → cả "danger"), nên số keyword khác nhau đếm được giống hệt kiểm tra
+      `keyword in text` từng cái
+    - Cùng lần gọi trích độ sâu ghi trong mô tả ("50cm", "1m")
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = tuple(dict.fromkeys(normalize_text(k) for k in keywords))
+        # Biến thể (có dấu / không dấu) → keyword gốc
+        variants: Dict[str, str] = {}
+        for keyword in self.keywords:
+            variants.setdefault(keyword, keyword)
+            variants.setdefault(strip_diacritics(keyword), keyword)
+        # Biến thể → mọi keyword gốc chứa trong nó
+        self._implied = {
+            variant: frozenset(variants[other] for other in variants if other in variant)
+            for variant in variants
+        }
+        alternation = "|".join(re.escape(v) for v in sorted(variants, key=len, reverse=True))
+        self._pattern = re.compile(f"(?=({alternation}))")
+
+    def matches(self, text: Optional[str]) -> set:
+        """Keyword (dạng gốc) xuất hiện trong text."""
+        found = set()
+        for variant in self._pattern.findall(normalize_text(text)):
+            found |= self._implied[variant]
+        return found
+
+    def count(self, text: Optional[str]) -> int:
+        return len(self.matches(text)) if text else 0
+
+    def analyze(self, text: Optional[str]) -> Tuple[int, Optional[float]]:
+        """(số keyword, độ sâu ghi trong text hoặc None)."""
+        return self.count(text), depth_from_description(text)
+
+
+SEVERITY_MATCHER = KeywordMatcher(SEVERITY_KEYWORDS)
+
+
+def count_keywords(description: Optional[str]) -> int:
+    """Số keyword nguy hiểm (VI + EN, có dấu hoặc không dấu) xuất hiện trong mô tả."""
+    return SEVERITY_MATCHER.count(description)
+
+
+def depth_from_description(description: Optional[str]) -> Optional[float]:
+    """Độ sâu (m) ghi trong mô tả, vd. "ngập 30cm" → 0.3; None nếu không có."""
+    match = _DEPTH_RE.search(normalize_text(description))
+    if not match:
+        return None
+    value = float(match.group(1).replace(",", "."))
+    return value / 100 if match.group(2) == "cm" else value
+
+
+def crowd_text_features(descriptions: Iterable[Optional[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """(keyword matches, độ dài mô tả) cho cả mảng report - đầu vào của `crowd_risk_scores`."""
+    descriptions = [d or "" for d in descriptions]
+    matches = np.fromiter((SEVERITY_MATCHER.count(d) for d in descriptions), dtype=np.int32, count=len(descriptions))
+    lengths = np.fromiter((len(d) for d in descriptions), dtype=np.int32, count=len(descriptions))
+    return matches, lengths
+
+
+def crowd_risk_scores(
+    levels: Sequence[float],
+    keyword_matches: Any = 0,
+    description_lengths: Any = 0,
+    photo_counts: Any = 0,
+    verified: Any = False
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Vectorized risk score cho cả mảng crowd report.
+
+    Returns:
+        (risk scores [0, 1], risk level names, factors - mỗi factor là một mảng)
+    """
+    levels = np.asarray(levels, dtype=np.float64).reshape(-1)
+    size = len(levels)
+    matches = np.broadcast_to(np.asarray(keyword_matches, dtype=np.int32), (size,))
+    lengths = np.broadcast_to(np.asarray(description_lengths, dtype=np.int32), (size,))
+    photos = np.broadcast_to(np.asarray(photo_counts, dtype=np.int32), (size,))
+    verified = np.broadcast_to(np.asarray(verified, dtype=bool), (size,))
+
+    # 1. Mức nước - phi tuyến: 0-0.3m → 0-0.3, 0.3-0.8m → 0.3-0.7, >0.8m → 0.7-1.0
+    water_level_score = np.select(
+        [levels < 0.3, levels < 0.8],
+        [levels / 0.3 * 0.3, 0.3 + (levels - 0.3) / 0.5 * 0.4],
+        0.7 + np.minimum((levels - 0.8) / 1.2 * 0.3, 0.3)
+    )
+    # 2. Mô tả: keyword nguy hiểm, không thì theo độ dài
+    text_score = np.select(
+        [matches >= 3, matches >= 1, lengths > 50, lengths > 20],
+        [1.0, 0.7, 0.4, 0.3],
+        0.1
+    )
+    # 3. Ảnh: mỗi ảnh 0.25, tối đa 1.0
+    photo_score = np.minimum(photos * 0.25, 1.0)
+
+    scores = np.clip(_round(
+        RISK_WEIGHTS["water_level"] * water_level_score
+        + RISK_WEIGHTS["text"] * text_score
+        + RISK_WEIGHTS["photo"] * photo_score
+        + RISK_WEIGHTS["verified"] * np.where(verified, 1.0, 0.5)
+    ), 0.0, 1.0)
+    risk_levels = _RISK_NAMES[np.searchsorted(RISK_BOUNDS, scores, side="left")]
+
+    factors = {
+        "waterLevelFactor": _round(water_level_score),
+        "textSeverityFactor": _round(text_score),
+        "photoFactor": _round(photo_score),
+        "verifiedFactor": np.where(verified, VERIFIED_BOOST, 0.0),
+        "keywordMatches": matches,
+    }
+    return scores, risk_levels, factors
+
+
+def score_crowd_reports(
+    descriptions: Sequence[Optional[str]],
+    levels: Optional[Sequence[Optional[float]]] = None,
+    photo_counts: Any = 0,
+    verified: Any = False
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Batch entry point cho rescore / backfill report lịch sử.
+
+    Mức nước thiếu (None/NaN) → độ sâu ghi trong mô tả ("ngập 50cm"), không có thì 0.
+
+    Returns: như `crowd_risk_scores`
+    """
+    descriptions = list(descriptions)
+    matches, lengths = crowd_text_features(descriptions)
+    levels = np.array(_as_array(levels, len(descriptions)))
+    for i in np.flatnonzero(np.isnan(levels)):
+        levels[i] = depth_from_description(descriptions[i]) or 0.0
+    return crowd_risk_scores(levels, matches, lengths, photo_counts, verified)
+
+
+def crowd_risk_score(
+    water_level: float,
+    description: str = "",
+    photos: Optional[list] = None,
+    verified: bool = False
+) -> Tuple[float, str, dict]:
+    """
+    Risk score của một crowd report (batch một phần tử).
+
+    Returns: (risk_score, risk_level, factors)
+    """
+    matches, lengths = crowd_text_features([description])
+    scores, levels, factors = crowd_risk_scores([water_level], matches, lengths, len(photos or []), verified)
+    return float(scores[0]), str(levels[0]), {
+        name: (int(values[0]) if name == "keywordMatches" else float(values[0]))
+        for name, values in factors.items()
+    }
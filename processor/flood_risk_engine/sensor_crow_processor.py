@@ -4,9 +4,14 @@
 from fastapi import FastAPI, Request
 import httpx
 import uuid
-import re
 from datetime import datetime
 
+# Scoring engine dùng chung với backend (bản vendored của app/services/scoring.py)
+try:
+    from .scoring import crowd_risk_score, depth_from_description, sensor_severity
+except ImportError:  # chạy trực tiếp trong thư mục này: uvicorn sensor_crow_processor:app
+    from scoring import crowd_risk_score, depth_from_description, sensor_severity
+
 app = FastAPI()
 
 ORION_BASE = "http://orion-ld:1026/ngsi-ld/v1"
@@ -59,6 +64,13 @@ async def create_subscriptions():
             "id": f"urn:ngsi-ld:Subscription:CrowdReport",
             "type": "Subscription",
             "entities": [{"type": "CrowdReport"}],
+            # Chỉ các attribute dùng để tính điểm: backend ghi thêm photoDerivatives
+            # sau khi resize ảnh, thay đổi đó không được kích hoạt tính lại
+            "watchedAttributes": [
+                "https://schema.org/description",
+                "https://schema.org/verified",
+                "https://uri.fiware.org/ns/data-models#location"
+            ],
             "notification": {
                 "attributes": [
                     "https://schema.org/description",
@@ -96,17 +108,11 @@ async def process_sensor(request: Request):
     sensor_id = data["id"]
 
     alert_threshold = data.get("alertThreshold", {}).get("value", 0.3)
+    trend = data.get("waterTrend", {}).get("value")
     coordinates = data["location"]["value"]["coordinates"]
 
-    # === severity rules ===
-    if water_level >= 1.5:
-        severity = "Severe"
-    elif water_level >= 0.5:
-        severity = "High"
-    elif water_level >= 0.2:
-        severity = "Medium"
-    else:
-        severity = "Low"
+    # === severity rules (shared scoring engine) ===
+    severity = sensor_severity(water_level, alert_threshold, trend)
 
     alert = "ThresholdExceeded" if water_level >= alert_threshold else "Normal"
 
@@ -156,19 +162,13 @@ async def process_crowd(request: Request):
     coordinates = data["location"]["value"]["coordinates"]
 
     # ===== extract depth from description =====
-    match = re.search(r"([0-9]+(\.[0-9]+)?)\s*(cm|m)", description, re.IGNORECASE)
-
-    if match:
-        value = float(match.group(1))
-        unit = match.group(3).lower()
-        depth = value / 100 if unit == "cm" else value
-    else:
+    depth = depth_from_description(description)
+    if depth is None:
         depth = 0.30 if "ngập nặng" in description else \
                 0.10 if "ngập" in description else 0.00
 
-    # ===== severity =====
-    severity = "High" if depth >= 0.30 else \
-               "Medium" if depth >= 0.15 else "Low"
+    # ===== severity (shared scoring engine) =====
+    risk_score, severity, _ = crowd_risk_score(depth, description, verified=verified)
 
     confidence = "High" if verified else "Medium"
 
@@ -178,6 +178,7 @@ async def process_crowd(request: Request):
         "id": flood_id,
         "type": "FloodRiskCrowd",
         "severity": {"type": "Property", "value": severity},
+        "riskScore": {"type": "Property", "value": risk_score},
         "crowdDepth": {"type": "Property", "value": depth},
         "confidence": {"type": "Property", "value": confidence},
         "sourceCrowd": {"type": "Relationship", "object": crowd_id},
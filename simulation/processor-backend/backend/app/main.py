@@ -6,27 +6,35 @@
 # ======================================================
 
 import os
-import io
-import uuid
 import logging
 import json
 from datetime import datetime, timezone
-from typing import List, Optional, Dict, Any, Tuple
-from contextlib import contextmanager
+from typing import List, Optional, Dict, Any, Tuple, Literal
 
 import asyncio
-import requests
-from crate import client
-from fastapi import FastAPI, UploadFile, Form, File, HTTPException, Request, status, WebSocket, WebSocketDisconnect, Query
+import asyncpg
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException, Request, status, WebSocket, WebSocketDisconnect, Query, Path
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
-from cachetools import TTLCache
-from PIL import Image
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
-from .services.storage import save_files_local, validate_and_save_files
-from .services.orion_client import create_crowd_report_entity
+from .services.storage import store_images
+from .services.image_derivatives import DerivativePipeline, DERIVED_SUBDIR
+from .services.orion_client import (
+    create_crowd_report_entity, derived_entity_id, get_orion, close_orion, OrionError, OrionUnavailable
+)
+from .services.ingest_queue import DedupWindow, IngestQueue, PartialFlush
+from .services import cratedb
+from .services.read_models import LatestReadingStore, coordinate_key, now_ms
+from .services.cache import SWRCache, TieredCache, start_invalidation_listener, close_backend, tiered_stats
+from .services import payloads
+from .services import scoring
+from .services.payloads import Payload, PayloadCache, payload_response
+from .services.geo_index import GeoIndex, VersionedGeoIndex
+from .services.zone_lookup import get_zone_lookup
+from .services.clustering import ClusterIndex, VersionedClusterIndex, MAX_ZOOM
+from .services.ws_hub import MapHub, Region
+from .services.ws_codec import MsgpackEncoder, PROTOCOL_JSON, PROTOCOL_MSGPACK, available_protocols
 from .schemas import CreateReportResult
 
 # ======================================================
@@ -150,63 +158,49 @@ ORION_LD_URL = os.getenv("ORION_ENTITIES", "http://orion-ld:1026/ngsi-ld/v1/enti
 CONTEXT = "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context-v1.6.jsonld"
 BASE_URL = os.getenv("BASE_URL")
 
-# CrateDB configuration
-CRATEDB_HTTP_URL = os.getenv("CRATEDB_HTTP_URL", "http://cratedb:4200")
-CRATEDB_USER = os.getenv("CRATEDB_USER", "crate")
-CRATEDB_DSN = os.getenv("CRATEDB_DSN", "postgresql://crate@cratedb:5432/quantumleap")
+# CrateDB configuration (asyncpg pool - xem services/cratedb.py)
+CRATEDB_DSN = cratedb.CRATEDB_DSN
 
 # ======================================================
-# CONNECTION POOL - OPTIMIZED
+# SNAPSHOT STORES - WRITE-THROUGH (thay thế TTL cache bị clear mỗi notification)
 # ======================================================
 
-# Global connection pool (singleton)
-_connection_pool = None
+# Crowd reports hiển thị trong 24 giờ gần nhất
+CROWD_WINDOW_MS = 24 * 60 * 60 * 1000
 
-def get_connection_pool():
-    """Get or create connection pool (lazy initialization)."""
-    global _connection_pool
-    if _connection_pool is None:
-        _connection_pool = client.connect(
-            CRATEDB_HTTP_URL, 
-            username=CRATEDB_USER
-        )
-    return _connection_pool
+# ✅ Read model: mực nước mới nhất theo zone (upsert mỗi notification /flood/sensor)
+sensor_state = LatestReadingStore(key_field="zoneid", alias_field="entity_id", time_field="updatedat")
 
-@contextmanager
-def get_db_cursor():
-    """Context manager for database cursor with connection pooling."""
-    conn = get_connection_pool()
-    cursor = conn.cursor()
-    try:
-        yield cursor
-    finally:
-        cursor.close()
+# ✅ Crowd report mới nhất theo tọa độ (upsert mỗi notification /flood/crowd)
+crowd_state = LatestReadingStore(
+    key_func=coordinate_key,
+    alias_field="entity_id",
+    time_field="calculatedat",
+    order_by="calculatedat",
+    descending=True
+)
 
-# ======================================================
-# TTL CACHE - OPTIMIZED (thay thế lru_cache)
-# ======================================================
+# ✅ NEW: Đồng bộ store với CrateDB theo kiểu stale-while-revalidate + single-flight.
+# Lần đầu (sau restart) chờ bootstrap; sau đó cứ SNAPSHOT_REFRESH_TTL giây thì một
+# request kích hoạt reconcile chạy nền, các request khác vẫn đọc store ngay.
+SNAPSHOT_REFRESH_TTL = float(os.getenv("SNAPSHOT_REFRESH_TTL", "30"))
+snapshot_refresh = SWRCache(ttl=SNAPSHOT_REFRESH_TTL, name="snapshot")
+
+# ✅ NEW: Kết quả query reconcile dùng chung giữa các worker (L2 Redis nếu có REDIS_URL)
+# → với `uvicorn --workers N`, CrateDB chỉ chạy query nặng một lần mỗi TTL cho cả cluster
+snapshot_rows_cache = TieredCache(namespace="snapshot_rows", ttl=SNAPSHOT_REFRESH_TTL)
+
+# ✅ NEW: JSON bytes (orjson) của dashboard/nearby/WebSocket snapshot, build một lần
+# cho mỗi version của store; HTTP trả kèm ETag và 304 khi client gửi If-None-Match
+snapshot_payloads = PayloadCache(maxsize=256)
 
-# Cache với TTL 30 giây
-snapshot_cache = TTLCache(maxsize=10, ttl=30)
-sensor_cache = TTLCache(maxsize=10, ttl=30)
-
-def cached_get_snapshot_crowd(limit: int = 1000) -> list:
-    """Get crowd snapshot with TTL cache."""
-    cache_key = f"crowd_{limit}"
-    if cache_key in snapshot_cache:
-        return snapshot_cache[cache_key]
-    result = get_snapshot_crowd(limit)
-    snapshot_cache[cache_key] = result
-    return result
-
-def cached_get_snapshot_sensor(limit: int = 1000) -> list:
-    """Get sensor snapshot with TTL cache."""
-    cache_key = f"sensor_{limit}"
-    if cache_key in sensor_cache:
-        return sensor_cache[cache_key]
-    result = get_snapshot_sensor(limit)
-    sensor_cache[cache_key] = result
-    return result
+async def cached_get_snapshot_crowd(limit: int = 1000) -> list:
+    """Get crowd snapshot from the in-memory write-through store."""
+    return await get_snapshot_crowd(limit)
+
+async def cached_get_snapshot_sensor(limit: int = 1000) -> list:
+    """Get sensor snapshot from the latest-reading-per-zone read model."""
+    return await get_snapshot_sensor(limit)
 
 # ======================================================
 # UTILITIES
@@ -233,6 +227,14 @@ def validate_location(location: Dict[str, Any]) -> Dict[str, Any]:
         }
     return None
 
+def point_coordinates(location: Dict[str, Any]) -> Tuple[Optional[float], Optional[float]]:
+    """Extract (lng, lat) from a GeoProperty Point, (None, None) otherwise."""
+    value = (location or {}).get("value") or {}
+    coords = value.get("coordinates") if value.get("type") == "Point" else None
+    if not coords or len(coords) < 2:
+        return None, None
+    return coords[0], coords[1]
+
 def validate_coordinates(lat: float, lng: float, precision_check: bool = False) -> bool:
     """
     Validate coordinates for Vietnam with improved bounds.
@@ -273,35 +275,10 @@ def compute_flood_severity(water_level: float, threshold: float = None, trend: f
     - water_level 0.2-0.5m: Moderate (20-50cm - cần chú ý)
     - water_level 0.5-1.0m: High (50-100cm - nguy hiểm)
     - water_level > 1.0m: Severe (trên 100cm - rất nguy hiểm)
+
+    ✅ NEW: Logic nằm ở `services.scoring` (dùng chung với processor, có API batch)
     """
-    # ✅ Phân loại theo mức nước tuyệt đối (Việt Nam context)
-    if water_level < 0.2:  # < 20cm
-        base_severity = "Low"
-    elif water_level < 0.5:  # 20-50cm
-        base_severity = "Moderate"
-    elif water_level < 1.0:  # 50-100cm
-        base_severity = "High"
-    else:  # > 100cm
-        base_severity = "Severe"
-    
-    # ✅ Xét threshold (ngưỡng cảnh báo địa phương) nếu có
-    if threshold and threshold > 0 and water_level >= threshold:
-        if base_severity in ["Low", "Moderate"]:
-            base_severity = "High"
-    
-    # ✅ Xét xu hướng tăng (trend) với ngưỡng thấp hơn
-    severity_levels = ["Low", "Moderate", "High", "Severe"]
-    current_idx = severity_levels.index(base_severity)
-    
-    if trend is not None:
-        if trend > 0.05:  # Tăng > 5cm/h - nguy hiểm
-            if current_idx < len(severity_levels) - 1:
-                base_severity = severity_levels[current_idx + 1]
-        elif trend > 0.1:  # Tăng > 10cm/h - rất nguy hiểm
-            if current_idx < len(severity_levels) - 2:
-                base_severity = severity_levels[min(current_idx + 2, 3)]
-    
-    return base_severity
+    return scoring.sensor_severity(water_level, threshold, trend)
 
 def severity_from_level(level: float, threshold: float) -> str:
     """Wrapper for backward compatibility."""
@@ -319,100 +296,25 @@ def calculate_crowd_risk_score(
 ) -> Tuple[float, str, dict]:
     """
     ✅ FIXED: Tính risk score với logic cải tiến
+    ✅ NEW: Logic nằm ở `services.scoring` (dùng chung với processor, có API batch)
     
     Returns: (risk_score, risk_level, factors)
     """
-    photos = photos or []
-    
-    # ✅ 1. Water level score - phi tuyến tính (quan trọng nhất)
-    if water_level < 0.3:
-        water_level_score = water_level / 0.3 * 0.3  # 0-0.3
-    elif water_level < 0.8:
-        water_level_score = 0.3 + (water_level - 0.3) / 0.5 * 0.4  # 0.3-0.7
-    else:
-        water_level_score = 0.7 + min((water_level - 0.8) / 1.2 * 0.3, 0.3)  # 0.7-1.0
-    
-    # ✅ 2. Photo evidence score (nhiều ảnh = độ tin cậy cao)
-    photo_score = min(len(photos) * 0.25, 1.0) if photos else 0.0
-    
-    # ✅ 3. Text severity score với keywords tiếng Việt
-    severity_keywords_vi = [
-        "nguy hiểm", "nghiêm trọng", "ngập sâu", "kẹt xe", "không qua được",
-        "nước chảy mạnh", "ngập nặng", "tràn bờ", "sụp đổ", "cứu", "giúp",
-        "chết người", "cuốn trôi", "mắc kẹt", "ngập đến", "ngang người",
-        "ngập lụt", "khẩn cấp", "nguy cấp"
-    ]
-    severity_keywords_en = [
-        "danger", "severe", "overflow", "stuck", "blocked", "deep",
-        "emergency", "flood", "help", "rescue", "dangerous"
-    ]
-    all_keywords = severity_keywords_vi + severity_keywords_en
-    
-    description_lower = description.lower() if description else ""
-    keyword_matches = sum(1 for w in all_keywords if w in description_lower)
-    
-    if keyword_matches >= 3:
-        text_severity_score = 1.0
-    elif keyword_matches >= 1:
-        text_severity_score = 0.7
-    elif len(description) > 50:
-        text_severity_score = 0.4
-    elif len(description) > 20:
-        text_severity_score = 0.3
-    else:
-        text_severity_score = 0.1
-    
-    # ✅ 4. Verified boost (chỉ tăng confidence, không ảnh hưởng quá nhiều)
-    verified_boost = 0.15 if verified else 0.0
-    
-    # ✅ 5. Final risk score với trọng số hợp lý
-    risk_score = round(
-        0.50 * water_level_score +      # 50% từ mức nước (quan trọng nhất)
-        0.25 * text_severity_score +    # 25% từ mô tả
-        0.15 * photo_score +            # 15% từ ảnh
-        0.10 * (1.0 if verified else 0.5),  # 10% từ verified status
-        3
-    )
-    
-    # Clamp to [0, 1]
-    risk_score = max(0.0, min(1.0, risk_score))
-    
-    # ✅ 6. Determine risk level
-    if risk_score > 0.75:
-        risk_level = "Severe"
-    elif risk_score > 0.55:
-        risk_level = "High"
-    elif risk_score > 0.35:
-        risk_level = "Moderate"
-    else:
-        risk_level = "Low"
-    
-    factors = {
-        "waterLevelFactor": round(water_level_score, 3),
-        "textSeverityFactor": round(text_severity_score, 3),
-        "photoFactor": round(photo_score, 3),
-        "verifiedFactor": round(verified_boost, 3),
-        "keywordMatches": keyword_matches
-    }
-    
-    return risk_score, risk_level, factors
+    return scoring.crowd_risk_score(water_level, description, photos, verified)
 
 # ======================================================
-# DATABASE QUERIES - OPTIMIZED with Connection Pool
+# DATABASE QUERIES - ASYNC (asyncpg pool, không block event loop)
 # ======================================================
 
-def execute_query(query: str, params: list = None) -> list:
-    """Execute CrateDB query with connection pooling."""
+async def execute_query(query: str, *args, timeout: float = None, json_fields: tuple = ()) -> list:
+    """Execute CrateDB query on the async pool. Returns [] on error/timeout."""
     try:
-        with get_db_cursor() as cursor:
-            cursor.execute(query, params or [])
-            columns = [desc[0] for desc in cursor.description]
-            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return await cratedb.fetch(query, *args, timeout=timeout, json_fields=json_fields)
+    except asyncio.TimeoutError:
+        logger.error(f"CrateDB Query TIMEOUT after {timeout or cratedb.CRATEDB_QUERY_TIMEOUT}s")
+        return []
     except Exception as e:
         logger.error(f"CrateDB Query ERROR: {str(e)}")
-        # Reset connection pool on error
-        global _connection_pool
-        _connection_pool = None
         return []
 
 def deduplicate_by_coordinates(records: List[Dict], coord_precision: int = 5) -> List[Dict]:
@@ -439,12 +341,15 @@ def deduplicate_by_coordinates(records: List[Dict], coord_precision: int = 5) ->
     return unique_records
 
 # ===========================================================
-# SNAPSHOT QUERIES - OPTIMIZED với xóa cũ lấy mới
+# SNAPSHOT QUERIES - BOOTSTRAP PATH (chỉ chạy sau restart)
 # ===========================================================
 
-def get_snapshot_crowd(limit: int = 1000) -> list:
-    """Get latest crowd reports - chỉ lấy record mới nhất cho mỗi vị trí."""
-    records = execute_query(f"""
+async def query_latest_crowd_rows(limit: int = 1000) -> list:
+    """
+    ✅ REBUILD PATH: Latest crowd reports - chỉ lấy record mới nhất cho mỗi vị trí.
+    Chỉ dùng để bootstrap `crowd_state`, live views đọc từ memory.
+    """
+    records = await execute_query(f"""
         SELECT 
             entity_id,
             entity_type,
@@ -460,23 +365,93 @@ def get_snapshot_crowd(limit: int = 1000) -> list:
         AND calculatedat > NOW() - INTERVAL '24 hours'
         ORDER BY calculatedat DESC
         LIMIT {limit}
-    """)
+    """, json_fields=("address",))
     
     # Deduplicate - chỉ giữ record mới nhất cho mỗi tọa độ
     unique_records = deduplicate_by_coordinates(records)
+    # ✅ Gán zone (point-in-polygon) cho cả batch
+    get_zone_lookup().assign(unique_records)
     logger.info(f"Crowd: {len(records)} raw → {len(unique_records)} unique (24h)")
     
     return unique_records
 
-def get_snapshot_sensor(limit: int = 1000) -> list:
+async def rebuild_crowd_state() -> int:
+    """Bootstrap the crowd snapshot store from CrateDB."""
+    records = await snapshot_rows_cache.get_or_load("crowd", query_latest_crowd_rows)
+    # DB trống/không kết nối được: giữ chưa bootstrap để lần đọc sau thử lại
+    if records:
+        crowd_state.bootstrap(records)
+    return len(crowd_state)
+
+async def refresh_crowd_state():
+    """
+    Bootstrap/reconcile crowd store với CrateDB qua `snapshot_refresh`
+    (một query cho mọi request) và loại report ngoài cửa sổ 24h.
     """
-    ✅ OPTIMIZED: Get latest sensor data from WaterLevelObserved entities
+    await snapshot_refresh.get("crowd", rebuild_crowd_state)
+    crowd_state.evict_older_than(now_ms() - CROWD_WINDOW_MS)
+
+async def get_snapshot_crowd(limit: int = 1000) -> list:
+    """✅ OPTIMIZED: Crowd reports trong 24h từ store trong memory."""
+    await refresh_crowd_state()
+    return crowd_state.snapshot(limit)
+
+def normalize_sensor_rows(records: List[Dict]) -> List[Dict]:
+    """
+    Deduplicate sensor rows by zoneId (for polygon zones) or coordinates,
+    fill in `severity`/`updatedat`. Giữ thứ tự đầu vào (row đầu tiên thắng).
+    """
+    seen_zones = set()
+    seen_coords = set()
+    unique_records = []
+    
+    for record in records:
+        lat = record.get('lat')
+        lng = record.get('lng')
+        zone_id = record.get('zoneid')
+        
+        if not validate_coordinates(lat, lng):
+            continue
+        
+        # Skip nếu đã thấy zone này
+        if zone_id:
+            if zone_id in seen_zones:
+                continue
+            seen_zones.add(zone_id)
+        else:
+            # Fallback to coordinate-based dedup
+            coord_key = (round(lat, 4), round(lng, 4))
+            if coord_key in seen_coords:
+                continue
+            seen_coords.add(coord_key)
+        
+        # ✅ Map updatedat from time_index (thời điểm QuantumLeap ghi) or use current time
+        if not record.get('updatedat'):
+            record['updatedat'] = record.get('time_index') or now_ms()
+        
+        unique_records.append(record)
+    
+    # ✅ Calculate severity from water level for WaterLevelObserved (một lần cho cả batch)
+    unscored = [record for record in unique_records if not record.get('severity')]
+    if unscored:
+        levels = [record.get('waterlevel') or 0 for record in unscored]
+        for record, severity in zip(unscored, scoring.sensor_severities(levels).tolist()):
+            record['severity'] = severity
+    
+    return unique_records
+
+async def query_latest_sensor_rows(limit: int = 1000) -> list:
+    """
+    ✅ REBUILD PATH: Query latest sensor data from WaterLevelObserved entities
     Simulator creates WaterLevelObserved entities with zoneId for polygon zones.
     Lấy record mới nhất cho mỗi zone.
+    
+    Query GROUP BY/JOIN trên toàn bộ bảng lịch sử - chỉ dùng để rebuild
+    `sensor_state` (sau restart), live views đọc từ read model.
     """
     # ✅ FIX: Sử dụng subquery để lấy record mới nhất của mỗi zoneid
     # Tránh vấn đề LIMIT chỉ lấy một số zones đầu alphabet
-    records = execute_query(f"""
+    records = await execute_query(f"""
         SELECT 
             t.entity_id,
             t.entity_type,
@@ -507,7 +482,7 @@ def get_snapshot_sensor(limit: int = 1000) -> list:
     # Fallback: Try FloodRiskSensor table if WaterLevelObserved is empty
     if not records:
         logger.info("WaterLevelObserved empty, falling back to FloodRiskSensor")
-        records = execute_query(f"""
+        records = await execute_query(f"""
             SELECT 
                 t.entity_id,
                 t.entity_type,
@@ -529,108 +504,109 @@ def get_snapshot_sensor(limit: int = 1000) -> list:
             LIMIT {limit}
         """)
     
-    # Deduplicate by zoneId (for polygon zones) or coordinates
-    seen_zones = set()
-    seen_coords = set()
-    unique_records = []
-    
-    for record in records:
-        lat = record.get('lat')
-        lng = record.get('lng')
-        zone_id = record.get('zoneid')
-        
-        if not validate_coordinates(lat, lng):
-            continue
-        
-        # Skip nếu đã thấy zone này
-        if zone_id:
-            if zone_id in seen_zones:
-                continue
-            seen_zones.add(zone_id)
-        else:
-            # Fallback to coordinate-based dedup
-            coord_key = (round(lat, 4), round(lng, 4))
-            if coord_key in seen_coords:
-                continue
-            seen_coords.add(coord_key)
-        
-        # ✅ Calculate severity from water level for WaterLevelObserved
-        water_level = record.get('waterlevel', 0)
-        if not record.get('severity'):
-            record['severity'] = compute_flood_severity(water_level)
-        
-        # ✅ Map updatedat from entity_id timestamp or use current time
-        if not record.get('updatedat'):
-            record['updatedat'] = now_iso()
-        
-        unique_records.append(record)
+    unique_records = normalize_sensor_rows(records)
     
     logger.info(f"Sensor: {len(records)} raw → {len(unique_records)} unique zones")
     
     return unique_records
 
+async def rebuild_sensor_state() -> int:
+    """Rebuild the latest-reading-per-zone read model from CrateDB."""
+    records = await snapshot_rows_cache.get_or_load("sensor", query_latest_sensor_rows)
+    # DB trống/không kết nối được: giữ chưa bootstrap để lần đọc sau thử lại
+    if records:
+        sensor_state.bootstrap(records)
+    return len(sensor_state)
+
+async def refresh_sensor_state():
+    """Bootstrap/reconcile sensor read model với CrateDB qua `snapshot_refresh`."""
+    await snapshot_refresh.get("sensor", rebuild_sensor_state)
+
+async def get_snapshot_sensor(limit: int = 1000) -> list:
+    """✅ OPTIMIZED: Latest sensor reading per zone từ read model - O(zones)."""
+    await refresh_sensor_state()
+    return sensor_state.snapshot(limit)
+
+def snapshot_timestamp(*stores: LatestReadingStore) -> str:
+    """
+    Thời điểm store thay đổi gần nhất (ISO). Dùng thay cho `now_iso()` trong
+    payload snapshot để cùng version → cùng bytes → cùng ETag.
+    """
+    updated = [store.updated_at for store in stores if store.updated_at]
+    if not updated:
+        return now_iso()
+    return datetime.fromtimestamp(max(updated) / 1000, tz=timezone.utc).isoformat()
+
 # ===========================================================
-# RADIUS FILTER - NEW FEATURE
+# RADIUS FILTER - SPATIAL INDEX (build một lần mỗi version)
 # ===========================================================
 
-def filter_by_radius(
-    records: List[Dict], 
-    center_lat: float, 
-    center_lng: float, 
-    radius_km: float
-) -> List[Dict]:
+# ✅ OPTIMIZED: grid index + haversine NumPy thay cho vòng lặp Python trên mọi record
+crowd_geo = VersionedGeoIndex()
+sensor_geo = VersionedGeoIndex()
+
+def crowd_index() -> GeoIndex:
+    """Spatial index over the current crowd snapshot."""
+    return crowd_geo.get(crowd_state.version, lambda: crowd_state.snapshot(1000))
+
+def sensor_index() -> GeoIndex:
+    """Spatial index over the current sensor snapshot."""
+    return sensor_geo.get(sensor_state.version, lambda: sensor_state.snapshot(1000))
+
+def radius_snapshots(
+    lat: Optional[float],
+    lng: Optional[float],
+    radius: Optional[float],
+    limit: Optional[int] = None
+) -> Tuple[List[Dict], List[Dict]]:
     """
-    ✅ NEW: Lọc records theo bán kính từ điểm trung tâm.
-    
-    Args:
-        records: Danh sách records với lat/lng
-        center_lat: Vĩ độ tâm
-        center_lng: Kinh độ tâm
-        radius_km: Bán kính tính bằng km
-    
-    Returns:
-        Danh sách records trong bán kính
+    Crowd + sensor snapshots (copies), lọc theo bán kính nếu có đủ `lat/lng/radius`.
+    Kết quả lọc sắp xếp gần nhất trước, kèm `distance_km`.
     """
-    from math import radians, cos, sin, asin, sqrt
-    
-    def haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
-        """Calculate distance between two points in km."""
-        R = 6371  # Earth radius in km
-        
-        lat1, lng1, lat2, lng2 = map(radians, [lat1, lng1, lat2, lng2])
-        dlat = lat2 - lat1
-        dlng = lng2 - lng1
-        
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlng/2)**2
-        c = 2 * asin(sqrt(a))
-        
-        return R * c
-    
-    filtered = []
-    for record in records:
-        lat = record.get('lat')
-        lng = record.get('lng')
-        
-        if lat is None or lng is None:
-            continue
-        
-        distance = haversine(center_lat, center_lng, lat, lng)
-        if distance <= radius_km:
-            record['distance_km'] = round(distance, 2)
-            filtered.append(record)
-    
-    # Sort by distance
-    filtered.sort(key=lambda x: x.get('distance_km', 0))
-    
-    return filtered
+    if lat is None or lng is None or not radius:
+        return crowd_state.snapshot(1000), sensor_state.snapshot(1000)
+    return (
+        crowd_index().within(lat, lng, radius, limit),
+        sensor_index().within(lat, lng, radius, limit)
+    )
+
+def region_snapshots(region: Optional[Region]) -> Tuple[List[Dict], List[Dict]]:
+    """Crowd + sensor snapshots (copies) inside a WebSocket subscription region."""
+    if region is None:
+        return radius_snapshots(None, None, None)
+    if region.radius_km is not None:
+        return radius_snapshots(region.lat, region.lng, region.radius_km)
+    bbox = (region.south, region.west, region.north, region.east)
+    return crowd_index().within_bbox(*bbox), sensor_index().within_bbox(*bbox)
 
 # ===========================================================
-# INCREMENTAL QUERIES - OPTIMIZED
+# GEO QUERIES - PUSHDOWN (CrateDB distance() trên location_centroid)
 # ===========================================================
 
-def get_crowd_after(timestamp) -> list:
-    """Get new crowd reports after timestamp."""
-    records = execute_query("""
+# Số row tối đa một truy vấn geo được trả về (thay cho cap 1000 của snapshot)
+DB_GEO_MAX_ROWS = int(os.getenv("DB_GEO_MAX_ROWS", "5000"))
+# Lịch sử crowd có nhiều row cùng tọa độ → lấy dư rồi dedupe giữ row mới nhất
+DB_GEO_OVERFETCH = int(os.getenv("DB_GEO_OVERFETCH", "4"))
+
+def wkt_point(lat: float, lng: float) -> str:
+    """WKT point cho tham số geo_point (CrateDB: `POINT(lng lat)`)."""
+    return f"POINT({lng} {lat})"
+
+def finish_geo_rows(records: List[Dict], limit: int) -> List[Dict]:
+    """distance (m) → `distance_km`, cắt theo `limit`."""
+    for record in records:
+        record["distance_km"] = round(record.pop("distance_m", 0) / 1000, 2)
+    return records[:limit]
+
+async def query_crowd_within(lat: float, lng: float, radius_km: float, limit: int) -> list:
+    """
+    ✅ NEW: Crowd reports (24h) trong bán kính, gần nhất trước - lọc ngay trong CrateDB.
+    
+    Raises:
+        cratedb.CrateDBUnavailable / asyncio.TimeoutError
+    """
+    fetch_limit = min(limit * DB_GEO_OVERFETCH, DB_GEO_MAX_ROWS)
+    records = await cratedb.fetch("""
         SELECT 
             entity_id,
             entity_type,
@@ -640,24 +616,23 @@ def get_crowd_after(timestamp) -> list:
             risklevel,
             waterlevel,
             address,
-            calculatedat
+            calculatedat,
+            distance(location_centroid, CAST($1 AS geo_point)) AS distance_m
         FROM doc.etfloodriskcrowd
-        WHERE calculatedat > ?
-        AND location_centroid IS NOT NULL
-        ORDER BY calculatedat DESC
-        LIMIT 100
-    """, [timestamp])
-    
-    return deduplicate_by_coordinates(records)
-
-def get_sensor_after(timestamp) -> list:
-    """Get new sensor data after timestamp.
-    ✅ FIX: Query từ WaterLevelObserved table với polygon zone fields
-    Lấy record mới nhất của mỗi zone.
-    """
-    # Try WaterLevelObserved first (from simulator polygon zones)
-    # Sử dụng subquery để lấy record mới nhất của mỗi zoneid
-    records = execute_query("""
+        WHERE location_centroid IS NOT NULL
+        AND calculatedat > NOW() - INTERVAL '24 hours'
+        AND distance(location_centroid, CAST($1 AS geo_point)) <= $2
+        ORDER BY distance_m, calculatedat DESC
+        LIMIT $3
+    """, wkt_point(lat, lng), radius_km * 1000, fetch_limit, json_fields=("address",))
+    # Cùng tọa độ → cùng distance, row mới nhất đứng trước → dedupe giữ row đầu
+    records = finish_geo_rows(deduplicate_by_coordinates(records), limit)
+    get_zone_lookup().assign(records)
+    return records
+
+async def query_water_level_within(lat: float, lng: float, radius_km: float, limit: int) -> list:
+    """Latest WaterLevelObserved row per zone within the radius, nearest first."""
+    return await cratedb.fetch("""
         SELECT 
             t.entity_id,
             t.entity_type,
@@ -670,28 +645,39 @@ def get_sensor_after(timestamp) -> list:
             t.zoneid,
             t.zonename,
             t.reporttype,
-            t.time_index
+            t.time_index,
+            distance(t.location_centroid, CAST($1 AS geo_point)) AS distance_m
         FROM doc.etwaterlevelobserved t
         INNER JOIN (
             SELECT zoneid, MAX(time_index) as max_time
             FROM doc.etwaterlevelobserved
             WHERE location_centroid IS NOT NULL
+            AND distance(location_centroid, CAST($1 AS geo_point)) <= $2
             GROUP BY zoneid
         ) latest ON t.zoneid = latest.zoneid AND t.time_index = latest.max_time
         WHERE t.location_centroid IS NOT NULL
-        ORDER BY t.zoneid
-        LIMIT 100
-    """)
+        AND distance(t.location_centroid, CAST($1 AS geo_point)) <= $2
+        ORDER BY distance_m
+        LIMIT $3
+    """, wkt_point(lat, lng), radius_km * 1000, min(limit, DB_GEO_MAX_ROWS))
+
+async def query_sensor_within(lat: float, lng: float, radius_km: float, limit: int) -> list:
+    """
+    ✅ NEW: Reading mới nhất của các zone trong bán kính, gần nhất trước - lọc trong CrateDB.
     
-    # Add severity and updatedat for each record
-    for record in records:
-        water_level = record.get('waterlevel', 0)
-        record['severity'] = compute_flood_severity(water_level)
-        record['updatedat'] = now_iso()
+    Giống `query_latest_sensor_rows`: không có WaterLevelObserved (bảng chưa có
+    hoặc không có row trong bán kính) → fallback sang FloodRiskSensor.
     
-    # Fallback to FloodRiskSensor if empty
+    Raises:
+        cratedb.CrateDBUnavailable / asyncio.TimeoutError
+    """
+    try:
+        records = await query_water_level_within(lat, lng, radius_km, limit)
+    except asyncpg.UndefinedTableError:
+        records = []
     if not records:
-        records = execute_query("""
+        logger.info("No WaterLevelObserved in radius, falling back to FloodRiskSensor")
+        records = await cratedb.fetch("""
             SELECT 
                 entity_id,
                 entity_type,
@@ -704,25 +690,84 @@ def get_sensor_after(timestamp) -> list:
                 updatedat,
                 zoneid,
                 zonename,
-                watertrend
+                watertrend,
+                distance(location_centroid, CAST($1 AS geo_point)) AS distance_m
             FROM doc.etfloodrisksensor
-            WHERE updatedat > ?
-            AND location_centroid IS NOT NULL
-            ORDER BY updatedat DESC
-            LIMIT 100
-        """, [timestamp])
-    
-    return deduplicate_by_coordinates(records)
+            WHERE location_centroid IS NOT NULL
+            AND distance(location_centroid, CAST($1 AS geo_point)) <= $2
+            ORDER BY distance_m, updatedat DESC
+            LIMIT $3
+        """, wkt_point(lat, lng), radius_km * 1000, min(limit * DB_GEO_OVERFETCH, DB_GEO_MAX_ROWS))
+    # Cùng zone → row gần nhất / mới nhất đứng trước → normalize giữ row đầu
+    return finish_geo_rows(normalize_sensor_rows(records), limit)
+
+async def query_within(lat: float, lng: float, radius_km: float, limit: int) -> Tuple[list, list]:
+    """Crowd + sensor trong bán kính từ CrateDB; DB không khả dụng → 503."""
+    try:
+        return await asyncio.gather(
+            query_crowd_within(lat, lng, radius_km, limit),
+            query_sensor_within(lat, lng, radius_km, limit)
+        )
+    except (cratedb.CrateDBUnavailable, asyncio.TimeoutError) as e:
+        logger.error(f"Geo query failed: {e}")
+        raise HTTPException(503, "CrateDB unavailable for source=db")
 
 # ===========================================================
 # DASHBOARD STATISTICS API - ENHANCED
 # ===========================================================
 
+def build_dashboard_stats(
+    crowd: List[Dict],
+    sensor: List[Dict],
+    lat: Optional[float],
+    lng: Optional[float],
+    radius: Optional[float]
+) -> Dict[str, Any]:
+    """Compute dashboard statistics from (radius-filtered) crowd + sensor snapshots."""
+    total_points = len(crowd) + len(sensor)
+    
+    # Severity counts
+    severe_count = len([r for r in crowd if r.get('risklevel') == 'Severe'])
+    severe_count += len([r for r in sensor if r.get('severity') == 'Severe'])
+    
+    high_count = len([r for r in crowd if r.get('risklevel') == 'High'])
+    high_count += len([r for r in sensor if r.get('severity') == 'High'])
+    
+    medium_count = len([r for r in crowd if r.get('risklevel') in ['Moderate', 'Medium']])
+    medium_count += len([r for r in sensor if r.get('severity') in ['Moderate', 'Medium']])
+    
+    low_count = total_points - severe_count - high_count - medium_count
+    
+    # Average water level
+    all_water_levels = []
+    all_water_levels.extend([r.get('waterlevel', 0) for r in crowd if r.get('waterlevel')])
+    all_water_levels.extend([r.get('waterlevel', 0) for r in sensor if r.get('waterlevel')])
+    avg_water_level = sum(all_water_levels) / len(all_water_levels) if all_water_levels else 0
+    
+    return {
+        "total": total_points,
+        "severe": severe_count,
+        "high": high_count,
+        "medium": medium_count,
+        "low": low_count,
+        "avgWaterLevel": round(avg_water_level, 2),
+        "sensorCount": len(sensor),
+        "communityCount": len(crowd),
+        "lastUpdated": snapshot_timestamp(crowd_state, sensor_state),
+        "filter": {
+            "lat": lat,
+            "lng": lng,
+            "radius_km": radius
+        } if radius else None
+    }
+
 @app.get("/api/dashboard/stats", tags=["Dashboard"], summary="Thống kê tổng quan")
 async def get_dashboard_stats(
+    request: Request,
     lat: Optional[float] = Query(None, description="Vĩ độ tâm để lọc theo bán kính"),
     lng: Optional[float] = Query(None, description="Kinh độ tâm để lọc theo bán kính"),
-    radius: Optional[float] = Query(None, description="Bán kính lọc (km)", ge=0.1, le=100)
+    radius: Optional[float] = Query(None, description="Bán kính lọc (km)", ge=0.1, le=100),
+    source: Literal["memory", "db"] = Query("memory", description="memory: snapshot trong memory; db: lọc bán kính trong CrateDB")
 ):
     """
     📊 **Lấy thống kê tổng quan cho Dashboard**
@@ -734,59 +779,88 @@ async def get_dashboard_stats(
     - Số liệu từ sensors và community reports
     
     **Hỗ trợ lọc theo bán kính**: Cung cấp `lat`, `lng`, `radius` để lọc dữ liệu trong phạm vi.
+    
+    **`source=db`**: lọc bán kính bằng `distance()` của CrateDB (cần `lat`, `lng`, `radius`),
+    không bị giới hạn bởi 1000 bản ghi của snapshot.
+    
+    Hỗ trợ `If-None-Match` (ETag) → 304 nếu dữ liệu chưa thay đổi.
     """
     try:
-        crowd = cached_get_snapshot_crowd(1000)
-        sensor = cached_get_snapshot_sensor(1000)
-        
-        # ✅ Apply radius filter if provided
-        if lat is not None and lng is not None and radius is not None:
-            crowd = filter_by_radius(crowd, lat, lng, radius)
-            sensor = filter_by_radius(sensor, lat, lng, radius)
-            logger.info(f"Filtered by radius {radius}km from ({lat}, {lng})")
-        
-        total_points = len(crowd) + len(sensor)
-        
-        # Severity counts
-        severe_count = len([r for r in crowd if r.get('risklevel') == 'Severe'])
-        severe_count += len([r for r in sensor if r.get('severity') == 'Severe'])
-        
-        high_count = len([r for r in crowd if r.get('risklevel') == 'High'])
-        high_count += len([r for r in sensor if r.get('severity') == 'High'])
-        
-        medium_count = len([r for r in crowd if r.get('risklevel') in ['Moderate', 'Medium']])
-        medium_count += len([r for r in sensor if r.get('severity') in ['Moderate', 'Medium']])
-        
-        low_count = total_points - severe_count - high_count - medium_count
-        
-        # Average water level
-        all_water_levels = []
-        all_water_levels.extend([r.get('waterlevel', 0) for r in crowd if r.get('waterlevel')])
-        all_water_levels.extend([r.get('waterlevel', 0) for r in sensor if r.get('waterlevel')])
-        avg_water_level = sum(all_water_levels) / len(all_water_levels) if all_water_levels else 0
-        
-        return {
-            "total": total_points,
-            "severe": severe_count,
-            "high": high_count,
-            "medium": medium_count,
-            "low": low_count,
-            "avgWaterLevel": round(avg_water_level, 2),
-            "sensorCount": len(sensor),
-            "communityCount": len(crowd),
-            "lastUpdated": now_iso(),
-            "filter": {
-                "lat": lat,
-                "lng": lng,
-                "radius_km": radius
-            } if radius else None
-        }
+        if source == "db":
+            if lat is None or lng is None or radius is None:
+                raise HTTPException(400, "source=db requires lat, lng and radius")
+            crowd, sensor = await query_within(lat, lng, radius, DB_GEO_MAX_ROWS)
+            stats = build_dashboard_stats(crowd, sensor, lat, lng, radius)
+            stats["lastUpdated"] = now_iso()
+            return payload_response(request, Payload(payloads.dumps(stats)))
+        
+        await refresh_crowd_state()
+        await refresh_sensor_state()
+        
+        payload = snapshot_payloads.get_or_build(
+            ("stats", lat, lng, radius),
+            (crowd_state.version, sensor_state.version),
+            lambda: build_dashboard_stats(*radius_snapshots(lat, lng, radius), lat, lng, radius)
+        )
+        return payload_response(request, payload)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Dashboard stats error: {str(e)}")
         raise HTTPException(500, "Failed to get dashboard stats")
 
+def build_district_summary(sensor_data: List[Dict], crowd_data: List[Dict] = ()) -> Dict[str, Any]:
+    """
+    Aggregate sensor readings per district, most flooded first.
+    Crowd reports được đếm theo district của zone chứa report (gán sẵn qua zone lookup).
+    """
+    districts = {}
+    
+    def district_entry(district: str) -> Dict[str, Any]:
+        if district not in districts:
+            districts[district] = {
+                'district': district,
+                'total': 0,
+                'severe': 0,
+                'high': 0,
+                'avgWaterLevel': 0,
+                'crowdReports': 0,
+                'waterLevels': []
+            }
+        return districts[district]
+    
+    for record in crowd_data:
+        if record.get('zoneid'):
+            district_entry(record.get('district', 'Unknown'))['crowdReports'] += 1
+    
+    for record in sensor_data:
+        district = record.get('district', 'Unknown')
+        district_entry(district)
+        
+        districts[district]['total'] += 1
+        severity = record.get('severity', 'Low')
+        if severity == 'Severe':
+            districts[district]['severe'] += 1
+        elif severity == 'High':
+            districts[district]['high'] += 1
+        
+        water_level = record.get('waterlevel', 0)
+        if water_level:
+            districts[district]['waterLevels'].append(water_level)
+    
+    result = []
+    for district_name, data in districts.items():
+        if data['waterLevels']:
+            data['avgWaterLevel'] = round(sum(data['waterLevels']) / len(data['waterLevels']), 2)
+        del data['waterLevels']
+        result.append(data)
+    
+    result.sort(key=lambda x: (x['severe'], x['high'], x['total']), reverse=True)
+    
+    return {"districts": result, "timestamp": snapshot_timestamp(crowd_state, sensor_state)}
+
 @app.get("/api/dashboard/districts", tags=["Dashboard"], summary="Thống kê theo quận/huyện")
-async def get_district_summary():
+async def get_district_summary(request: Request):
     """
     📊 **Tổng hợp tình trạng ngập theo quận/huyện**
     
@@ -794,46 +868,21 @@ async def get_district_summary():
     - Số điểm ngập
     - Số điểm Severe/High
     - Mức nước trung bình
+    - Số crowd report nằm trong các flood zone của quận (`crowdReports`)
     
     Sắp xếp theo mức độ nghiêm trọng (quận ngập nặng nhất trước).
+    Hỗ trợ `If-None-Match` (ETag) → 304 nếu dữ liệu chưa thay đổi.
     """
     try:
-        sensor_data = cached_get_snapshot_sensor(1000)
-        
-        districts = {}
-        for record in sensor_data:
-            district = record.get('district', 'Unknown')
-            if district not in districts:
-                districts[district] = {
-                    'district': district,
-                    'total': 0,
-                    'severe': 0,
-                    'high': 0,
-                    'avgWaterLevel': 0,
-                    'waterLevels': []
-                }
-            
-            districts[district]['total'] += 1
-            severity = record.get('severity', 'Low')
-            if severity == 'Severe':
-                districts[district]['severe'] += 1
-            elif severity == 'High':
-                districts[district]['high'] += 1
-            
-            water_level = record.get('waterlevel', 0)
-            if water_level:
-                districts[district]['waterLevels'].append(water_level)
+        await refresh_crowd_state()
+        await refresh_sensor_state()
         
-        result = []
-        for district_name, data in districts.items():
-            if data['waterLevels']:
-                data['avgWaterLevel'] = round(sum(data['waterLevels']) / len(data['waterLevels']), 2)
-            del data['waterLevels']
-            result.append(data)
-        
-        result.sort(key=lambda x: (x['severe'], x['high'], x['total']), reverse=True)
-        
-        return {"districts": result, "timestamp": now_iso()}
+        payload = snapshot_payloads.get_or_build(
+            ("districts",),
+            (crowd_state.version, sensor_state.version),
+            lambda: build_district_summary(sensor_state.snapshot(1000), crowd_state.snapshot(1000))
+        )
+        return payload_response(request, payload)
     except Exception as e:
         logger.error(f"District summary error: {str(e)}")
         raise HTTPException(500, "Failed to get district summary")
@@ -844,10 +893,12 @@ async def get_district_summary():
 
 @app.get("/api/flood/nearby", tags=["Flood Data"], summary="Điểm ngập gần vị trí")
 async def get_nearby_floods(
+    request: Request,
     lat: float = Query(..., description="Vĩ độ trung tâm", example=10.762622),
     lng: float = Query(..., description="Kinh độ trung tâm", example=106.660172),
     radius: float = Query(5.0, description="Bán kính tìm kiếm (km)", ge=0.1, le=100),
-    limit: int = Query(100, description="Số kết quả tối đa", ge=1, le=500)
+    limit: int = Query(100, description="Số kết quả tối đa", ge=1, le=500),
+    source: Literal["memory", "db"] = Query("memory", description="memory: snapshot trong memory; db: lọc bán kính trong CrateDB")
 ):
     """
     🌊 **Tìm điểm ngập trong bán kính**
@@ -863,44 +914,143 @@ async def get_nearby_floods(
     - Danh sách crowd reports gần đó
     - Danh sách sensor data gần đó
     - Khoảng cách từ mỗi điểm đến tâm (km)
+    
+    **`source=db`**: CrateDB lọc bằng `distance()` + `ORDER BY distance LIMIT k`,
+    chỉ các điểm khớp được trả về qua mạng (dùng khi số crowd report vượt cap 1000 của snapshot).
     """
     try:
         if not validate_coordinates(lat, lng):
             raise HTTPException(400, "Invalid coordinates for Vietnam")
         
-        crowd = cached_get_snapshot_crowd(1000)
-        sensor = cached_get_snapshot_sensor(1000)
-        
-        # Filter by radius
-        nearby_crowd = filter_by_radius(crowd, lat, lng, radius)[:limit]
-        nearby_sensor = filter_by_radius(sensor, lat, lng, radius)[:limit]
+        if source == "db":
+            nearby_crowd, nearby_sensor = await query_within(lat, lng, radius, limit)
+            return payload_response(request, Payload(payloads.dumps({
+                "center": {"lat": lat, "lng": lng},
+                "radius_km": radius,
+                "crowd_reports": nearby_crowd,
+                "sensor_data": nearby_sensor,
+                "total_crowd": len(nearby_crowd),
+                "total_sensor": len(nearby_sensor),
+                "timestamp": now_iso()
+            })))
+        
+        await refresh_crowd_state()
+        await refresh_sensor_state()
+        
+        def build_nearby() -> Dict[str, Any]:
+            # ✅ Spatial index: top-k gần nhất trong bán kính
+            nearby_crowd, nearby_sensor = radius_snapshots(lat, lng, radius, limit)
+            return {
+                "center": {"lat": lat, "lng": lng},
+                "radius_km": radius,
+                "crowd_reports": nearby_crowd,
+                "sensor_data": nearby_sensor,
+                "total_crowd": len(nearby_crowd),
+                "total_sensor": len(nearby_sensor),
+                "timestamp": snapshot_timestamp(crowd_state, sensor_state)
+            }
         
-        return {
-            "center": {"lat": lat, "lng": lng},
-            "radius_km": radius,
-            "crowd_reports": nearby_crowd,
-            "sensor_data": nearby_sensor,
-            "total_crowd": len(nearby_crowd),
-            "total_sensor": len(nearby_sensor),
-            "timestamp": now_iso()
-        }
+        payload = snapshot_payloads.get_or_build(
+            ("nearby", lat, lng, radius, limit),
+            (crowd_state.version, sensor_state.version),
+            build_nearby
+        )
+        return payload_response(request, payload)
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Nearby floods error: {str(e)}")
         raise HTTPException(500, "Failed to get nearby floods")
 
+# ===========================================================
+# MAP CLUSTERS - TILE ENDPOINT (cluster phía server)
+# ===========================================================
+
+# ✅ NEW: cluster index build một lần mỗi version (crowd, sensor), tối đa một lần
+# mỗi CLUSTER_REBUILD_INTERVAL giây; mỗi zoom tính khi cần
+map_clusters = VersionedClusterIndex()
+
+def cluster_index() -> ClusterIndex:
+    """Cluster index over the full crowd + sensor snapshots (không cap 1000)."""
+    return map_clusters.get(
+        (crowd_state.version, sensor_state.version),
+        lambda: (crowd_state.snapshot(), sensor_state.snapshot())
+    )
+
+@app.get("/api/map/clusters/{z}/{x}/{y}", tags=["Flood Data"], summary="Cluster điểm ngập theo tile")
+async def get_map_clusters(
+    request: Request,
+    z: int = Path(..., description="Zoom", ge=0, le=MAX_ZOOM),
+    x: int = Path(..., description="Tile X", ge=0),
+    y: int = Path(..., description="Tile Y", ge=0)
+):
+    """
+    🗺️ **Cluster điểm ngập cho một tile bản đồ (XYZ / Web Mercator)**
+    
+    Server gom crowd reports + sensors theo zoom, mỗi cluster trả về:
+    - `count`, `crowdCount`, `sensorCount`
+    - `maxSeverity`: mức cao nhất trong cluster
+    - `meanWaterLevel`: mực nước trung bình (m)
+    
+    Điểm đứng riêng (và mọi điểm từ zoom 16 trở lên) nằm trong `points`.
+    Kích thước payload phụ thuộc viewport chứ không phụ thuộc tổng số điểm.
+    """
+    if x >= 1 << z or y >= 1 << z:
+        raise HTTPException(400, f"Tile {z}/{x}/{y} out of range")
+    try:
+        await refresh_crowd_state()
+        await refresh_sensor_state()
+        
+        index = cluster_index()
+        
+        def build_tile() -> Dict[str, Any]:
+            tile = index.tile(z, x, y)
+            return {
+                "z": z,
+                "x": x,
+                "y": y,
+                "clusters": tile["clusters"],
+                "points": tile["points"],
+                "total_clusters": len(tile["clusters"]),
+                "total_points": len(tile["points"]),
+                "timestamp": snapshot_timestamp(crowd_state, sensor_state)
+            }
+        
+        # Key theo version của index đang phục vụ (có thể cũ hơn store khi rebuild bị hoãn)
+        payload = snapshot_payloads.get_or_build(("clusters", z, x, y), map_clusters.version, build_tile)
+        return payload_response(request, payload)
+    except Exception as e:
+        logger.error(f"Map clusters error: {str(e)}")
+        raise HTTPException(500, "Failed to get map clusters")
+
 # ===========================================================
 # WEBSOCKET HANDLER - OPTIMIZED
 # ===========================================================
 
+async def refresh_map_state():
+    """Refresh both stores before a broadcast tick (SWR: tối đa một query / TTL)."""
+    await refresh_crowd_state()
+    await refresh_sensor_state()
+
+# ✅ NEW: một broadcaster cho mọi client thay vì mỗi client tự poll
+map_hub = MapHub({"crowd": crowd_state, "sensor": sensor_state}, refresh=refresh_map_state)
+
 @app.websocket("/ws/map")
 async def websocket_map(ws: WebSocket):
-    """Optimized WebSocket for real-time map updates."""
+    """
+    Real-time map updates.
+
+    `init` → snapshot của vùng subscribe (bbox hoặc bán kính, không có = toàn
+    thành phố), sau đó server tự push `update` từ `map_hub`, chỉ gồm bản ghi
+    trong vùng. `move` đổi vùng và gửi snapshot của vùng mới.
+    `init` kèm `resume_from` + `epoch` → chỉ replay các update bị lỡ nếu còn
+    trong ring buffer, ngược lại gửi snapshot như bình thường.
+    `init` kèm `protocol: "msgpack"` → frame binary MessagePack (field dictionary
+    + delta theo record, xem `ws_codec`); lỗi luôn là JSON text.
+    `poll` được giữ cho client cũ nhưng không còn làm gì.
+    """
     await ws.accept()
-    
-    last_crowd_ts = None
-    last_sensor_ts = None
+    subscriber = map_hub.connect(ws)
     
     try:
         while True:
@@ -908,167 +1058,345 @@ async def websocket_map(ws: WebSocket):
             data = json.loads(msg)
             msg_type = data.get("type")
             
-            # STEP 1 — INITIAL SNAPSHOT
-            if msg_type == "init":
-                logger.info("WebSocket: Sending initial snapshot")
+            # STEP 1 — SNAPSHOT OF THE SUBSCRIBED REGION (init / move)
+            if msg_type in ("init", "move"):
+                try:
+                    region = Region.from_message(data)
+                except ValueError as e:
+                    subscriber.send(payloads.dumps({"type": "error", "message": str(e)}).decode("utf-8"))
+                    continue
                 
-                # Get radius filter from client if provided
-                radius = data.get("radius")
-                center_lat = data.get("lat")
-                center_lng = data.get("lng")
+                # ✅ Protocol negotiation (một lần mỗi connection)
+                protocol = data.get("protocol", PROTOCOL_JSON)
+                if msg_type == "init" and protocol != PROTOCOL_JSON and subscriber.encoder is None:
+                    if protocol == PROTOCOL_MSGPACK and PROTOCOL_MSGPACK in available_protocols():
+                        subscriber.encoder = MsgpackEncoder(
+                            {name: store.key_of for name, store in map_hub.streams.items()}
+                        )
+                        subscriber.send(subscriber.encoder.schema())
+                    else:
+                        subscriber.send(payloads.dumps({
+                            "type": "error",
+                            "message": f"Unsupported protocol '{protocol}', using json",
+                            "protocols": available_protocols()
+                        }).decode("utf-8"))
                 
-                crowd = cached_get_snapshot_crowd()
-                sensor = cached_get_snapshot_sensor()
+                # ✅ Reconnect: replay delta từ ring buffer thay vì snapshot đầy đủ
+                if msg_type == "init" and data.get("resume_from") is not None:
+                    replayed = map_hub.resume(subscriber, data["resume_from"], data.get("epoch"), region)
+                    if replayed is not None:
+                        logger.info(f"WebSocket resumed from seq {data['resume_from']}: {replayed} updates replayed")
+                        continue
                 
-                # Apply radius filter if provided
-                if radius and center_lat and center_lng:
-                    crowd = filter_by_radius(crowd, center_lat, center_lng, radius)
-                    sensor = filter_by_radius(sensor, center_lat, center_lng, radius)
-                    logger.info(f"WebSocket: Applied radius filter {radius}km")
+                logger.info(f"WebSocket {msg_type}: sending snapshot for {region or 'all'}")
                 
-                # Track timestamps
-                if crowd:
-                    last_crowd_ts = crowd[0].get("calculatedat")
-                if sensor:
-                    last_sensor_ts = sensor[0].get("updatedat")
+                await refresh_map_state()
                 
-                await ws.send_text(json.dumps({
-                    "type": "snapshot",
-                    "crowd": crowd,
-                    "sensor": sensor,
-                    "timestamp": now_iso()
-                }, default=str))
+                def build_snapshot() -> Dict[str, Any]:
+                    crowd, sensor = region_snapshots(region)
+                    return {
+                        "type": "snapshot",
+                        "crowd": crowd,
+                        "sensor": sensor,
+                        "seq": map_hub.seq,
+                        "epoch": map_hub.epoch,
+                        "timestamp": snapshot_timestamp(crowd_state, sensor_state)
+                    }
                 
-                logger.info(f"Snapshot sent: {len(crowd)} crowd + {len(sensor)} sensor")
-                continue
-            
-            # STEP 2 — POLLING FOR UPDATES
-            if msg_type == "poll":
-                updates = {"type": "update", "crowd": [], "sensor": [], "timestamp": now_iso()}
-                
-                if last_crowd_ts:
-                    new_crowd = get_crowd_after(last_crowd_ts)
-                    if new_crowd:
-                        last_crowd_ts = new_crowd[0].get("calculatedat")
-                        updates["crowd"] = new_crowd
+                # Từ đây không await: snapshot vào queue trước mọi update của hub
+                versions = {"crowd": crowd_state.version, "sensor": sensor_state.version}
+                map_hub.start(subscriber, versions, region)
+                if subscriber.encoder is not None:
+                    # Binary: encode riêng cho connection (seed trạng thái delta)
+                    crowd, sensor = region_snapshots(region)
+                    subscriber.send_records(
+                        "snapshot", {"crowd": crowd, "sensor": sensor},
+                        seq=map_hub.seq,
+                        epoch=map_hub.epoch,
+                        timestamp=snapshot_timestamp(crowd_state, sensor_state)
+                    )
+                    logger.info(f"Binary snapshot queued: {len(crowd)} crowd / {len(sensor)} sensor")
+                    continue
                 
-                if last_sensor_ts:
-                    new_sensor = get_sensor_after(last_sensor_ts)
-                    if new_sensor:
-                        last_sensor_ts = new_sensor[0].get("updatedat")
-                        updates["sensor"] = new_sensor
+                # ✅ Cùng version + cùng filter → gửi lại bytes đã serialize
+                payload = snapshot_payloads.get_or_build(
+                    ("ws_snapshot", region),
+                    (versions["crowd"], versions["sensor"], map_hub.seq),
+                    build_snapshot
+                )
+                subscriber.send(payload.text)
                 
-                if updates["crowd"] or updates["sensor"]:
-                    await ws.send_text(json.dumps(updates, default=str))
+                logger.info(f"Snapshot queued: {len(payload.body)} bytes (v{versions['crowd']}/{versions['sensor']})")
+                continue
+            
+            # STEP 2 — POLL: no-op, update được push bởi map_hub
     
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected normally")
     except Exception as e:
         logger.error(f"WebSocket error: {str(e)}", exc_info=True)
     finally:
+        await map_hub.disconnect(subscriber)
         try:
             await ws.close()
         except:
             pass
 
 # ======================================================
-# RETRY MECHANISM for Orion-LD
+# ORION-LD CLIENT - OPTIMIZED
 # ======================================================
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
-    retry=retry_if_exception_type(requests.exceptions.RequestException)
-)
-def send_to_orion(entity: dict) -> requests.Response:
-    """Send entity to Orion-LD with retry mechanism."""
-    headers = {"Content-Type": "application/ld+json"}
-    response = requests.post(ORION_LD_URL, json=entity, headers=headers, timeout=10)
-    response.raise_for_status()
-    return response
+async def upsert_to_orion(entities: List[dict]) -> Dict[str, Any]:
+    """
+    Write derived entities to Orion-LD in batches (/entityOperations/upsert).
+
+    ✅ OPTIMIZED: httpx async dùng chung (keep-alive pool), retry có jitter +
+    retry budget, circuit breaker → Orion-LD chậm/lỗi không chặn event loop.
+    ✅ NEW: một request cho tối đa ORION_BATCH_SIZE entity thay vì một POST mỗi entity.
+    """
+    return await get_orion().upsert_entities(entities)
+
+IngestItem = Tuple[str, Dict[str, Any], Optional[Dict[str, Any]], Optional[Tuple[str, str]]]
+
+async def flush_ingest(batch: List[IngestItem]):
+    """
+    Write one micro-batch from `ingest_queue`: một batch upsert Orion-LD, rồi
+    áp dụng các entity được chấp nhận vào read model + push WebSocket.
+
+    Item = (stream, entity, record, dedup key). Entity bị Orion-LD từ chối →
+    bỏ đánh dấu dedup để lần gửi lại (đã sửa) vẫn được xử lý.
+
+    Một lô upsert lỗi giữa chừng: các lô trước đó vẫn được áp dụng, chỉ item
+    của lô lỗi (và các lô chưa gửi) được thử lại / bỏ.
+
+    Raises:
+        PartialFlush: Orion-LD lỗi tạm thời → queue thử lại các item chưa ghi
+    """
+    # Id cố định: cùng entity nhiều lần trong batch → chỉ gửi bản mới nhất
+    entities = {entity["id"]: entity for _, entity, _, _ in batch}
+    failure: Optional[OrionError] = None
+    try:
+        result = await upsert_to_orion(list(entities.values()))
+    except OrionError as e:
+        failure = e
+        result = e.partial or {"success": [], "errors": []}
+    for error in result["errors"]:
+        logger.warning(f"Orion-LD rejected {error.get('entityId')}: {error.get('error')}")
+    accepted = set(result["success"])
+    answered = accepted | {error.get("entityId") for error in result["errors"]}
+    unsent = [item for item in batch if failure is not None and item[1]["id"] not in answered]
+    if failure is not None and not isinstance(failure, OrionUnavailable):
+        # 4xx cho cả lô: gửi lại cũng không khác → bỏ
+        logger.error(f"Orion-LD rejected ingest batch of {len(unsent)}: {failure}")
+        unsent = []
+    pending = {id(item) for item in unsent}
+    ingest_dedup.release(item[3] for item in batch if item[1]["id"] not in accepted and id(item) not in pending)
+    stores = {"sensor": sensor_state, "crowd": crowd_state}
+    updates: Dict[str, List[Dict[str, Any]]] = {name: [] for name in stores}
+    for stream, entity, record, _ in batch:
+        if entity["id"] in accepted and record is not None:
+            # ✅ Write-through: áp dụng entity vừa ghi như một delta (không clear cache)
+            stores[stream].upsert(record)
+            updates[stream].append(record)
+    # ✅ NEW: push ngay + chia sẻ với hub của các worker khác (Redis pub/sub)
+    for stream, records in updates.items():
+        if records:
+            # Row CrateDB trong cache đã cũ → xóa L1 + L2 trên mọi worker (pub/sub)
+            await snapshot_rows_cache.invalidate(stream)
+        await map_hub.publish(stream, records)
+    logger.info(f"[Ingest] Upserted {len(accepted)}/{len(entities)} entities ({len(batch)} queued)")
+    if unsent:
+        raise PartialFlush(unsent, failure)
+
+def release_dropped_ingest(items: List[IngestItem]):
+    """Item bị bỏ sau `max_attempts` lần ghi lỗi → lần Orion-LD gửi lại không bị coi là trùng."""
+    ingest_dedup.release(key for _, _, _, key in items)
+
+# ✅ NEW: write-behind - route trả 202 ngay, worker nền gom micro-batch ghi Orion-LD
+ingest_queue = IngestQueue(flush_ingest, on_drop=release_dropped_ingest)
+# ✅ NEW: chống trùng - Orion-LD gửi lại khi timeout, subscription chồng nhau
+ingest_dedup = DedupWindow()
+
+def enqueue_ingest(items: List[IngestItem]):
+    """Queue derived entities for the write-behind worker (503 khi queue đầy)."""
+    if not ingest_queue.offer(items):
+        # Chưa nhận → bỏ đánh dấu để lần gửi lại không bị coi là trùng
+        ingest_dedup.release(key for _, _, _, key in items)
+        raise HTTPException(503, "Ingest queue is full", headers={"Retry-After": "1"})
+
+def notification_key(entity: Dict[str, Any], observed_at: Any = None) -> Optional[Tuple[str, str]]:
+    """
+    Dedup key (source id, version) of a notified entity.
+
+    Version = `modifiedAt` (sysAttrs) nếu có, không thì thời điểm quan sát
+    của nguồn. None nếu không xác định được → luôn xử lý.
+    """
+    source_id = entity.get("id")
+    version = entity.get("modifiedAt") or observed_at
+    return (source_id, str(version)) if source_id and version else None
+
+# Attribute backend tự ghi lại vào entity nguồn (không ảnh hưởng điểm)
+DERIVED_SOURCE_ATTRIBUTES = frozenset({"photoDerivatives"})
+
+def derived_only_update(entity: Dict[str, Any]) -> bool:
+    """
+    True nếu lần sửa gần nhất của entity chỉ là attribute backend tự ghi
+    (vd. `photoDerivatives` sau khi resize ảnh) → không tính điểm lại.
+
+    So `modifiedAt` (sysAttrs) của attribute; tên attribute có thể đã expand
+    thành URI (".../default-context/photoDerivatives").
+    """
+    derived, source = [], []
+    for name, attr in entity.items():
+        if isinstance(attr, dict) and attr.get("modifiedAt"):
+            is_derived = name.rsplit("/", 1)[-1] in DERIVED_SOURCE_ATTRIBUTES
+            (derived if is_derived else source).append(str(attr["modifiedAt"]))
+    return bool(derived) and bool(source) and max(derived) > max(source)
+
+def notification_entities(raw: Any) -> List[Dict[str, Any]]:
+    """Entities of an NGSI-LD notification (`data[]`), hoặc chính body nếu gửi raw."""
+    if isinstance(raw, dict) and isinstance(raw.get("data"), list):
+        return [e for e in raw["data"] if isinstance(e, dict)]
+    return [raw] if isinstance(raw, dict) else []
 
 # ======================================================
 # SENSOR ROUTE → FloodRiskSensor - FIXED
 # ======================================================
 
-@app.post("/flood/sensor")
+def build_flood_sensor(data: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Score one water level observation.
+
+    Returns:
+        (FloodRiskSensor entity cho Orion-LD, reading cho read model `sensor_state`)
+
+    Raises:
+        ValueError: Thiếu waterLevel, location hoặc id
+    """
+    district = data.get("district", {}).get("value")
+    water_level = data.get("waterLevel", {}).get("value")
+    threshold = data.get("alertThreshold", {}).get("value")
+    location = validate_location(data.get("location", {}))
+    source_id = data.get("id")
+    
+    # ✅ NEW: Extract polygon zone fields
+    zone_id = data.get("zoneId", {}).get("value")
+    zone_name = data.get("zoneName", {}).get("value")
+
+    if not all([water_level is not None, location, source_id]):
+        raise ValueError("Missing required fields: waterLevel, location, or id")
+
+    # ✅ FIXED: Dùng hàm compute_flood_severity mới
+    trend = data.get("waterTrend", {}).get("value")
+    severity = compute_flood_severity(water_level, threshold, trend)
+
+    entity = {
+        # ✅ NEW: id cố định theo sensor nguồn → upsert tại chỗ, lịch sử nằm ở QuantumLeap
+        "id": derived_entity_id("FloodRiskSensor", source_id),
+        "type": "FloodRiskSensor",
+        "location": location,
+        "severity": {"type": "Property", "value": severity},
+        "waterLevel": {
+            "type": "Property",
+            "value": water_level,
+            "unitCode": "MTR",
+            "observedAt": data.get("waterLevel", {}).get("observedAt", now_iso()),
+        },
+        "alertThreshold": {"type": "Property", "value": threshold or 1.0, "unitCode": "MTR"},
+        "confidence": {"type": "Property", "value": "High"},
+        "sourceSensor": {"type": "Relationship", "object": source_id},
+        "updatedAt": {"type": "Property", "value": now_iso()},
+        "@context": CONTEXT,
+    }
+    
+    if district:
+        entity["district"] = {"type": "Property", "value": district}
+    
+    # ✅ NEW: Add polygon zone fields if present
+    if zone_id:
+        entity["zoneId"] = {"type": "Property", "value": zone_id}
+    if zone_name:
+        entity["zoneName"] = {"type": "Property", "value": zone_name}
+    if trend:
+        entity["waterTrend"] = {"type": "Property", "value": trend}
+    
+    # Add sensorInstanceId for deduplication (renamed from instanceId to avoid NGSI-LD reserved keyword conflict)
+    entity["sensorInstanceId"] = {"type": "Property", "value": source_id}
+
+    lng, lat = point_coordinates(location)
+    reading = {
+        "entity_id": source_id,
+        "entity_type": data.get("type", "WaterLevelObserved"),
+        "sensorinstanceid": zone_id or source_id,
+        "lng": lng,
+        "lat": lat,
+        "waterlevel": water_level,
+        "severity": severity,
+        "district": district,
+        "watertrend": trend,
+        "zoneid": zone_id,
+        "zonename": zone_name,
+        "updatedat": data.get("waterLevel", {}).get("observedAt") or now_ms(),
+    }
+    return entity, reading
+
+@app.post("/flood/sensor", status_code=status.HTTP_202_ACCEPTED)
 async def process_flood_sensor(request: Request):
     """Process flood sensor data from IoT devices.
     ✅ NEW: Hỗ trợ polygon zones với zoneId, zoneName
+    ✅ NEW: Xử lý mọi entity trong `data[]`, ghi Orion-LD bằng batch upsert
+    ✅ NEW: Trả 202 sau khi validate + enqueue; `ingest_queue` ghi Orion-LD ở nền
     """
     try:
         raw = await request.json()
-        logger.info("Received sensor data")
 
-        if "data" not in raw or len(raw["data"]) == 0:
+        if not isinstance(raw, dict) or not isinstance(raw.get("data"), list) or len(raw["data"]) == 0:
             raise HTTPException(400, "Invalid NGSI-LD notification format: missing data[]")
+        logger.info(f"Received sensor data ({len(raw['data'])} entities)")
+
+        built, keys, skipped, duplicates = [], [], [], []
+        for data in notification_entities(raw):
+            water_level = data.get("waterLevel")
+            key = notification_key(data, water_level.get("observedAt") if isinstance(water_level, dict) else None)
+            # ✅ NEW: lần đo đã nhận → ack, không tính lại / ghi lại Orion-LD
+            if not ingest_dedup.claim(key):
+                duplicates.append(data.get("id"))
+                continue
+            try:
+                built.append(build_flood_sensor(data))
+                keys.append(key)
+            except (ValueError, AttributeError) as e:
+                ingest_dedup.release([key])
+                skipped.append({"id": data.get("id"), "error": str(e) if isinstance(e, ValueError) else "Invalid entity"})
+        if not built and duplicates:
+            return {
+                "status": "duplicate",
+                "entity_id": derived_entity_id("FloodRiskSensor", duplicates[0]),
+                "queued": 0,
+                "entities": [],
+                "skipped": skipped,
+                "duplicates": len(duplicates),
+            }
+        if not built:
+            raise HTTPException(400, skipped[0]["error"] if skipped else "Invalid NGSI-LD notification format: missing data[]")
 
-        data = raw["data"][0]
-        
-        district = data.get("district", {}).get("value")
-        water_level = data.get("waterLevel", {}).get("value")
-        threshold = data.get("alertThreshold", {}).get("value")
-        location = validate_location(data.get("location", {}))
-        source_id = data.get("id")
+        # ✅ Validate + enqueue, trả 202 ngay (không chờ round trip tới Orion-LD)
+        enqueue_ingest([("sensor", entity, reading, key) for (entity, reading), key in zip(built, keys)])
+        processed = [{"entity_id": entity["id"], "severity": entity["severity"]["value"]} for entity, _ in built]
         
-        # ✅ NEW: Extract polygon zone fields
-        zone_id = data.get("zoneId", {}).get("value")
-        zone_name = data.get("zoneName", {}).get("value")
-
-        if not all([water_level is not None, location, source_id]):
-            raise HTTPException(400, "Missing required fields: waterLevel, location, or id")
-
-        # ✅ FIXED: Dùng hàm compute_flood_severity mới
-        trend = data.get("waterTrend", {}).get("value")
-        severity = compute_flood_severity(water_level, threshold, trend)
-
-        entity = {
-            "id": f"urn:ngsi-ld:FloodRiskSensor:{uuid.uuid4()}",
-            "type": "FloodRiskSensor",
-            "location": location,
-            "severity": {"type": "Property", "value": severity},
-            "waterLevel": {
-                "type": "Property",
-                "value": water_level,
-                "unitCode": "MTR",
-                "observedAt": data.get("waterLevel", {}).get("observedAt", now_iso()),
-            },
-            "alertThreshold": {"type": "Property", "value": threshold or 1.0, "unitCode": "MTR"},
-            "confidence": {"type": "Property", "value": "High"},
-            "sourceSensor": {"type": "Relationship", "object": source_id},
-            "updatedAt": {"type": "Property", "value": now_iso()},
-            "@context": CONTEXT,
+        return {
+            "status": "accepted" if not skipped else "partial",
+            # Tương thích client cũ (notification một entity)
+            "entity_id": processed[0]["entity_id"],
+            "severity": processed[0]["severity"],
+            "queued": len(processed),
+            "entities": processed,
+            "skipped": skipped,
+            "duplicates": len(duplicates),
         }
-        
-        if district:
-            entity["district"] = {"type": "Property", "value": district}
-        
-        # ✅ NEW: Add polygon zone fields if present
-        if zone_id:
-            entity["zoneId"] = {"type": "Property", "value": zone_id}
-        if zone_name:
-            entity["zoneName"] = {"type": "Property", "value": zone_name}
-        if trend:
-            entity["waterTrend"] = {"type": "Property", "value": trend}
-        
-        # Add sensorInstanceId for deduplication (renamed from instanceId to avoid NGSI-LD reserved keyword conflict)
-        entity["sensorInstanceId"] = {"type": "Property", "value": source_id}
-
-        # ✅ Send with retry
-        res = send_to_orion(entity)
-
-        logger.info(f"[FloodRiskSensor] Created {entity['id']} | Severity={severity} | WaterLevel={water_level}m")
-        
-        # Clear cache to get fresh data
-        sensor_cache.clear()
-        
-        return {"status": "success", "entity_id": entity["id"], "severity": severity}
 
     except HTTPException:
         raise
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Orion-LD communication error: {e}")
-        raise HTTPException(502, "Cannot communicate with Orion-LD")
     except Exception as e:
         logger.error(f"Sensor processing error: {e}", exc_info=True)
         raise HTTPException(500, "Internal server error")
@@ -1077,130 +1405,189 @@ async def process_flood_sensor(request: Request):
 # CROWD ROUTE → FloodRiskCrowd - FIXED
 # ======================================================
 
-@app.post("/flood/crowd")
-async def process_flood_crowd(request: Request):
-    """Process crowd-sourced flood reports."""
-    try:
-        data = await request.json()
-        logger.info("[CrowdReport] Processing")
+def build_flood_crowd(entity: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """
+    Score one crowd report.
 
-        if "data" in data and isinstance(data["data"], list) and len(data["data"]) > 0:
-            entity = data["data"][0]
+    Returns:
+        (FloodRiskCrowd entity cho Orion-LD, record cho read model `crowd_state`
+        hoặc None nếu tọa độ nằm ngoài Việt Nam)
+
+    Raises:
+        ValueError: Thiếu id, location hoặc waterLevel
+    """
+    source_id = entity.get("id")
+    
+    # Extract address
+    address = None
+    if "address" in entity:
+        if isinstance(entity["address"], dict) and "value" in entity["address"]:
+            address = entity["address"]["value"]
         else:
-            entity = data
-
-        source_id = entity.get("id")
-        
-        # Extract address
-        address = None
-        if "address" in entity:
-            if isinstance(entity["address"], dict) and "value" in entity["address"]:
-                address = entity["address"]["value"]
-            else:
-                address = entity["address"]
-        
-        # Extract water level
-        water_level_obj = entity.get("waterLevel", {})
-        water_level = water_level_obj.get("value") if isinstance(water_level_obj, dict) else None
-        
-        # Extract other fields
-        verified = entity.get("verified", {}).get("value", False) if isinstance(entity.get("verified"), dict) else entity.get("verified", False)
-        description = entity.get("description", {}).get("value", "") if isinstance(entity.get("description"), dict) else entity.get("description", "")
-        photos = entity.get("photos", {}).get("value", []) if isinstance(entity.get("photos"), dict) else entity.get("photos", [])
-        timestamp = entity.get("timestamp", {}).get("value", now_iso()) if isinstance(entity.get("timestamp"), dict) else entity.get("timestamp", now_iso())
-
-        # Validate location
-        location_data = entity.get("location")
-        if isinstance(location_data, dict) and "value" in location_data:
-            location_data = location_data["value"]
-            
-        location = validate_location(location_data)
-        
-        if not location or not source_id or water_level is None:
-            raise HTTPException(400, "Missing required fields: id, location, or waterLevel")
+            address = entity["address"]
+    
+    # Extract water level
+    water_level_obj = entity.get("waterLevel", {})
+    water_level = water_level_obj.get("value") if isinstance(water_level_obj, dict) else None
+    
+    # Extract other fields
+    verified = entity.get("verified", {}).get("value", False) if isinstance(entity.get("verified"), dict) else entity.get("verified", False)
+    description = entity.get("description", {}).get("value", "") if isinstance(entity.get("description"), dict) else entity.get("description", "")
+    photos = entity.get("photos", {}).get("value", []) if isinstance(entity.get("photos"), dict) else entity.get("photos", [])
 
-        # ✅ FIXED: Dùng hàm tính risk score mới
-        risk_score, risk_level, factors = calculate_crowd_risk_score(
-            water_level=water_level,
-            description=description,
-            photos=photos,
-            verified=verified
-        )
+    # Validate location
+    location_data = entity.get("location")
+    if isinstance(location_data, dict) and "value" in location_data:
+        location_data = location_data["value"]
+        
+    location = validate_location(location_data)
+    
+    if not location or not source_id or water_level is None:
+        raise ValueError("Missing required fields: id, location, or waterLevel")
 
-        crowd_confidence = "Verified" if verified else "Likely"
+    # ✅ FIXED: Dùng hàm tính risk score mới
+    risk_score, risk_level, factors = calculate_crowd_risk_score(
+        water_level=water_level,
+        description=description,
+        photos=photos,
+        verified=verified
+    )
 
-        entity_id = f"urn:ngsi-ld:FloodRiskCrowd:{uuid.uuid4()}"
+    crowd_confidence = "Verified" if verified else "Likely"
+
+    # ✅ NEW: Gán report vào flood zone (point-in-polygon)
+    lng, lat = point_coordinates(location)
+    zone = get_zone_lookup().lookup(lat, lng) if validate_coordinates(lat, lng) else None
+
+    # ✅ NEW: id cố định theo report nguồn (notification gửi lại → cùng entity)
+    entity_id = derived_entity_id("FloodRiskCrowd", source_id)
+
+    new_entity = {
+        "id": entity_id,
+        "type": "FloodRiskCrowd",
+        "riskScore": {"type": "Property", "value": risk_score},
+        "riskLevel": {"type": "Property", "value": risk_level},
+        "waterLevel": {"type": "Property", "value": water_level, "unitCode": "MTR"},
+        "crowdConfidence": {"type": "Property", "value": crowd_confidence},
+        "factors": {"type": "Property", "value": factors},
+        **({"address": {"type": "Property", "value": address}} if address else {}),
+        **({
+            "zoneId": {"type": "Property", "value": zone["id"]},
+            "zoneName": {"type": "Property", "value": zone["name"]}
+        } if zone else {}),
+        "sourceReport": {"type": "Relationship", "object": source_id},
+        "location": location,
+        "calculatedAt": {"type": "Property", "value": now_iso()},
+        "@context": CONTEXT
+    }
 
-        new_entity = {
-            "id": entity_id,
-            "type": "FloodRiskCrowd",
-            "riskScore": {"type": "Property", "value": risk_score},
-            "riskLevel": {"type": "Property", "value": risk_level},
-            "waterLevel": {"type": "Property", "value": water_level, "unitCode": "MTR"},
-            "crowdConfidence": {"type": "Property", "value": crowd_confidence},
-            "factors": {"type": "Property", "value": factors},
-            **({"address": {"type": "Property", "value": address}} if address else {}),
-            "sourceReport": {"type": "Relationship", "object": source_id},
-            "location": location,
-            "calculatedAt": {"type": "Property", "value": now_iso()},
-            "@context": CONTEXT
+    # ✅ Write-through: áp dụng entity vừa tính như một delta (không clear cache)
+    report = None
+    if validate_coordinates(lat, lng):
+        report = {
+            "entity_id": entity_id,
+            "entity_type": "FloodRiskCrowd",
+            "lng": lng,
+            "lat": lat,
+            "riskscore": risk_score,
+            "risklevel": risk_level,
+            "waterlevel": water_level,
+            "address": address,
+            "calculatedat": new_entity["calculatedAt"]["value"],
+            **({
+                "zoneid": zone["id"],
+                "zonename": zone["name"],
+                "district": zone["district"]
+            } if zone else {}),
         }
+    return new_entity, report
 
-        # ✅ Send with retry
-        res = send_to_orion(new_entity)
-
-        logger.info(f"[FloodRiskCrowd] Created {entity_id} | Risk={risk_level} | Score={risk_score}")
-
-        # Clear cache
-        snapshot_cache.clear()
+@app.post("/flood/crowd", status_code=status.HTTP_202_ACCEPTED)
+async def process_flood_crowd(request: Request):
+    """Process crowd-sourced flood reports.
+    ✅ NEW: Xử lý mọi entity trong `data[]`, ghi Orion-LD bằng batch upsert
+    ✅ NEW: Trả 202 sau khi validate + enqueue; `ingest_queue` ghi Orion-LD ở nền
+    """
+    try:
+        data = await request.json()
+        entities = notification_entities(data)
+        logger.info(f"[CrowdReport] Processing {len(entities)} entities")
+
+        built, keys, skipped, duplicates = [], [], [], []
+        for entity in entities:
+            reported_at = entity.get("timestamp")
+            key = notification_key(entity, reported_at.get("value") if isinstance(reported_at, dict) else reported_at)
+            # ✅ NEW: report đã nhận (hoặc chỉ vừa được ghi thêm photoDerivatives) → ack,
+            # không tính lại / ghi lại Orion-LD
+            if derived_only_update(entity) or not ingest_dedup.claim(key):
+                duplicates.append(entity.get("id"))
+                continue
+            try:
+                built.append(build_flood_crowd(entity))
+                keys.append(key)
+            except (ValueError, AttributeError) as e:
+                ingest_dedup.release([key])
+                skipped.append({"id": entity.get("id"), "error": str(e) if isinstance(e, ValueError) else "Invalid entity"})
+        if not built and duplicates:
+            return {
+                "status": "duplicate",
+                "entity_id": derived_entity_id("FloodRiskCrowd", duplicates[0]),
+                "queued": 0,
+                "entities": [],
+                "skipped": skipped,
+                "duplicates": len(duplicates),
+            }
+        if not built:
+            raise HTTPException(400, skipped[0]["error"] if skipped else "Missing required fields: id, location, or waterLevel")
+
+        # ✅ Validate + enqueue, trả 202 ngay (không chờ round trip tới Orion-LD)
+        enqueue_ingest([("crowd", new_entity, report, key) for (new_entity, report), key in zip(built, keys)])
+        processed = [{
+            "entity_id": new_entity["id"],
+            "risk_score": new_entity["riskScore"]["value"],
+            "risk_level": new_entity["riskLevel"]["value"],
+            "factors": new_entity["factors"]["value"],
+            "zone_id": new_entity.get("zoneId", {}).get("value"),
+        } for new_entity, _ in built]
 
         return {
-            "status": "success",
-            "entity_id": entity_id,
-            "risk_score": risk_score,
-            "risk_level": risk_level,
-            "factors": factors,
-            "orion_status": res.status_code
+            "status": "accepted" if not skipped else "partial",
+            # Tương thích client cũ (notification một entity)
+            **processed[0],
+            "queued": len(processed),
+            "entities": processed,
+            "skipped": skipped,
+            "duplicates": len(duplicates),
         }
 
     except HTTPException:
         raise
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Orion-LD error: {str(e)}")
-        raise HTTPException(502, "Orion-LD communication error")
     except Exception as e:
         logger.error(f"Crowd processing error: {str(e)}", exc_info=True)
         raise HTTPException(500, "Internal server error")
 
 # ======================================================
-# FILE UPLOAD VALIDATION
+# IMAGE DERIVATIVES - thumbnail/WebP tạo ở nền (process pool)
 # ======================================================
 
-ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+async def record_photo_derivatives(entity_id: str, results: List[Tuple[str, Optional[Dict[str, str]]]]):
+    """Ghi URL ảnh đã resize vào CrowdReport (`photoDerivatives`, thứ tự như `photos`)."""
+    derivatives = [
+        {
+            "original": f"{BASE_URL}/static/uploads/{name}",
+            **{variant: f"{BASE_URL}/static/uploads/{DERIVED_SUBDIR}/{file}" for variant, file in derived.items()},
+        }
+        for name, derived in results if derived
+    ]
+    if not derivatives:
+        return
+    await get_orion().append_attributes(entity_id, {
+        "photoDerivatives": {"type": "Property", "value": derivatives},
+        "@context": ["https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"]
+    })
 
-async def validate_image(file: UploadFile) -> bytes:
-    """Validate uploaded image file."""
-    # Check extension
-    ext = os.path.splitext(file.filename or "")[1].lower()
-    if ext not in ALLOWED_EXTENSIONS:
-        raise HTTPException(400, f"Invalid file type: {ext}. Allowed: {', '.join(ALLOWED_EXTENSIONS)}")
-    
-    # Read and check size
-    content = await file.read()
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(400, f"File too large. Max size: {MAX_FILE_SIZE // (1024*1024)}MB")
-    
-    # Verify it's actually an image
-    try:
-        img = Image.open(io.BytesIO(content))
-        img.verify()
-    except Exception:
-        raise HTTPException(400, "Invalid or corrupted image file")
-    
-    # Reset file pointer
-    await file.seek(0)
-    return content
+# ✅ NEW: /report không chờ resize/encode; PIL chạy trong process con
+image_derivatives = DerivativePipeline(record_photo_derivatives)
 
 # ======================================================
 # REPORT ROUTE - FIXED with validation
@@ -1241,14 +1628,11 @@ async def report(
         if water_level is not None and (water_level < 0 or water_level > 20):
             raise HTTPException(400, "Water level must be between 0 and 20 meters")
         
-        # ✅ Validate images
-        for img in images:
-            await validate_image(img)
-        
-        # Save files
-        image_urls = save_files_local(images, BASE_URL)
+        # ✅ OPTIMIZED: Stream ảnh theo chunk ra file tạm (giới hạn size, hash, verify
+        # trong worker thread) rồi rename atomic - không giữ cả ảnh trong memory
+        image_urls = await store_images(images, BASE_URL)
         
-        entity_id = create_crowd_report_entity(
+        entity_id = await create_crowd_report_entity(
             description=description,
             reporterId=reporterId,
             photo_urls=image_urls,
@@ -1256,6 +1640,8 @@ async def report(
             lng=longitude,
             water_level=water_level
         )
+        # ✅ NEW: thumbnail + WebP (bỏ EXIF) tạo ở nền, URL ghi vào entity khi xong
+        image_derivatives.submit(entity_id, [url.rsplit("/", 1)[-1] for url in image_urls])
         
         return {
             "id": entity_id,
@@ -1265,6 +1651,9 @@ async def report(
         }
     except HTTPException:
         raise
+    except OrionError as e:
+        logger.error(f"Orion-LD error: {str(e)}")
+        raise HTTPException(502, "Orion-LD communication error")
     except Exception as e:
         logger.error(f"Report submission error: {str(e)}", exc_info=True)
         raise HTTPException(500, "Failed to submit report")
@@ -1293,7 +1682,7 @@ async def get_recent_reports(
     Sắp xếp theo thời gian (mới nhất trước).
     """
     try:
-        records = execute_query(f"""
+        records = await execute_query(f"""
             SELECT 
                 entity_id,
                 entity_type,
@@ -1310,7 +1699,7 @@ async def get_recent_reports(
             AND calculatedat > NOW() - INTERVAL '{hours} hours'
             ORDER BY calculatedat DESC
             LIMIT {limit}
-        """)
+        """, json_fields=("address",))
         
         # Format response
         reports = []
@@ -1345,7 +1734,7 @@ async def get_report_detail(report_id: str):
     ✅ API: Lấy chi tiết một báo cáo cụ thể.
     """
     try:
-        records = execute_query("""
+        records = await execute_query("""
             SELECT 
                 entity_id,
                 entity_type,
@@ -1359,9 +1748,9 @@ async def get_report_detail(report_id: str):
                 crowdconfidence,
                 factors
             FROM doc.etfloodriskcrowd
-            WHERE entity_id = ?
+            WHERE entity_id = $1
             LIMIT 1
-        """, [report_id])
+        """, report_id, json_fields=("factors", "address"))
         
         if not records:
             raise HTTPException(404, "Report not found")
@@ -1558,8 +1947,8 @@ async def chat_endpoint(request: Request, chat_request: ChatRequest):
         # Lấy summary ngập lụt
         flood_data = None
         try:
-            crowd = cached_get_snapshot_crowd(100)
-            sensor = cached_get_snapshot_sensor(100)
+            crowd = await cached_get_snapshot_crowd(100)
+            sensor = await cached_get_snapshot_sensor(100)
             
             severe_count = len([r for r in crowd if r.get('risklevel') == 'Severe'])
             severe_count += len([r for r in sensor if r.get('severity') == 'Severe'])
@@ -1644,8 +2033,8 @@ async def get_flood_risk_analysis():
         weather_data = await get_weather_with_forecast()
         
         # Get flood data
-        crowd = cached_get_snapshot_crowd(100)
-        sensor = cached_get_snapshot_sensor(100)
+        crowd = await cached_get_snapshot_crowd(100)
+        sensor = await cached_get_snapshot_sensor(100)
         
         summary = get_weather_summary(weather_data) if weather_data else {}
         
@@ -1901,7 +2290,7 @@ async def predict_flood():
         tidal_effect = get_tidal_phase()
         
         # Lấy dữ liệu ngập hiện tại
-        sensor_data = cached_get_snapshot_sensor(100)
+        sensor_data = await cached_get_snapshot_sensor(100)
         current_severe = len([r for r in sensor_data if r.get('severity') == 'Severe'])
         current_high = len([r for r in sensor_data if r.get('severity') == 'High'])
         
@@ -1995,6 +2384,7 @@ def root():
             "dashboard_stats": "/api/dashboard/stats",
             "districts": "/api/dashboard/districts",
             "nearby": "/api/flood/nearby",
+            "map_clusters": "/api/map/clusters/{z}/{x}/{y}",
             "report": "/report",
             "recent_reports": "/api/reports/recent",
             "report_detail": "/api/reports/{report_id}",
@@ -2004,12 +2394,13 @@ def root():
             "weather_districts_list": "/api/weather/districts",
             "weather_advice": "/api/weather/advice",
             "chat": "/api/chat",
-            "flood_risk_analysis": "/api/flood/risk-analysis"
+            "flood_risk_analysis": "/api/flood/risk-analysis",
+            "metrics": "/api/metrics"
         }
     }
 
 @app.get("/health", tags=["Health"], summary="Health Check")
-def health_check():
+async def health_check():
     """
     💚 **Kiểm tra trạng thái hệ thống**
     
@@ -2024,19 +2415,15 @@ def health_check():
     """
     try:
         # Test Orion connection
-        orion_ok = False
-        try:
-            # Orion-LD 400 nếu query quá rộng, nên dùng /version để kiểm tra up/down
-            orion_health_url = ORION_LD_URL.split("/ngsi-ld")[0] + "/version"
-            response = requests.get(orion_health_url, timeout=5)
-            orion_ok = response.ok
-        except Exception as e:
-            logger.warning(f"Orion health check failed: {e}")
+        # Orion-LD 400 nếu query quá rộng, nên dùng /version để kiểm tra up/down
+        orion_ok = await get_orion().ping()
+        if not orion_ok:
+            logger.warning("Orion health check failed")
         
         # Test CrateDB connection
         cratedb_ok = False
         try:
-            test_result = execute_query("SELECT 1 as test")
+            test_result = await execute_query("SELECT 1 as test", timeout=2)
             cratedb_ok = len(test_result) > 0
         except:
             pass
@@ -2058,6 +2445,34 @@ def health_check():
             "timestamp": now_iso()
         }
 
+@app.get("/api/metrics", tags=["Health"], summary="Cache & pool metrics")
+async def get_metrics():
+    """
+    📈 **Số liệu vận hành**
+
+    - `caches`: hit/miss, số lần refresh và tuổi dữ liệu (giây) của từng cache
+    - `stores`: version và số bản ghi của snapshot stores
+    - `cratedb`: trạng thái connection pool
+    - `websocket`: số kết nối /ws/map và số lần broadcast
+    """
+    return {
+        "caches": {
+            snapshot_refresh.name: snapshot_refresh.stats(),
+            **tiered_stats(),
+            "payloads": snapshot_payloads.stats()
+        },
+        "stores": {
+            "sensor": {"records": len(sensor_state), "version": sensor_state.version},
+            "crowd": {"records": len(crowd_state), "version": crowd_state.version}
+        },
+        "cratedb": cratedb.pool_stats(),
+        "websocket": map_hub.stats(),
+        "orion": get_orion().stats(),
+        "ingest": {**ingest_queue.stats(), "dedup": ingest_dedup.stats()},
+        "image_derivatives": image_derivatives.stats(),
+        "timestamp": now_iso()
+    }
+
 # ======================================================
 # STARTUP/SHUTDOWN EVENTS
 # ======================================================
@@ -2068,17 +2483,30 @@ async def startup_event():
     logger.info("=" * 60)
     logger.info("FloodWatch Backend v3.0.0 Starting...")
     logger.info(f"Orion-LD: {ORION_LD_URL}")
-    logger.info(f"CrateDB: {CRATEDB_HTTP_URL}")
+    logger.info(f"CrateDB: {CRATEDB_DSN} (asyncpg pool)")
     logger.info("Features: TTL Cache, Connection Pool, Retry, Radius Filter")
     logger.info("=" * 60)
+    
+    # Warm up CrateDB pool (không fail startup nếu DB chưa sẵn sàng)
+    try:
+        await cratedb.get_pool()
+    except cratedb.CrateDBUnavailable as e:
+        logger.warning(f"CrateDB not ready at startup: {e}")
+
+    # Nhận invalidation cache từ các worker khác (Redis pub/sub)
+    await start_invalidation_listener()
+    # Nhận ingest event của các worker khác → push cho WebSocket client của worker này
+    await map_hub.listen()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown."""
-    global _connection_pool
-    if _connection_pool:
-        try:
-            _connection_pool.close()
-        except:
-            pass
+    # Ghi nốt các entity còn trong queue trước khi đóng Orion client
+    await ingest_queue.close()
+    # Tạo nốt ảnh đang chờ (cần Orion client để ghi URL)
+    await image_derivatives.close()
+    await map_hub.close()
+    await close_orion()
+    await cratedb.close_pool()
+    await close_backend()
     logger.info("FloodWatch Backend shutdown complete")
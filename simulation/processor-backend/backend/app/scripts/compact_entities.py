@@ -0,0 +1,114 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - One-off Orion-LD compaction
+# Gộp các FloodRiskSensor / FloodRiskCrowd cũ (một entity UUID mỗi notification)
+# về một entity id cố định cho mỗi sensor / report nguồn
+#
+# Chạy (trong thư mục backend):
+#     python -m app.scripts.compact_entities --dry-run
+#     python -m app.scripts.compact_entities
+# ======================================================
+
+import argparse
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..services.orion_client import derived_entity_id, get_orion, close_orion
+from ..services.read_models import to_epoch_ms
+
+logger = logging.getLogger(__name__)
+
+CONTEXT = "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context-v1.6.jsonld"
+
+# entity type → (relationship trỏ tới entity nguồn, property thời điểm tính)
+DERIVED_TYPES = {
+    "FloodRiskSensor": ("sourceSensor", "updatedAt"),
+    "FloodRiskCrowd": ("sourceReport", "calculatedAt"),
+}
+
+
+def _value(entity: Dict[str, Any], attr: str) -> Any:
+    value = entity.get(attr)
+    if isinstance(value, dict):
+        return value.get("object", value.get("value"))
+    return value
+
+
+def plan_compaction(
+    entity_type: str,
+    entities: List[Dict[str, Any]]
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Group entities by source, keep the latest per source under its stable id.
+
+    Returns:
+        (entity cần upsert với id cố định, id cần xóa). Entity không có
+        relationship nguồn được giữ nguyên.
+    """
+    source_attr, time_attr = DERIVED_TYPES[entity_type]
+    latest: Dict[str, Dict[str, Any]] = {}
+    ids: Dict[str, List[str]] = {}
+    for entity in entities:
+        source = _value(entity, source_attr)
+        if not source:
+            continue
+        ids.setdefault(source, []).append(entity["id"])
+        current = latest.get(source)
+        if current is None or (to_epoch_ms(_value(entity, time_attr)) or 0) > (to_epoch_ms(_value(current, time_attr)) or 0):
+            latest[source] = entity
+
+    upserts, deletes = [], []
+    for source, entity in latest.items():
+        stable_id = derived_entity_id(entity_type, source)
+        if entity["id"] != stable_id:
+            upserts.append({**entity, "id": stable_id, "@context": entity.get("@context", CONTEXT)})
+        deletes.extend(entity_id for entity_id in ids[source] if entity_id != stable_id)
+    return upserts, deletes
+
+
+async def compact(entity_types: Optional[List[str]] = None, dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+    """Compact each derived entity type in Orion-LD. Returns counts per type."""
+    orion = get_orion()
+    summary = {}
+    try:
+        for entity_type in entity_types or list(DERIVED_TYPES):
+            entities = await orion.list_entities(entity_type)
+            upserts, deletes = plan_compaction(entity_type, entities)
+            summary[entity_type] = {"entities": len(entities), "upserted": len(upserts), "deleted": len(deletes)}
+            logger.info(f"{entity_type}: {len(entities)} entities → upsert {len(upserts)}, delete {len(deletes)}")
+            if dry_run:
+                continue
+            # Ghi entity id cố định trước, xóa bản cũ sau: dừng giữa chừng không mất dữ liệu
+            if upserts:
+                result = await orion.upsert_entities(upserts)
+                rejected = {e.get("entityId") for e in result["errors"]}
+                if rejected:
+                    # Không ghi được id cố định → giữ các bản cũ của source đó
+                    source_attr = DERIVED_TYPES[entity_type][0]
+                    kept = {_value(e, source_attr) for e in upserts if e["id"] in rejected}
+                    source_of = {e["id"]: _value(e, source_attr) for e in entities}
+                    deletes = [entity_id for entity_id in deletes if source_of.get(entity_id) not in kept]
+                    summary[entity_type]["deleted"] = len(deletes)
+                    logger.warning(f"{entity_type}: {len(rejected)} upserts rejected, keeping their duplicates")
+            await orion.delete_entities(deletes)
+    finally:
+        await close_orion()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collapse duplicate derived entities in Orion-LD")
+    parser.add_argument("--type", action="append", choices=list(DERIVED_TYPES), help="Chỉ compact type này")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ in số entity sẽ upsert / xóa")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    summary = asyncio.run(compact(args.type, dry_run=args.dry_run))
+    for entity_type, counts in summary.items():
+        print(f"{entity_type}: {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,462 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Cache Layer
+# Stale-while-revalidate + single-flight (chống thundering herd)
+# Two-level cache: L1 trong process + L2 Redis dùng chung giữa các worker
+# ======================================================
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from cachetools import TTLCache
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis là tùy chọn - không có thì chỉ dùng L1
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[], Awaitable[Any]]
+
+# ======================================================
+# CONFIGURATION
+# ======================================================
+
+# Ví dụ: redis://redis:6379/1 (db 0 dành cho QuantumLeap). Để trống = chỉ cache L1
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX_API", "fw")
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "1"))
+CACHE_INVALIDATION_CHANNEL = f"{REDIS_KEY_PREFIX}:cache:invalidate"
+
+# ======================================================
+# STALE-WHILE-REVALIDATE CACHE
+# ======================================================
+
+class _Entry:
+    __slots__ = ("value", "loaded_at")
+
+    def __init__(self, value: Any, loaded_at: float):
+        self.value = value
+        self.loaded_at = loaded_at
+
+
+class SWRCache:
+    """
+    Async cache with stale-while-revalidate and single-flight refresh.
+
+    - Entry còn mới (age < ttl) → trả ngay (hit)
+    - Entry đã cũ nhưng còn trong `stale_ttl` → trả dữ liệu cũ, refresh chạy nền
+    - Không có entry → chờ load (miss)
+    - Mỗi key chỉ có tối đa một lần load/refresh đang chạy; các request đồng thời
+      dùng chung kết quả thay vì cùng bắn query nặng vào CrateDB
+
+    Args:
+        ttl: Số giây entry được coi là mới
+        stale_ttl: Số giây sau `ttl` vẫn được phục vụ dữ liệu cũ (None = không giới hạn)
+        name: Tên cache (dùng cho log/metrics)
+    """
+
+    def __init__(self, ttl: float, stale_ttl: Optional[float] = None, name: str = "cache"):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.name = name
+        self._entries: Dict[Hashable, _Entry] = {}
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+    def _is_servable(self, age: float) -> bool:
+        return self.stale_ttl is None or age < self.ttl + self.stale_ttl
+
+    async def get(self, key: Hashable, loader: Loader) -> Any:
+        """Return the cached value for `key`, loading it with `loader` when needed."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.loaded_at
+            if age < self.ttl:
+                self._stats["hits"] += 1
+                return entry.value
+            if self._is_servable(age):
+                self._stats["stale_hits"] += 1
+                self._start_refresh(key, loader)
+                return entry.value
+
+        self._stats["misses"] += 1
+        return await asyncio.shield(self._start_refresh(key, loader))
+
+    def _start_refresh(self, key: Hashable, loader: Loader) -> asyncio.Task:
+        """Start (or join) the single in-flight refresh for `key`."""
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get(key)
+        # Task của event loop khác (đã đóng) sẽ không bao giờ hoàn thành → bỏ qua
+        if task is not None and not task.done() and task.get_loop() is loop:
+            return task
+        task = loop.create_task(self._refresh(key, loader))
+        self._inflight[key] = task
+        return task
+
+    async def _refresh(self, key: Hashable, loader: Loader) -> Any:
+        try:
+            value = await loader()
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"[{self.name}] refresh failed for {key!r}: {e}")
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Lỗi khi refresh: tiếp tục phục vụ dữ liệu cũ
+                return entry.value
+            raise
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                self._inflight.pop(key, None)
+        self._entries[key] = _Entry(value, time.monotonic())
+        self._stats["refreshes"] += 1
+        return value
+
+    def invalidate(self, key: Hashable):
+        """Drop one key (next read waits for a fresh load)."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop all entries."""
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and refresh age per key (seconds)."""
+        now = time.monotonic()
+        return {
+            "name": self.name,
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            **self._stats,
+            "inflight": sum(1 for t in self._inflight.values() if not t.done()),
+            "age_seconds": {
+                str(key): round(now - entry.loaded_at, 3)
+                for key, entry in self._entries.items()
+            },
+        }
+
+
+# ======================================================
+# L2 BACKENDS
+# ======================================================
+
+class MemoryBackend:
+    """
+    In-process stand-in for the Redis L2 (dev/test).
+
+    Cùng interface với RedisBackend: key/value có TTL và pub/sub theo channel.
+    Nhiều TieredCache dùng chung một instance mô phỏng nhiều worker dùng chung Redis.
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Any] = {}
+        self._expiry: Dict[str, float] = {}
+        self._subscribers: Dict[str, List[Callable[[str], None]]] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        expires = self._expiry.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._data.pop(key, None)
+            self._expiry.pop(key, None)
+        return self._data.get(key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        self._data[key] = value
+        self._expiry[key] = time.monotonic() + ttl
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._data.pop(key, None)
+            self._expiry.pop(key, None)
+
+    async def delete_prefix(self, prefix: str):
+        await self.delete(*[k for k in self._data if k.startswith(prefix)])
+
+    async def publish(self, channel: str, message: str):
+        for callback in list(self._subscribers.get(channel, [])):
+            callback(message)
+
+    async def subscribe(self, channel: str, callback: Callable[[str], None]):
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    async def close(self):
+        self._subscribers.clear()
+
+
+class RedisBackend:
+    """Redis L2 (redis.asyncio) shared by all API workers."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._client = aioredis.from_url(
+            url,
+            decode_responses=True,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        )
+        self._listeners: List[asyncio.Task] = []
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._client.get(key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        await self._client.set(key, value, px=max(1, int(ttl * 1000)))
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self._client.delete(*keys)
+
+    async def delete_prefix(self, prefix: str):
+        keys = [key async for key in self._client.scan_iter(match=f"{prefix}*", count=500)]
+        await self.delete(*keys)
+
+    async def publish(self, channel: str, message: str):
+        await self._client.publish(channel, message)
+
+    async def subscribe(self, channel: str, callback: Callable[[str], None]):
+        self._listeners.append(asyncio.create_task(self._listen(channel, callback)))
+
+    async def _listen(self, channel: str, callback: Callable[[str], None]):
+        """Subscribe loop, tự kết nối lại khi Redis bị gián đoạn."""
+        # Client riêng không có socket_timeout: subscriber có thể im lặng rất lâu
+        client = aioredis.from_url(self.url, decode_responses=True)
+        while True:
+            pubsub = client.pubsub()
+            try:
+                await pubsub.subscribe(channel)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        callback(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Redis subscription to {channel} lost: {e}")
+                await asyncio.sleep(2)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    async def close(self):
+        for task in self._listeners:
+            task.cancel()
+        self._listeners.clear()
+        await self._client.aclose()
+
+
+_backend: Any = None
+
+
+def get_backend():
+    """Shared L2 backend: Redis nếu có `REDIS_URL`, ngược lại None (chỉ L1)."""
+    global _backend
+    if _backend is None and REDIS_URL:
+        if aioredis is None:
+            logger.warning("REDIS_URL is set but the 'redis' package is not installed - using L1 cache only")
+        else:
+            _backend = RedisBackend(REDIS_URL)
+            logger.info(f"Cache L2: Redis ({REDIS_URL})")
+    return _backend
+
+# ======================================================
+# TWO-LEVEL CACHE
+# ======================================================
+
+_PROCESS_ID = uuid.uuid4().hex
+_registry: Dict[str, "TieredCache"] = {}
+
+
+class TieredCache:
+    """
+    Two-level cache: L1 TTLCache (per process) + optional shared L2 (Redis).
+
+    - Key L2 có version: `{prefix}:{namespace}:v{version}:{key}` → đổi format
+      dữ liệu chỉ cần tăng `version`, worker cũ/mới không đọc nhầm của nhau
+    - `get_or_load()` single-flight trong process; worker khác đọc lại từ L2
+      nên dữ liệu chỉ được tính một lần cho cả cluster (trong TTL)
+    - `invalidate()` xóa L1 + L2 và publish qua pub/sub để các worker khác xóa L1
+      (vd. ingest flush xóa row snapshot của stream vừa ghi)
+    - L2 lỗi → log và tiếp tục chỉ với L1 (không làm hỏng request)
+
+    Giá trị phải serialize được bằng JSON. None/rỗng không được cache
+    (thường là lỗi upstream, lần sau cần thử lại).
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        ttl: float,
+        maxsize: int = 256,
+        version: int = 1,
+        l1_ttl: Optional[float] = None,
+        backend: Any = None
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.version = version
+        # L1 ngắn hơn L2 để invalidation bị lỡ (mất kết nối pub/sub) tự hết hạn
+        self._l1 = TTLCache(maxsize=maxsize, ttl=l1_ttl if l1_ttl is not None else ttl)
+        self._backend = backend
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._pending: set = set()
+        self._stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "loads": 0, "l2_errors": 0}
+        _registry[namespace] = self
+
+    @property
+    def backend(self):
+        return self._backend if self._backend is not None else get_backend()
+
+    def _l2_key(self, key: str) -> str:
+        return f"{REDIS_KEY_PREFIX}:{self.namespace}:v{self.version}:{key}"
+
+    async def get(self, key: str) -> Any:
+        """Read L1, then L2 (populating L1). Returns None on miss."""
+        if key in self._l1:
+            self._stats["l1_hits"] += 1
+            return self._l1[key]
+        backend = self.backend
+        if backend is not None:
+            try:
+                raw = await backend.get(self._l2_key(key))
+            except Exception as e:
+                self._stats["l2_errors"] += 1
+                logger.warning(f"[{self.namespace}] L2 get failed: {e}")
+                raw = None
+            if raw is not None:
+                value = json.loads(raw)
+                self._l1[key] = value
+                self._stats["l2_hits"] += 1
+                return value
+        self._stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Any):
+        """Write through L1 and L2."""
+        if not value:
+            return
+        self._l1[key] = value
+        backend = self.backend
+        if backend is not None:
+            try:
+                await backend.set(self._l2_key(key), json.dumps(value, default=str), self.ttl)
+            except Exception as e:
+                self._stats["l2_errors"] += 1
+                logger.warning(f"[{self.namespace}] L2 set failed: {e}")
+
+    async def get_or_load(self, key: str, loader: Loader) -> Any:
+        """Cached value for `key`, or load it once (per process) and store it."""
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get(key)
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = loop.create_task(self._load(key, loader))
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, loader: Loader) -> Any:
+        try:
+            value = await loader()
+            self._stats["loads"] += 1
+            await self.set(key, value)
+            return value
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                self._inflight.pop(key, None)
+
+    async def invalidate(self, key: Optional[str] = None):
+        """Drop one key (or the whole namespace) on every worker."""
+        self._drop_local(key)
+        backend = self.backend
+        if backend is None:
+            return
+        try:
+            if key is None:
+                await backend.delete_prefix(f"{REDIS_KEY_PREFIX}:{self.namespace}:")
+            else:
+                await backend.delete(self._l2_key(key))
+            await backend.publish(CACHE_INVALIDATION_CHANNEL, json.dumps({
+                "origin": _PROCESS_ID, "namespace": self.namespace, "key": key
+            }))
+        except Exception as e:
+            self._stats["l2_errors"] += 1
+            logger.warning(f"[{self.namespace}] L2 invalidate failed: {e}")
+
+    def clear(self):
+        """
+        Sync variant of `invalidate()` for the whole namespace.
+
+        L1 xóa ngay; L2 + các worker khác được xử lý nền nếu đang trong event loop.
+        """
+        self._drop_local(None)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self.invalidate())
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def _drop_local(self, key: Optional[str]):
+        if key is None:
+            self._l1.clear()
+        else:
+            self._l1.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters per level."""
+        return {
+            "namespace": self.namespace,
+            "ttl": self.ttl,
+            "l2": type(self.backend).__name__ if self.backend is not None else None,
+            "l1_size": len(self._l1),
+            **self._stats,
+        }
+
+
+def handle_invalidation(message: str):
+    """Apply an invalidation published by another worker to the local L1."""
+    try:
+        payload = json.loads(message)
+    except ValueError:
+        return
+    if payload.get("origin") == _PROCESS_ID:
+        return
+    cache = _registry.get(payload.get("namespace"))
+    if cache is not None:
+        cache._drop_local(payload.get("key"))
+
+
+async def start_invalidation_listener(backend: Any = None):
+    """Subscribe to cross-worker invalidations (gọi khi startup)."""
+    backend = backend or get_backend()
+    if backend is None:
+        return
+    try:
+        await backend.subscribe(CACHE_INVALIDATION_CHANNEL, handle_invalidation)
+    except Exception as e:
+        logger.warning(f"Cannot subscribe to cache invalidations: {e}")
+
+
+async def close_backend():
+    """Close the shared L2 backend (gọi khi shutdown)."""
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+        _backend = None
+
+
+def tiered_stats() -> Dict[str, Any]:
+    """Stats for every registered TieredCache."""
+    return {name: cache.stats() for name, cache in _registry.items()}
@@ -0,0 +1,195 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Map Clustering
+# Cluster phân cấp theo zoom (kiểu supercluster) cho tile /api/map/clusters/{z}/{x}/{y}
+# ======================================================
+
+import os
+import math
+import time
+import logging
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Mỗi tile chia 2^CELL_BITS x 2^CELL_BITS ô (8x8 → ô ~32px trên tile 256px)
+CELL_BITS = 3
+# Từ zoom này trở lên trả về từng điểm, không gom cluster
+MAX_CLUSTER_ZOOM = 16
+MAX_ZOOM = 22
+MAX_MERCATOR_LAT = 85.05112878
+
+SEVERITY_RANK = {"Low": 0, "Medium": 1, "Moderate": 1, "High": 2, "Severe": 3}
+SEVERITY_NAMES = ["Low", "Moderate", "High", "Severe"]
+# Version đổi liên tục (ingest dày) → build lại index tối đa một lần mỗi N giây
+CLUSTER_REBUILD_INTERVAL = float(os.getenv("CLUSTER_REBUILD_INTERVAL", "2"))
+
+
+def project(lat: np.ndarray, lng: np.ndarray):
+    """Lat/lng → Web Mercator tọa độ chuẩn hóa [0, 1) (giống tile XYZ)."""
+    lat = np.clip(lat, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)
+    x = (lng + 180.0) / 360.0
+    sin_lat = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return np.clip(x, 0.0, 1.0 - 1e-12), np.clip(y, 0.0, 1.0 - 1e-12)
+
+
+class ClusterIndex:
+    """
+    Hierarchical grid clusters over crowd + sensor records.
+
+    - Chiếu điểm sang Web Mercator một lần khi build
+    - Mỗi zoom z gom điểm theo ô lưới 2^(z+CELL_BITS); ô của zoom z là hợp các ô
+      con của zoom z+1 nên cluster lồng nhau theo cấp (như supercluster)
+    - Aggregate (count, severity cao nhất, mực nước trung bình, tâm) tính bằng
+      NumPy; mỗi zoom chỉ build khi được yêu cầu lần đầu
+    - Payload phụ thuộc viewport (số ô trong tile), không phụ thuộc tổng dữ liệu
+    """
+
+    def __init__(self, crowd: List[Dict[str, Any]], sensor: List[Dict[str, Any]] = ()):
+        located = lambda rows: [r for r in rows if r.get("lat") is not None and r.get("lng") is not None]
+        crowd, sensor = located(crowd), located(sensor)
+        self._records = crowd + sensor
+        self._kinds = ["crowd"] * len(crowd) + ["sensor"] * len(sensor)
+        n = len(self._records)
+        self._lat = np.fromiter((r["lat"] for r in self._records), dtype=np.float64, count=n)
+        self._lng = np.fromiter((r["lng"] for r in self._records), dtype=np.float64, count=n)
+        self._x, self._y = project(self._lat, self._lng)
+        self._severity = np.fromiter(
+            (SEVERITY_RANK.get(r.get("severity") or r.get("risklevel"), 0) for r in self._records),
+            dtype=np.int8, count=n
+        )
+        self._water = np.fromiter(
+            (r["waterlevel"] if isinstance(r.get("waterlevel"), (int, float)) else np.nan for r in self._records),
+            dtype=np.float64, count=n
+        )
+        self._is_sensor = np.arange(n) >= len(crowd)
+        self._levels: Dict[int, Dict[str, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _point(self, i: int) -> Dict[str, Any]:
+        return {**self._records[i], "type": self._kinds[i]}
+
+    def _level(self, zoom: int) -> Dict[str, np.ndarray]:
+        """Aggregates per grid cell at `zoom` (cached)."""
+        level = self._levels.get(zoom)
+        if level is not None:
+            return level
+
+        size = 1 << (zoom + CELL_BITS)
+        cx = np.floor(self._x * size).astype(np.int64)
+        cy = np.floor(self._y * size).astype(np.int64)
+        cells, inverse = np.unique(cx * size + cy, return_inverse=True)
+        m = len(cells)
+
+        count = np.bincount(inverse, minlength=m)
+        has_water = ~np.isnan(self._water)
+        water_n = np.bincount(inverse, weights=has_water, minlength=m)
+        water_sum = np.bincount(inverse, weights=np.where(has_water, self._water, 0.0), minlength=m)
+        max_severity = np.zeros(m, dtype=np.int8)
+        np.maximum.at(max_severity, inverse, self._severity)
+        # Điểm đại diện (điểm đầu tiên) của mỗi ô - dùng khi ô chỉ có một điểm
+        first = np.full(m, len(self._records), dtype=np.int64)
+        np.minimum.at(first, inverse, np.arange(len(self._records)))
+
+        level = {
+            "cx": cells // size,
+            "cy": cells % size,
+            "count": count,
+            "lat": np.bincount(inverse, weights=self._lat, minlength=m) / np.maximum(count, 1),
+            "lng": np.bincount(inverse, weights=self._lng, minlength=m) / np.maximum(count, 1),
+            "water": np.divide(water_sum, water_n, out=np.full(m, np.nan), where=water_n > 0),
+            "severity": max_severity,
+            "sensor": np.bincount(inverse, weights=self._is_sensor, minlength=m).astype(np.int64),
+            "first": first,
+        }
+        self._levels[zoom] = level
+        return level
+
+    def tile(self, z: int, x: int, y: int) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Clusters and single points inside tile z/x/y.
+
+        Returns:
+            {"clusters": [...], "points": [...]} - points là bản copy của record gốc
+            kèm `type` ("crowd" | "sensor")
+        """
+        if not self._records:
+            return {"clusters": [], "points": []}
+
+        if z >= MAX_CLUSTER_ZOOM:
+            # Zoom sâu: trả từng điểm trong tile
+            size = 1 << z
+            mask = (np.floor(self._x * size) == x) & (np.floor(self._y * size) == y)
+            return {"clusters": [], "points": [self._point(i) for i in np.flatnonzero(mask).tolist()]}
+
+        level = self._level(z)
+        mask = ((level["cx"] >> CELL_BITS) == x) & ((level["cy"] >> CELL_BITS) == y)
+        clusters, points = [], []
+        for i in np.flatnonzero(mask).tolist():
+            count = int(level["count"][i])
+            if count == 1:
+                points.append(self._point(int(level["first"][i])))
+                continue
+            water = float(level["water"][i])
+            clusters.append({
+                "lat": round(float(level["lat"][i]), 6),
+                "lng": round(float(level["lng"][i]), 6),
+                "count": count,
+                "sensorCount": int(level["sensor"][i]),
+                "crowdCount": count - int(level["sensor"][i]),
+                "maxSeverity": SEVERITY_NAMES[int(level["severity"][i])],
+                "meanWaterLevel": None if math.isnan(water) else round(water, 3),
+            })
+        return {"clusters": clusters, "points": points}
+
+
+class VersionedClusterIndex:
+    """
+    Holds one ClusterIndex, rebuilt when the snapshot version changes.
+
+    Rebuild bị giới hạn tối đa một lần mỗi `min_interval` giây: khi ingest làm
+    version đổi liên tục, request trong khoảng đó dùng lại index cũ (tile trễ
+    tối đa `min_interval`) thay vì mỗi request build lại toàn bộ index.
+    `version` là version của index đang phục vụ - dùng làm key cache payload.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = CLUSTER_REBUILD_INTERVAL,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.min_interval = min_interval
+        self._clock = clock
+        self._version: Optional[Hashable] = None
+        self._index: Optional[ClusterIndex] = None
+        self._built_at = 0.0
+        self.builds = 0
+        self.deferred = 0
+
+    @property
+    def version(self) -> Optional[Hashable]:
+        return self._version
+
+    def get(
+        self,
+        version: Hashable,
+        records: Callable[[], Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]
+    ) -> ClusterIndex:
+        """Index for `version` (hoặc index cũ nếu vừa build); `records()` → (crowd, sensor), chỉ gọi khi rebuild."""
+        if self._index is not None and self._version != version:
+            if self._clock() - self._built_at < self.min_interval:
+                self.deferred += 1
+                return self._index
+        if self._index is None or self._version != version:
+            self._index = ClusterIndex(*records())
+            self._version = version
+            self._built_at = self._clock()
+            self.builds += 1
+        return self._index
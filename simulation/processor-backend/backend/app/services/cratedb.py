@@ -0,0 +1,226 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Async CrateDB Access Layer
+# asyncpg (PostgreSQL wire protocol) thay cho crate.client đồng bộ
+# ======================================================
+
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# ======================================================
+# CONFIGURATION
+# ======================================================
+
+CRATEDB_DSN = os.getenv("CRATEDB_DSN", "postgresql://crate@cratedb:5432/doc")
+CRATEDB_POOL_MIN_SIZE = int(os.getenv("CRATEDB_POOL_MIN_SIZE", "1"))
+CRATEDB_POOL_MAX_SIZE = int(os.getenv("CRATEDB_POOL_MAX_SIZE", "10"))
+CRATEDB_QUERY_TIMEOUT = float(os.getenv("CRATEDB_QUERY_TIMEOUT", "5"))
+CRATEDB_CONNECT_TIMEOUT = float(os.getenv("CRATEDB_CONNECT_TIMEOUT", "3"))
+# Sau khi tạo pool thất bại, chờ N giây mới thử lại (tránh mỗi request đều chờ connect)
+CRATEDB_RETRY_BACKOFF = float(os.getenv("CRATEDB_RETRY_BACKOFF", "5"))
+
+
+class CrateDBUnavailable(Exception):
+    """Raised when no connection to CrateDB can be obtained."""
+
+
+class CrateConnection(asyncpg.Connection):
+    """
+    asyncpg connection tuned for CrateDB.
+
+    CrateDB không hỗ trợ advisory locks / LISTEN nên bỏ reset query mặc định
+    của asyncpg khi trả connection về pool.
+    """
+
+    def get_reset_query(self) -> str:
+        return ""
+
+# ======================================================
+# ROW DECODING
+# ======================================================
+
+def decode_value(value: Any) -> Any:
+    """
+    Decode a CrateDB value into a JSON-friendly Python type.
+
+    - timestamp → epoch milliseconds (giống định dạng crate HTTP client trả về)
+    - numeric → float
+    """
+    if isinstance(value, datetime):
+        return int(value.timestamp() * 1000)
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+def to_timestamp(value: Any) -> Optional[datetime]:
+    """
+    Convert a cursor value (epoch ms, ISO string or datetime) into an aware datetime.
+
+    asyncpg cần datetime cho tham số kiểu timestamp.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    if isinstance(value, str):
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    raise TypeError(f"Unsupported timestamp value: {value!r}")
+
+def decode_row(record: asyncpg.Record, json_fields: Iterable[str] = ()) -> Dict[str, Any]:
+    """Convert an asyncpg Record into a plain dict with decoded values."""
+    row = {key: decode_value(value) for key, value in record.items()}
+    for field in json_fields:
+        raw = row.get(field)
+        if isinstance(raw, str):
+            try:
+                row[field] = json.loads(raw)
+            except ValueError:
+                pass
+    return row
+
+# ======================================================
+# CONNECTION POOL (bounded, lazy, per event loop)
+# ======================================================
+
+_pool: Optional[asyncpg.Pool] = None
+_pool_loop: Optional[asyncio.AbstractEventLoop] = None
+_pool_lock: Optional[asyncio.Lock] = None
+_retry_at = 0.0
+
+
+def _discard_pool(pool: asyncpg.Pool, loop: Optional[asyncio.AbstractEventLoop]):
+    """
+    Terminate a pool created on another event loop (vd. TestClient tạo loop mới).
+
+    Không `await pool.close()` được từ loop hiện tại → `terminate()` đóng ngay
+    các connection (trên chính loop cũ nếu loop đó vẫn đang chạy).
+    """
+    try:
+        if loop is not None and loop.is_running() and not loop.is_closed():
+            loop.call_soon_threadsafe(pool.terminate)
+        else:
+            pool.terminate()
+    except Exception as e:
+        logger.debug(f"Error terminating stale CrateDB pool: {e}")
+
+
+async def get_pool() -> asyncpg.Pool:
+    """Get or create the bounded connection pool for the running event loop."""
+    global _pool, _pool_loop, _pool_lock, _retry_at
+
+    loop = asyncio.get_running_loop()
+    if _pool is not None and _pool_loop is loop:
+        return _pool
+
+    if _pool_lock is None or _pool_loop is not loop:
+        if _pool is not None:
+            _discard_pool(_pool, _pool_loop)
+        _pool_lock = asyncio.Lock()
+        _pool = None
+        _pool_loop = loop
+
+    async with _pool_lock:
+        if _pool is not None:
+            return _pool
+        if time.monotonic() < _retry_at:
+            raise CrateDBUnavailable("CrateDB pool creation backing off")
+        try:
+            _pool = await asyncpg.create_pool(
+                CRATEDB_DSN,
+                min_size=CRATEDB_POOL_MIN_SIZE,
+                max_size=CRATEDB_POOL_MAX_SIZE,
+                timeout=CRATEDB_CONNECT_TIMEOUT,
+                command_timeout=CRATEDB_QUERY_TIMEOUT,
+                connection_class=CrateConnection,
+            )
+        except Exception as e:
+            _retry_at = time.monotonic() + CRATEDB_RETRY_BACKOFF
+            raise CrateDBUnavailable(f"Cannot connect to CrateDB: {e}") from e
+        logger.info(
+            f"CrateDB pool ready ({CRATEDB_POOL_MIN_SIZE}-{CRATEDB_POOL_MAX_SIZE} connections)"
+        )
+        return _pool
+
+
+async def close_pool():
+    """Close the connection pool (called on shutdown)."""
+    global _pool
+    if _pool is not None:
+        try:
+            await _pool.close()
+        except Exception as e:
+            logger.warning(f"Error closing CrateDB pool: {e}")
+        _pool = None
+
+# ======================================================
+# QUERY API
+# ======================================================
+
+async def fetch(
+    query: str,
+    *args: Any,
+    timeout: Optional[float] = None,
+    json_fields: Iterable[str] = ()
+) -> List[Dict[str, Any]]:
+    """
+    Run a query and return decoded rows.
+
+    Args:
+        query: SQL dùng placeholder `$1, $2, ...`
+        timeout: Timeout (giây) cho riêng query này, mặc định CRATEDB_QUERY_TIMEOUT
+        json_fields: Các cột object trả về dạng JSON string cần parse
+
+    Raises:
+        CrateDBUnavailable: Không lấy được connection
+        asyncio.TimeoutError: Query vượt quá timeout
+    """
+    pool = await get_pool()
+    records = await pool.fetch(
+        query,
+        *args,
+        timeout=timeout if timeout is not None else CRATEDB_QUERY_TIMEOUT
+    )
+    return [decode_row(r, json_fields) for r in records]
+
+
+async def fetchrow(
+    query: str,
+    *args: Any,
+    timeout: Optional[float] = None,
+    json_fields: Iterable[str] = ()
+) -> Optional[Dict[str, Any]]:
+    """Run a query and return the first decoded row (or None)."""
+    pool = await get_pool()
+    record = await pool.fetchrow(
+        query,
+        *args,
+        timeout=timeout if timeout is not None else CRATEDB_QUERY_TIMEOUT
+    )
+    return decode_row(record, json_fields) if record is not None else None
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Pool size/usage for monitoring."""
+    if _pool is None:
+        return {"connected": False, "size": 0, "idle": 0, "max_size": CRATEDB_POOL_MAX_SIZE}
+    return {
+        "connected": True,
+        "size": _pool.get_size(),
+        "idle": _pool.get_idle_size(),
+        "max_size": CRATEDB_POOL_MAX_SIZE,
+    }
@@ -0,0 +1,171 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Spatial Index
+# Grid index + haversine vectorized (NumPy) cho truy vấn bán kính / top-k
+# ======================================================
+
+import math
+import logging
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG_LAT = 111.32
+# 0.01° ≈ 1.1km: ô đủ nhỏ cho bán kính vài km trong nội thành
+DEFAULT_CELL_DEG = 0.01
+
+
+def haversine_km(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """Vectorized haversine distance (km) from one point to arrays of points."""
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def bounding_box(lat: float, lng: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """(south, west, north, east) bao quanh vòng tròn bán kính `radius_km`."""
+    dlat = radius_km / KM_PER_DEG_LAT
+    dlng = radius_km / (KM_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lng - dlng, lat + dlat, lng + dlng
+
+
+class GeoIndex:
+    """
+    Immutable uniform-grid index over records with `lat`/`lng`.
+
+    - Build một lần cho mỗi version snapshot (O(n))
+    - Ứng viên lấy từ các ô grid phủ bounding box của bán kính, khoảng cách
+      tính vectorized bằng NumPy
+    - Top-k dùng `argpartition` (partial selection) thay vì sort toàn bộ
+    - Kết quả luôn là bản copy (kèm `distance_km`), không sửa record trong index
+    """
+
+    def __init__(self, records: List[Dict[str, Any]], cell_deg: float = DEFAULT_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._records = [r for r in records if r.get("lat") is not None and r.get("lng") is not None]
+        self._lats = np.fromiter((r["lat"] for r in self._records), dtype=np.float64, count=len(self._records))
+        self._lngs = np.fromiter((r["lng"] for r in self._records), dtype=np.float64, count=len(self._records))
+
+        cells: Dict[Tuple[int, int], List[int]] = {}
+        if self._records:
+            rows = np.floor(self._lats / cell_deg).astype(np.int64)
+            cols = np.floor(self._lngs / cell_deg).astype(np.int64)
+            for i, cell in enumerate(zip(rows.tolist(), cols.tolist())):
+                cells.setdefault(cell, []).append(i)
+        self._cells = {cell: np.asarray(idx, dtype=np.int64) for cell, idx in cells.items()}
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _candidates(self, lat: float, lng: float, radius_km: float) -> np.ndarray:
+        """Indices of points inside the bounding box of the search circle."""
+        return self._candidates_bbox(*bounding_box(lat, lng, radius_km))
+
+    def _candidates_bbox(self, south: float, west: float, north: float, east: float) -> np.ndarray:
+        """Indices of points in the grid cells covering a bounding box."""
+        row_min, row_max = math.floor(south / self.cell_deg), math.floor(north / self.cell_deg)
+        col_min, col_max = math.floor(west / self.cell_deg), math.floor(east / self.cell_deg)
+
+        n_cells = (row_max - row_min + 1) * (col_max - col_min + 1)
+        if n_cells > len(self._cells):
+            # Bán kính lớn: duyệt các ô có dữ liệu thay vì mọi ô trong bbox
+            hits = [
+                idx for (row, col), idx in self._cells.items()
+                if row_min <= row <= row_max and col_min <= col <= col_max
+            ]
+        else:
+            hits = [
+                self._cells[(row, col)]
+                for row in range(row_min, row_max + 1)
+                for col in range(col_min, col_max + 1)
+                if (row, col) in self._cells
+            ]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(hits)
+
+    def _select(self, idx: np.ndarray, dist: np.ndarray, limit: Optional[int]) -> List[Dict[str, Any]]:
+        if limit is not None and 0 <= limit < len(idx):
+            if limit == 0:
+                return []
+            part = np.argpartition(dist, limit - 1)[:limit]
+            idx, dist = idx[part], dist[part]
+        order = np.argsort(dist, kind="stable")
+        return [
+            {**self._records[i], "distance_km": round(float(d), 2)}
+            for i, d in zip(idx[order].tolist(), dist[order].tolist())
+        ]
+
+    def within(
+        self,
+        lat: float,
+        lng: float,
+        radius_km: float,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Copies of records within `radius_km`, nearest first (at most `limit`)."""
+        if not self._records:
+            return []
+        idx = self._candidates(lat, lng, radius_km)
+        if not len(idx):
+            return []
+        dist = haversine_km(lat, lng, self._lats[idx], self._lngs[idx])
+        mask = dist <= radius_km
+        return self._select(idx[mask], dist[mask], limit)
+
+    def within_bbox(self, south: float, west: float, north: float, east: float) -> List[Dict[str, Any]]:
+        """Copies of records inside a lat/lng bounding box (thứ tự trong index)."""
+        if not self._records:
+            return []
+        idx = self._candidates_bbox(south, west, north, east)
+        if not len(idx):
+            return []
+        lats, lngs = self._lats[idx], self._lngs[idx]
+        idx = np.sort(idx[(lats >= south) & (lats <= north) & (lngs >= west) & (lngs <= east)])
+        return [dict(self._records[i]) for i in idx.tolist()]
+
+    def nearest(self, lat: float, lng: float, k: int) -> List[Dict[str, Any]]:
+        """Copies of the `k` nearest records (không giới hạn bán kính)."""
+        if not self._records:
+            return []
+        idx = np.arange(len(self._records))
+        return self._select(idx, haversine_km(lat, lng, self._lats, self._lngs), k)
+
+
+class VersionedGeoIndex:
+    """Holds one GeoIndex, rebuilt only when the source version changes."""
+
+    def __init__(self, cell_deg: float = DEFAULT_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._version: Optional[Hashable] = None
+        self._index: Optional[GeoIndex] = None
+        self.builds = 0
+
+    def get(self, version: Hashable, records: Callable[[], List[Dict[str, Any]]]) -> GeoIndex:
+        """Index for `version`; `records()` is called only on rebuild."""
+        if self._index is None or self._version != version:
+            self._index = GeoIndex(records(), cell_deg=self.cell_deg)
+            self._version = version
+            self.builds += 1
+        return self._index
+
+
+def filter_by_radius(
+    records: List[Dict[str, Any]],
+    center_lat: float,
+    center_lng: float,
+    radius_km: float,
+    limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    One-off radius filter for an arbitrary list (copies, nearest first).
+
+    Với dữ liệu snapshot nên dùng `VersionedGeoIndex` để không build lại index mỗi request.
+    """
+    return GeoIndex(records).within(center_lat, center_lng, radius_km, limit)
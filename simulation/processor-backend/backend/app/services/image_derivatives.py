@@ -0,0 +1,193 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Image Derivatives
+# Sau upload: thumbnail + ảnh cỡ vừa (WebP/AVIF, bỏ EXIF) tạo trong
+# ProcessPoolExecutor → CPU của PIL không chạy trên API worker, /report không chờ
+# ======================================================
+
+import os
+import asyncio
+import logging
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+# Số process con resize/encode ảnh
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv("IMAGE_DERIVATIVE_WORKERS", "2"))
+# Số report tối đa đang chờ tạo ảnh; đầy → bỏ qua (client vẫn dùng ảnh gốc)
+IMAGE_DERIVATIVE_QUEUE_MAX = int(os.getenv("IMAGE_DERIVATIVE_QUEUE_MAX", "100"))
+# webp hoặc avif (avif cần Pillow có libavif, không có → webp)
+IMAGE_DERIVATIVE_FORMAT = os.getenv("IMAGE_DERIVATIVE_FORMAT", "webp").lower()
+IMAGE_DERIVATIVE_QUALITY = int(os.getenv("IMAGE_DERIVATIVE_QUALITY", "80"))
+# Biến thể → cạnh dài tối đa (px): popup bản đồ / danh sách report dùng thumbnail
+DERIVATIVE_SIZES = {"thumbnail": 320, "medium": 1280}
+# Thư mục con của UPLOAD_DIR, phục vụ tại /static/uploads/derived/...
+DERIVED_SUBDIR = "derived"
+
+
+def resolve_format(fmt: str = IMAGE_DERIVATIVE_FORMAT) -> str:
+    """Định dạng output khả dụng với Pillow đang cài (avif → webp nếu không hỗ trợ)."""
+    if fmt == "avif":
+        from PIL import features
+        with warnings.catch_warnings():
+            # Pillow < 11.2 không biết feature "avif" → warning + False
+            warnings.simplefilter("ignore")
+            if features.check("avif"):
+                return "avif"
+        logger.warning("Pillow has no AVIF support - image derivatives fall back to WebP")
+    return "webp"
+
+
+def render_derivatives(
+    source: str,
+    out_dir: str,
+    sizes: Dict[str, int],
+    fmt: str,
+    quality: int
+) -> Dict[str, str]:
+    """
+    Tạo mọi biến thể của một ảnh (chạy trong process con).
+
+    - Xoay theo EXIF Orientation trước, rồi lưu không kèm EXIF (GPS, thiết bị)
+    - Ghi file tạm (tên riêng cho mỗi lần ghi: hai job cùng ảnh content-addressed
+      không ghi đè file tạm của nhau) rồi rename atomic (không phục vụ file ghi dở)
+
+    Returns:
+        {variant: tên file trong out_dir}
+    """
+    from PIL import Image, ImageOps
+
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(source))[0]
+    names = {}
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        for variant, edge in sizes.items():
+            resized = image.copy()
+            resized.thumbnail((edge, edge), Image.LANCZOS)
+            name = f"{stem}-{variant}.{fmt}"
+            temp_path = os.path.join(out_dir, f".{name}.{uuid4().hex}.part")
+            try:
+                resized.save(temp_path, format=fmt.upper(), quality=quality, exif=b"")
+                os.replace(temp_path, os.path.join(out_dir, name))
+            except BaseException:
+                with suppress(OSError):
+                    os.remove(temp_path)
+                raise
+            names[variant] = name
+    return names
+
+
+DerivativeResult = List[Tuple[str, Optional[Dict[str, str]]]]
+
+
+class DerivativePipeline:
+    """
+    Post-upload job queue backed by a ProcessPoolExecutor.
+
+    - `submit()` đồng bộ, không chờ: mỗi job (một report) là một task nền,
+      mỗi ảnh được resize/encode trong process con
+    - Job xong → `on_complete(job_id, [(ảnh gốc, {variant: file} | None)])`
+      (vd. ghi URL biến thể vào entity CrowdReport)
+    - Process pool tạo lười ở job đầu tiên, context "spawn": fork process đang
+      chạy event loop + thread pool không an toàn
+    """
+
+    def __init__(
+        self,
+        on_complete: Optional[Callable[[str, DerivativeResult], Awaitable[Any]]] = None,
+        workers: int = IMAGE_DERIVATIVE_WORKERS,
+        max_pending: int = IMAGE_DERIVATIVE_QUEUE_MAX,
+        sizes: Optional[Dict[str, int]] = None,
+        fmt: Optional[str] = None,
+        quality: int = IMAGE_DERIVATIVE_QUALITY,
+        executor_factory: Optional[Callable[[], Any]] = None
+    ):
+        self.on_complete = on_complete
+        self.workers = workers
+        self.max_pending = max_pending
+        self.sizes = dict(sizes or DERIVATIVE_SIZES)
+        self.format = fmt or resolve_format()
+        self.quality = quality
+        self._executor_factory = executor_factory or self._process_pool
+        self._executor = None
+        self._tasks: set = set()
+        self._stats = {"submitted": 0, "completed": 0, "dropped": 0, "images": 0, "failed_images": 0}
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    @property
+    def out_dir(self) -> str:
+        return os.path.join(storage.UPLOAD_DIR, DERIVED_SUBDIR)
+
+    def submit(self, job_id: str, names: List[str]) -> bool:
+        """Queue derivatives for uploaded files `names` (trong UPLOAD_DIR). False nếu queue đầy."""
+        if not names:
+            return True
+        if len(self._tasks) >= self.max_pending:
+            self._stats["dropped"] += 1
+            logger.warning(f"Image derivative queue full - skipped {job_id}")
+            return False
+        if self._executor is None:
+            self._executor = self._executor_factory()
+        task = asyncio.get_running_loop().create_task(self._run(job_id, list(names)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._stats["submitted"] += 1
+        return True
+
+    async def _render(self, name: str) -> Optional[Dict[str, str]]:
+        loop = asyncio.get_running_loop()
+        try:
+            derived = await loop.run_in_executor(
+                self._executor, render_derivatives,
+                os.path.join(storage.UPLOAD_DIR, name), self.out_dir, self.sizes, self.format, self.quality
+            )
+        except Exception as e:
+            self._stats["failed_images"] += 1
+            logger.warning(f"Image derivatives failed for {name}: {e!r}")
+            return None
+        self._stats["images"] += 1
+        return derived
+
+    async def _run(self, job_id: str, names: List[str]):
+        results = await asyncio.gather(*(self._render(name) for name in names))
+        self._stats["completed"] += 1
+        if self.on_complete is not None:
+            try:
+                await self.on_complete(job_id, list(zip(names, results)))
+            except Exception as e:
+                logger.warning(f"Image derivatives callback failed for {job_id}: {e}")
+
+    async def drain(self):
+        """Wait for every queued job."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def close(self):
+        """Finish queued jobs, then stop the worker processes (gọi khi shutdown)."""
+        await self.drain()
+        if self._executor is not None:
+            await asyncio.to_thread(self._executor.shutdown, True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._tasks),
+            "capacity": self.max_pending,
+            "workers": self.workers,
+            "format": self.format,
+            **self._stats,
+        }
@@ -0,0 +1,261 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Write-behind Ingest Queue
+# Route chỉ validate + enqueue rồi trả 202; worker nền gom micro-batch
+# (theo kích thước hoặc thời gian) để ghi Orion-LD + cập nhật read model
+# Notification trùng (Orion-LD gửi lại, subscription chồng nhau) bị bỏ qua sớm
+# ======================================================
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Số entity tối đa chờ ghi; đầy → route trả 503 (Orion-LD gửi lại notification)
+INGEST_QUEUE_MAX = int(os.getenv("INGEST_QUEUE_MAX", "10000"))
+# Flush khi đủ số entity này...
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "100"))
+# ...hoặc khi entity cũ nhất đã chờ quá số giây này
+INGEST_BATCH_WAIT = float(os.getenv("INGEST_BATCH_WAIT", "0.05"))
+# Batch lỗi tạm thời (Orion-LD không phản hồi) được thử lại tối đa N lần rồi bỏ
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+INGEST_RETRY_DELAY = float(os.getenv("INGEST_RETRY_DELAY", "1"))
+# Cửa sổ chống trùng: số key (source id, observedAt) nhớ tối đa / thời gian nhớ (giây)
+INGEST_DEDUP_SIZE = int(os.getenv("INGEST_DEDUP_SIZE", "50000"))
+INGEST_DEDUP_TTL = float(os.getenv("INGEST_DEDUP_TTL", "900"))
+
+
+class DedupWindow:
+    """
+    Recently accepted notification keys (LRU + TTL, giới hạn bộ nhớ).
+
+    Key = (source id, modifiedAt/observedAt): cùng một lần đo của cùng một
+    nguồn. Route `claim()` trước khi tính toán; nếu không enqueue được (503)
+    thì `release()` để lần Orion-LD gửi lại vẫn được xử lý.
+    """
+
+    def __init__(self, maxsize: int = INGEST_DEDUP_SIZE, ttl: float = INGEST_DEDUP_TTL):
+        self._seen: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.checked = 0
+        self.suppressed = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._seen
+
+    def claim(self, key: Optional[Hashable]) -> bool:
+        """Record `key`; False nếu đã thấy trong cửa sổ (None = không xác định → luôn True)."""
+        if key is None:
+            return True
+        self.checked += 1
+        if key in self._seen:
+            self.suppressed += 1
+            return False
+        self._seen[key] = True
+        return True
+
+    def release(self, keys: Iterable[Optional[Hashable]]):
+        for key in keys:
+            if key is not None:
+                self._seen.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._seen),
+            "capacity": self._seen.maxsize,
+            "ttl": self._seen.ttl,
+            "checked": self.checked,
+            "suppressed": self.suppressed,
+        }
+
+
+class PartialFlush(Exception):
+    """
+    Raised by `flush` when only part of the batch was written.
+
+    Chỉ các item trong `unsent` (cùng object đã truyền cho `flush`) được thử
+    lại / bỏ; phần còn lại tính là đã ghi.
+    """
+
+    def __init__(self, unsent: List[Any], cause: Optional[BaseException] = None):
+        super().__init__(f"{len(unsent)} items not written: {cause}")
+        self.unsent = list(unsent)
+
+
+class _Item:
+    __slots__ = ("value", "enqueued_at", "attempts")
+
+    def __init__(self, value: Any, enqueued_at: float):
+        self.value = value
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+
+
+class IngestQueue:
+    """
+    Bounded in-process queue + background micro-batching worker.
+
+    - `offer()` đồng bộ, O(1): cả notification được nhận hoặc bị từ chối (đầy)
+    - Worker gọi `flush(values)` với tối đa `batch_size` item, ngay khi đủ
+      batch hoặc item cũ nhất chờ quá `max_wait` giây
+    - `flush` raise → batch quay lại đầu queue (giữ thứ tự), thử lại sau
+      `retry_delay`; item quá `max_attempts` lần bị bỏ, đếm vào `dropped` và
+      chuyển cho `on_drop(values)` (vd. bỏ đánh dấu dedup)
+    - `flush` raise `PartialFlush(unsent)` → chỉ `unsent` được thử lại / bỏ
+    - Item nằm trong deque (không gắn với event loop) nên worker được tạo lại
+      trên loop đang chạy mà không mất dữ liệu
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List[Any]], Awaitable[Any]],
+        max_size: int = INGEST_QUEUE_MAX,
+        batch_size: int = INGEST_BATCH_SIZE,
+        max_wait: float = INGEST_BATCH_WAIT,
+        max_attempts: int = INGEST_MAX_ATTEMPTS,
+        retry_delay: float = INGEST_RETRY_DELAY,
+        name: str = "ingest",
+        on_drop: Optional[Callable[[List[Any]], Any]] = None
+    ):
+        self._flush = flush
+        self._on_drop = on_drop
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.name = name
+        self._items: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._stats = {
+            "enqueued": 0, "flushed": 0, "batches": 0, "rejected": 0,
+            "failed_batches": 0, "dropped": 0, "max_depth": 0,
+        }
+        self.last_batch_size = 0
+        # Độ trễ enqueue → ghi xong (giây): batch gần nhất / lớn nhất / trung bình trượt
+        self.last_lag: Optional[float] = None
+        self.max_lag = 0.0
+        self.avg_lag: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        # Task của event loop khác (vd. TestClient tạo loop mới) → tạo lại
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wake = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    def offer(self, values: List[Any]) -> bool:
+        """Enqueue all `values` (gọi từ route async). False nếu không đủ chỗ."""
+        if len(self._items) + len(values) > self.max_size:
+            self._stats["rejected"] += len(values)
+            return False
+        now = time.monotonic()
+        self._items.extend(_Item(value, now) for value in values)
+        self._stats["enqueued"] += len(values)
+        self._stats["max_depth"] = max(self._stats["max_depth"], len(self._items))
+        self._ensure_running()
+        self._wake.set()
+        return True
+
+    async def _run(self):
+        while True:
+            if not self._items:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            # Chưa đủ batch: chờ thêm item tới hạn của item cũ nhất
+            remaining = self.max_wait - (time.monotonic() - self._items[0].enqueued_at)
+            if len(self._items) < self.batch_size and remaining > 0:
+                self._wake.clear()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wake.wait(), remaining)
+                continue
+            if await self.flush_once() == 0:
+                await asyncio.sleep(self.retry_delay)
+
+    async def flush_once(self) -> int:
+        """Flush one batch now. Returns number of items written (0 nếu lỗi)."""
+        batch = [self._items.popleft() for _ in range(min(self.batch_size, len(self._items)))]
+        if not batch:
+            return 0
+        try:
+            await self._flush([item.value for item in batch])
+        except asyncio.CancelledError:
+            self._items.extendleft(reversed(batch))
+            raise
+        except Exception as e:
+            self._stats["failed_batches"] += 1
+            if isinstance(e, PartialFlush):
+                # Phần đã ghi không được gửi lại / bỏ
+                unsent = {id(value) for value in e.unsent}
+                written = len(batch)
+                batch = [item for item in batch if id(item.value) in unsent]
+                self._stats["flushed"] += written - len(batch)
+            retry, dropped = [], []
+            for item in batch:
+                item.attempts += 1
+                (retry if item.attempts < self.max_attempts else dropped).append(item)
+            self._stats["dropped"] += len(dropped)
+            self._items.extendleft(reversed(retry))
+            logger.warning(f"[{self.name}] Batch of {len(batch)} failed ({len(retry)} requeued): {e}")
+            if dropped and self._on_drop is not None:
+                try:
+                    self._on_drop([item.value for item in dropped])
+                except Exception as drop_error:
+                    logger.warning(f"[{self.name}] on_drop callback failed: {drop_error}")
+            return 0
+
+        lag = time.monotonic() - batch[0].enqueued_at
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.avg_lag = lag if self.avg_lag is None else 0.9 * self.avg_lag + 0.1 * lag
+        self.last_batch_size = len(batch)
+        self._stats["batches"] += 1
+        self._stats["flushed"] += len(batch)
+        return len(batch)
+
+    async def drain(self):
+        """Flush everything queued (dừng khi một batch lỗi)."""
+        while self._items:
+            if await self.flush_once() == 0:
+                break
+
+    async def close(self):
+        """Stop the worker and flush what is left (gọi khi shutdown)."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            with suppress(asyncio.CancelledError, RuntimeError):
+                await self._task
+        await self.drain()
+
+    def stats(self) -> Dict[str, Any]:
+        batches = self._stats["batches"]
+        return {
+            "depth": len(self._items),
+            "capacity": self.max_size,
+            "last_batch_size": self.last_batch_size,
+            "avg_batch_size": round(self._stats["flushed"] / batches, 1) if batches else 0,
+            "lag_ms": {
+                "oldest_pending": round((time.monotonic() - self._items[0].enqueued_at) * 1000, 1)
+                if self._items else 0,
+                "last": round(self.last_lag * 1000, 1) if self.last_lag is not None else None,
+                "avg": round(self.avg_lag * 1000, 1) if self.avg_lag is not None else None,
+                "max": round(self.max_lag * 1000, 1),
+            },
+            **self._stats,
+        }
@@ -1,14 +1,28 @@
 # Copyright (c) 2025 FloodWatch Team
 # SPDX-License-Identifier: MIT
 
+# ======================================================
+# FloodWatch - Orion-LD Client
+# httpx.AsyncClient dùng chung (keep-alive pool) thay cho requests đồng bộ
+# Retry có jitter + retry budget, circuit breaker khi Orion-LD lỗi liên tục
+# ======================================================
+
 import os
+import time
 import uuid
+import random
+import asyncio
 import datetime
+import logging
 import requests
 from typing import List, Optional, Dict, Any
 import json
 from time import sleep
 
+import httpx
+
+logger = logging.getLogger(__name__)
+
 # --- Config ---
 ORION_LD_URL = os.getenv("ORION_ENTITIES", "http://orion-ld:1026/ngsi-ld/v1/entities")
 BASE_URL = os.getenv("BASE_URL", "http://api:8000")
@@ -17,6 +31,349 @@ HEADERS = {
     "Content-Type": "application/ld+json"
 }
 
+ORION_TIMEOUT = float(os.getenv("ORION_TIMEOUT", "10"))
+ORION_MAX_CONNECTIONS = int(os.getenv("ORION_MAX_CONNECTIONS", "20"))
+ORION_MAX_KEEPALIVE = int(os.getenv("ORION_MAX_KEEPALIVE", "10"))
+# Số lần thử lại tối đa cho mỗi request (ngoài lần đầu)
+ORION_RETRIES = int(os.getenv("ORION_RETRIES", "2"))
+# Backoff "full jitter": chờ ngẫu nhiên trong [0, min(max, base * 2^attempt)]
+ORION_BACKOFF_BASE = float(os.getenv("ORION_BACKOFF_BASE", "0.2"))
+ORION_BACKOFF_MAX = float(os.getenv("ORION_BACKOFF_MAX", "2"))
+# Retry budget: mỗi request góp `ratio` token, mỗi retry tiêu 1 token
+# → khi Orion-LD quá tải, tổng retry ≤ ~20% số request (không nhân tải lên)
+ORION_RETRY_BUDGET_RATIO = float(os.getenv("ORION_RETRY_BUDGET_RATIO", "0.2"))
+ORION_RETRY_BUDGET_RESERVE = float(os.getenv("ORION_RETRY_BUDGET_RESERVE", "10"))
+# Số entity tối đa mỗi request /entityOperations/upsert
+ORION_BATCH_SIZE = int(os.getenv("ORION_BATCH_SIZE", "100"))
+# Circuit breaker: mở sau N request thất bại liên tiếp, thử lại sau M giây
+ORION_BREAKER_THRESHOLD = int(os.getenv("ORION_BREAKER_THRESHOLD", "5"))
+ORION_BREAKER_RESET = float(os.getenv("ORION_BREAKER_RESET", "30"))
+
+# 429/5xx là lỗi tạm thời; 4xx khác là lỗi của request → không retry
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def derived_entity_id(entity_type: str, source_id: str) -> str:
+    """
+    Stable id of the entity derived from `source_id`.
+
+    `urn:ngsi-ld:WaterLevelObserved:q1-01` → `urn:ngsi-ld:FloodRiskSensor:q1-01`:
+    mỗi notification upsert cùng một entity thay vì tạo entity mới (lịch sử
+    nằm ở QuantumLeap).
+    """
+    parts = source_id.split(":", 3)
+    suffix = parts[3] if len(parts) == 4 and parts[0] == "urn" and parts[1] == "ngsi-ld" else source_id
+    return f"urn:ngsi-ld:{entity_type}:{suffix}"
+
+
+class OrionError(Exception):
+    """Orion-LD rejected the request (or could not be reached)."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        # upsert_entities: kết quả của các lô đã ghi trước lô lỗi
+        self.partial: Optional[Dict[str, Any]] = None
+
+
+class OrionUnavailable(OrionError):
+    """Raised when Orion-LD is unreachable or the circuit breaker is open."""
+
+# ======================================================
+# RETRY BUDGET + CIRCUIT BREAKER
+# ======================================================
+
+class RetryBudget:
+    """Token bucket giới hạn tỉ lệ retry so với số request."""
+
+    def __init__(self, ratio: float = ORION_RETRY_BUDGET_RATIO, reserve: float = ORION_RETRY_BUDGET_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+
+    def deposit(self):
+        self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    closed → (N lỗi liên tiếp) → open: từ chối ngay, không gọi Orion-LD
+    open → (sau `reset_timeout`) → half_open: cho một request thử
+    half_open → thành công: closed / thất bại: open lại
+    """
+
+    def __init__(
+        self,
+        threshold: int = ORION_BREAKER_THRESHOLD,
+        reset_timeout: float = ORION_BREAKER_RESET,
+        clock=time.monotonic
+    ):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        # Thời điểm cho request thử (half_open); trial bị hủy giữa chừng hết hạn sau reset_timeout
+        self._trial_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and (
+            self._trial_at is None or self.clock() - self._trial_at >= self.reset_timeout
+        ):
+            self._trial_at = self.clock()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_at is not None or (self.opened_at is None and self.failures >= self.threshold):
+            logger.warning(f"Orion-LD circuit opened after {self.failures} failures")
+            self.opened_at = self.clock()
+        self._trial_at = None
+
+# ======================================================
+# ASYNC CLIENT (pooled, per event loop)
+# ======================================================
+
+class OrionClient:
+    """
+    Async Orion-LD client dùng chung cho mọi route.
+
+    - Một `httpx.AsyncClient` (keep-alive pool) cho mỗi event loop
+    - Lỗi kết nối / timeout / 429 / 5xx → retry với backoff jitter, giới hạn
+      bởi `RetryBudget` (dùng chung mọi request)
+    - `CircuitBreaker` mở khi Orion-LD lỗi liên tục → request thất bại ngay
+      bằng `OrionUnavailable` thay vì giữ worker chờ timeout
+    """
+
+    def __init__(
+        self,
+        entities_url: str = ORION_LD_URL,
+        retries: int = ORION_RETRIES,
+        timeout: float = ORION_TIMEOUT,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        sleep=asyncio.sleep
+    ):
+        self.entities_url = entities_url.rstrip("/")
+        self.base_url = self.entities_url.split("/ngsi-ld")[0]
+        self.retries = retries
+        self.timeout = timeout
+        self.transport = transport
+        self.sleep = sleep
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+        self._http: Optional[httpx.AsyncClient] = None
+        self._http_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stats = {"requests": 0, "retries": 0, "failures": 0, "rejected": 0, "budget_exhausted": 0,
+                       "conflicts_after_retry": 0}
+
+    def _client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        # Client gắn với event loop tạo ra nó (TestClient tạo loop mới) → tạo lại
+        if self._http is None or self._http_loop is not loop or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=ORION_MAX_CONNECTIONS,
+                    max_keepalive_connections=ORION_MAX_KEEPALIVE,
+                ),
+                transport=self.transport,
+            )
+            self._http_loop = loop
+        return self._http
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(ORION_BACKOFF_MAX, ORION_BACKOFF_BASE * (2 ** attempt)))
+
+    async def request(self, method: str, url: str, conflict_on_retry_ok: bool = False, **kwargs) -> httpx.Response:
+        """
+        Send one request with retry + circuit breaker.
+
+        Args:
+            conflict_on_retry_ok: 409 ở lần thử lại → trả response thay vì raise
+                (POST tạo entity: lần thử trước đã ghi được nhưng mất response)
+
+        Raises:
+            OrionUnavailable: Circuit đang mở, hoặc lỗi tạm thời sau khi hết retry/budget
+            OrionError: Orion-LD trả 4xx (không retry)
+        """
+        if not self.breaker.allow():
+            self._stats["rejected"] += 1
+            raise OrionUnavailable("Orion-LD circuit breaker is open")
+        self._stats["requests"] += 1
+        self.budget.deposit()
+
+        attempt = 0
+        while True:
+            try:
+                response = await self._client().request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                error = OrionUnavailable(f"Cannot reach Orion-LD: {e!r}")
+            else:
+                if response.status_code not in RETRYABLE_STATUS:
+                    # 4xx vẫn là Orion-LD đang hoạt động bình thường
+                    self.breaker.record_success()
+                    if response.status_code == 409 and conflict_on_retry_ok and attempt > 0:
+                        self._stats["conflicts_after_retry"] += 1
+                        return response
+                    if response.is_error:
+                        raise OrionError(
+                            f"Orion-LD {response.status_code}: {response.text[:200]}",
+                            response.status_code
+                        )
+                    return response
+                error = OrionUnavailable(f"Orion-LD {response.status_code}", response.status_code)
+
+            if attempt >= self.retries:
+                break
+            if not self.budget.withdraw():
+                self._stats["budget_exhausted"] += 1
+                break
+            self._stats["retries"] += 1
+            await self.sleep(self._backoff(attempt))
+            attempt += 1
+
+        self._stats["failures"] += 1
+        self.breaker.record_failure()
+        raise error
+
+    async def create_entity(self, entity: Dict[str, Any]) -> httpx.Response:
+        """
+        POST /ngsi-ld/v1/entities.
+
+        POST không idempotent: lần đầu có thể đã tạo entity rồi mới mất kết nối
+        → 409 ở lần retry nghĩa là entity (cùng id) đã có, coi là thành công.
+        """
+        return await self.request("POST", self.entities_url, conflict_on_retry_ok=True, json=entity, headers=HEADERS)
+
+    async def append_attributes(self, entity_id: str, attributes: Dict[str, Any]) -> httpx.Response:
+        """POST /ngsi-ld/v1/entities/{id}/attrs (thêm hoặc ghi đè attribute)."""
+        return await self.request("POST", f"{self.entities_url}/{entity_id}/attrs", json=attributes, headers=HEADERS)
+
+    async def upsert_entities(
+        self,
+        entities: List[Dict[str, Any]],
+        batch_size: int = ORION_BATCH_SIZE
+    ) -> Dict[str, Any]:
+        """
+        POST /ngsi-ld/v1/entityOperations/upsert theo lô `batch_size` entity.
+
+        Returns:
+            {"status": 201|204|207 (None nếu không có entity), "success": [entity id],
+             "errors": [{"entityId", "error"}]}
+            - 207 khi Orion-LD từ chối một phần (entity lỗi nằm trong `errors`)
+
+        Raises:
+            OrionError / OrionUnavailable: một lô thất bại; `e.partial` là kết quả
+                (cùng dạng) của các lô trước đó - đã ghi, không cần gửi lại
+        """
+        url = f"{self.base_url}/ngsi-ld/v1/entityOperations/upsert"
+        result: Dict[str, Any] = {"status": None, "success": [], "errors": []}
+        for start in range(0, len(entities), batch_size):
+            chunk = entities[start:start + batch_size]
+            try:
+                response = await self.request("POST", url, json=chunk, headers=HEADERS)
+            except OrionError as e:
+                e.partial = result
+                raise
+            errors = []
+            if response.status_code == 207:
+                try:
+                    errors = response.json().get("errors") or []
+                except ValueError:
+                    errors = [{"entityId": e["id"], "error": response.text[:200]} for e in chunk]
+            failed = {error.get("entityId") for error in errors}
+            result["success"].extend(e["id"] for e in chunk if e["id"] not in failed)
+            result["errors"].extend(errors)
+            # Nhiều lô: 207 nếu có lô bị từ chối một phần
+            result["status"] = max(result["status"] or 0, response.status_code)
+        return result
+
+    async def list_entities(self, entity_type: str, page_size: int = 1000) -> List[Dict[str, Any]]:
+        """GET /ngsi-ld/v1/entities?type=... (mọi trang, `limit` tối đa 1000 của Orion-LD)."""
+        entities: List[Dict[str, Any]] = []
+        while True:
+            response = await self.request(
+                "GET", self.entities_url,
+                params={"type": entity_type, "limit": page_size, "offset": len(entities)},
+                headers={"Accept": "application/ld+json"}
+            )
+            page = response.json()
+            entities.extend(page)
+            if len(page) < page_size:
+                return entities
+
+    async def delete_entities(self, entity_ids: List[str], batch_size: int = ORION_BATCH_SIZE) -> int:
+        """POST /ngsi-ld/v1/entityOperations/delete theo lô. Returns số entity đã gửi xóa."""
+        url = f"{self.base_url}/ngsi-ld/v1/entityOperations/delete"
+        for start in range(0, len(entity_ids), batch_size):
+            await self.request("POST", url, json=entity_ids[start:start + batch_size],
+                               headers={"Content-Type": "application/json"})
+        return len(entity_ids)
+
+    async def ping(self, timeout: float = 5) -> bool:
+        """GET /version (health check - không retry, không tính vào breaker)."""
+        try:
+            response = await self._client().get(f"{self.base_url}/version", timeout=timeout)
+            return response.is_success
+        except httpx.HTTPError:
+            return False
+
+    async def close(self):
+        if self._http is not None:
+            try:
+                await self._http.aclose()
+            except Exception as e:
+                logger.warning(f"Error closing Orion-LD client: {e}")
+            self._http = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "retry_tokens": round(self.budget.tokens, 2),
+            **self._stats,
+        }
+
+
+_orion: Optional[OrionClient] = None
+
+
+def get_orion() -> OrionClient:
+    """Shared Orion-LD client (breaker + budget dùng chung trong process)."""
+    global _orion
+    if _orion is None:
+        _orion = OrionClient()
+    return _orion
+
+
+async def close_orion():
+    """Close the shared client's connection pool (gọi khi shutdown)."""
+    if _orion is not None:
+        await _orion.close()
+
 # --- Build payload ---
 def build_crowd_report_sdm(
     description: str,
@@ -106,7 +463,7 @@ def reverse_geocode(lat: float, lng: float) -> Dict[str, Any]:
         return {}
 
 # --- Send to Orion-LD ---
-def create_crowd_report_entity(
+async def create_crowd_report_entity(
     description: str,
     reporterId: str,
     photo_urls: Optional[List[str]] = None,
@@ -117,7 +474,9 @@ def create_crowd_report_entity(
     """
     Create a CrowdReport entity in Orion-LD
     """
-    payload = build_crowd_report_sdm(
+    # Reverse geocode (Nominatim) vẫn đồng bộ + sleep(1) → chạy ngoài event loop
+    payload = await asyncio.to_thread(
+        build_crowd_report_sdm,
         description=description,
         reporterId=reporterId,
         photo_urls=photo_urls,
@@ -126,35 +485,23 @@ def create_crowd_report_entity(
         water_level=water_level
     )
 
-    # Debug print
-    print("\n=== PAYLOAD SENT TO ORION-LD ===")
-    print(json.dumps(payload, indent=4, ensure_ascii=False))
-
-    # Send POST request
-    resp = requests.post(ORION_LD_URL, json=payload, headers=HEADERS)
-
-    print("\n=== ORION-LD RESPONSE ===")
-    print("Status:", resp.status_code)
-    try:
-        print(json.dumps(resp.json(), indent=4, ensure_ascii=False))
-    except Exception:
-        print(resp.text)
+    logger.debug("Payload sent to Orion-LD: %s", json.dumps(payload, ensure_ascii=False))
 
-    if not resp.ok:
-        raise Exception(f"Failed to create entity: {resp.text}")
+    resp = await get_orion().create_entity(payload)
+    logger.debug(f"Orion-LD response: {resp.status_code}")
 
     return payload["id"]
 
 # --- Example usage ---
 if __name__ == "__main__":
     try:
-        entity_id = create_crowd_report_entity(
+        entity_id = asyncio.run(create_crowd_report_entity(
             description="Ngập trên đường Nguyễn Huệ, khoảng 20cm",
             reporterId="user123",
             photo_urls=[f"{BASE_URL}/static/uploads/example.png"],
             lat=21.0245,
             lng=105.84117
-        )
+        ))
         print(f"\n✅ CrowdReport created with ID: {entity_id}")
     except Exception as e:
         print(f"\n❌ Error: {e}")
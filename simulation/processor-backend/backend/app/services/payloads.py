@@ -0,0 +1,92 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Pre-serialized Payloads
+# JSON bytes (orjson) được tạo một lần cho mỗi version snapshot + ETag / 304
+# ======================================================
+
+import hashlib
+import logging
+from typing import Any, Callable, Hashable, Optional
+
+import orjson
+from cachetools import LRUCache
+from fastapi import Request, Response
+
+logger = logging.getLogger(__name__)
+
+JSON_MEDIA_TYPE = "application/json"
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize to JSON bytes (orjson, fallback `str()` như json.dumps(default=str))."""
+    return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
+class Payload:
+    """Serialized JSON body with its strong ETag."""
+
+    __slots__ = ("body", "etag", "_text")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self._text: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        """Body as str (cho WebSocket text frame), decode một lần."""
+        if self._text is None:
+            self._text = self.body.decode("utf-8")
+        return self._text
+
+
+class PayloadCache:
+    """
+    Serialized payloads keyed by view (+ params), valid for one snapshot version.
+
+    `version` là bất kỳ giá trị hashable nào thay đổi khi dữ liệu nguồn thay đổi
+    (vd. tuple version của các snapshot store). Cùng key + version → trả lại đúng
+    bytes đã serialize, không build/serialize lại.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self._entries: LRUCache = LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key: Hashable, version: Hashable, build: Callable[[], Any]) -> Payload:
+        """Return the payload for `key` at `version`, building it at most once."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        payload = Payload(dumps(build()))
+        self._entries[key] = (version, payload)
+        return payload
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check (weak comparison theo RFC 9110, hỗ trợ `*` và danh sách)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def payload_response(request: Request, payload: Payload) -> Response:
+    """200 với bytes đã serialize, hoặc 304 nếu client đã có đúng version."""
+    headers = {"ETag": payload.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), payload.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=payload.body, media_type=JSON_MEDIA_TYPE, headers=headers)
@@ -0,0 +1,246 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - In-process Read Models
+# "Latest reading per zone" thay cho GROUP BY/JOIN mỗi lần poll
+# Write-through snapshot store có version (thay cho TTL cache bị clear liên tục)
+# ======================================================
+
+import os
+import logging
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Số tombstone (key đã bị loại) giữ lại cho reader incremental; cũ hơn → bỏ
+READ_MODEL_TOMBSTONES = int(os.getenv("READ_MODEL_TOMBSTONES", "10000"))
+
+
+def to_epoch_ms(value: Any) -> Optional[int]:
+    """Normalize a timestamp (epoch ms, ISO string, datetime) to epoch milliseconds."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        dt = value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        return int(dt.timestamp() * 1000)
+    if isinstance(value, str):
+        try:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return to_epoch_ms(dt)
+    return None
+
+
+def now_ms() -> int:
+    """Current UTC time in epoch milliseconds."""
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
+def coordinate_key(record: Dict[str, Any], precision: int = 5) -> Optional[str]:
+    """Key a record by its rounded coordinates (5 decimals ≈ 1.1m)."""
+    lat, lng = record.get("lat"), record.get("lng")
+    if lat is None or lng is None:
+        return None
+    return f"{round(lat, precision)},{round(lng, precision)}"
+
+
+class LatestReadingStore:
+    """
+    Latest reading per key, kept in memory (write-through snapshot store).
+
+    - `upsert()` áp dụng mỗi entity đã xử lý như một delta → O(1)
+    - `snapshot()` / `changed_since_version()` đọc hoàn toàn từ memory
+    - `bootstrap()` nạp dữ liệu từ CrateDB (chỉ sau restart)
+    - `version` tăng đơn điệu mỗi khi store thay đổi → cursor cho client/cache
+    - Key bị `evict_older_than()` để lại tombstone `{..., "removed": True}`
+      (chỉ các field định danh + tọa độ) trong `changed_since_version()`, để
+      WebSocket client / cache theo version cũng thấy record bị xóa
+
+    Key mặc định là field `key_field` (zoneid cho sensor); crowd report dùng
+    `key_func` theo tọa độ. Notification từ Orion không luôn có `zoneId`
+    (subscription chỉ gửi một số attribute), nên store giữ alias
+    `entity_id → key` để gộp đúng record.
+    """
+
+    def __init__(
+        self,
+        key_field: str = "zoneid",
+        alias_field: str = "entity_id",
+        time_field: str = "updatedat",
+        key_func: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None,
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        max_tombstones: int = READ_MODEL_TOMBSTONES
+    ):
+        self.key_field = key_field
+        self.alias_field = alias_field
+        self.time_field = time_field
+        self.key_func = key_func
+        self.order_by = order_by
+        self.descending = descending
+        self.max_tombstones = max_tombstones
+        self.bootstrapped = False
+        self.version = 0
+        self.updated_at: Optional[int] = None
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._versions: Dict[str, int] = {}
+        self._aliases: Dict[str, str] = {}
+        # key → (version lúc bị loại, tombstone), theo thứ tự loại
+        self._removed: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _resolve_key(self, record: Dict[str, Any]) -> Optional[str]:
+        key = self.key_func(record) if self.key_func else record.get(self.key_field)
+        if key:
+            return key
+        alias = record.get(self.alias_field)
+        if alias:
+            return self._aliases.get(alias, alias)
+        return None
+
+    def key_of(self, record: Dict[str, Any]) -> Optional[str]:
+        """Store key of a record (theo key/alias hiện tại), None nếu không xác định."""
+        return self._resolve_key(record)
+
+    def _touch(self, key: str):
+        self.version += 1
+        self._versions[key] = self.version
+        self._removed.pop(key, None)
+        self.updated_at = now_ms()
+
+    def _tombstone(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        fields = (self.key_field, self.alias_field, "lat", "lng")
+        tombstone = {f: record[f] for f in fields if record.get(f) is not None}
+        tombstone[self.time_field] = now_ms()
+        tombstone["removed"] = True
+        return tombstone
+
+    def _ordered_keys(self, keys) -> List[str]:
+        if self.order_by:
+            return sorted(
+                keys,
+                key=lambda k: self._records[k].get(self.order_by) or 0,
+                reverse=self.descending
+            )
+        return sorted(keys, reverse=self.descending)
+
+    def upsert(self, record: Dict[str, Any]) -> bool:
+        """
+        Apply one processed entity as a delta. Returns False if ignored (no key,
+        older than the reading already stored, or identical to it).
+        """
+        key = self._resolve_key(record)
+        if not key:
+            return False
+
+        incoming = {k: v for k, v in record.items() if v is not None}
+        incoming[self.time_field] = to_epoch_ms(record.get(self.time_field)) or now_ms()
+
+        # Record đã lưu tạm theo alias (trước khi biết zoneid) → gộp về key chính
+        alias = incoming.get(self.alias_field)
+        migrated = False
+        if alias and alias != key and alias in self._records:
+            stale = self._records.pop(alias)
+            self._versions.pop(alias, None)
+            self._records.setdefault(key, stale)
+            migrated = True
+
+        existing = self._records.get(key)
+        if existing is not None:
+            if existing.get(self.time_field, 0) > incoming[self.time_field]:
+                # Reading cũ hơn: chỉ bổ sung metadata còn thiếu (zoneid, zonename, ...)
+                missing = {f: v for f, v in incoming.items() if f not in existing}
+                existing.update(missing)
+                if alias:
+                    self._aliases[alias] = key
+                if missing or migrated:
+                    self._touch(key)
+                return False
+            incoming = {**existing, **incoming}
+            if incoming == existing and not migrated:
+                # Không có gì thay đổi (vd. reconcile lại cùng row) → giữ nguyên version
+                return False
+
+        self._records[key] = incoming
+        if alias:
+            self._aliases[alias] = key
+        self._touch(key)
+        return True
+
+    def bootstrap(self, records: List[Dict[str, Any]]):
+        """
+        Load rows from the rebuild query (e.g. CrateDB after restart).
+
+        Merge theo timestamp: reading mới hơn đã nhận qua notification được giữ lại.
+        Gọi lại định kỳ để reconcile với DB (các row không đổi không tăng version).
+        """
+        changed = sum(1 for record in records if self.upsert(record))
+        if not self.bootstrapped:
+            self.bootstrapped = True
+            logger.info(f"Read model bootstrapped: {len(self._records)} keys (v{self.version})")
+        elif changed:
+            logger.info(f"Read model reconciled: {changed} keys changed (v{self.version})")
+
+    def evict_older_than(self, cutoff: Any) -> int:
+        """
+        Drop records whose `time_field` is before `cutoff`. Returns count removed.
+
+        Mỗi key bị loại để lại tombstone (tối đa `max_tombstones`, cũ nhất bị bỏ trước).
+        """
+        cutoff_ms = to_epoch_ms(cutoff)
+        if cutoff_ms is None:
+            return 0
+        expired = [k for k, r in self._records.items() if r.get(self.time_field, 0) < cutoff_ms]
+        if not expired:
+            return 0
+        self.version += 1
+        for key in expired:
+            record = self._records.pop(key)
+            self._versions.pop(key, None)
+            self._aliases.pop(record.get(self.alias_field), None)
+            self._removed.pop(key, None)
+            self._removed[key] = (self.version, self._tombstone(record))
+        for key in list(self._removed)[:max(0, len(self._removed) - self.max_tombstones)]:
+            del self._removed[key]
+        self.updated_at = now_ms()
+        return len(expired)
+
+    def snapshot(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Copies of all latest readings, in store order."""
+        keys = self._ordered_keys(self._records)
+        if limit is not None:
+            keys = keys[:limit]
+        return [dict(self._records[k]) for k in keys]
+
+    def changed_since(self, timestamp: Any) -> List[Dict[str, Any]]:
+        """Copies of readings updated strictly after `timestamp`."""
+        since = to_epoch_ms(timestamp)
+        if since is None:
+            return self.snapshot()
+        keys = [k for k, r in self._records.items() if r.get(self.time_field, 0) > since]
+        return [dict(self._records[k]) for k in self._ordered_keys(keys)]
+
+    def changed_since_version(self, version: int) -> List[Dict[str, Any]]:
+        """
+        Copies of records changed after store `version` (delta for incremental readers),
+        rồi tombstone `{..., "removed": True}` của các key bị loại sau `version`.
+        """
+        keys = [k for k, v in self._versions.items() if v > version]
+        changed = [dict(self._records[k]) for k in self._ordered_keys(keys)]
+        changed.extend(dict(t) for v, t in self._removed.values() if v > version)
+        return changed
+
+    def latest_timestamp(self) -> Optional[int]:
+        """Most recent `time_field` across all keys (cursor for incremental reads)."""
+        if not self._records:
+            return None
+        return max(r.get(self.time_field, 0) for r in self._records.values())
@@ -2,17 +2,23 @@
 # SPDX-License-Identifier: MIT
 
 import os
-import io
+import asyncio
+import hashlib
+import logging
 from uuid import uuid4
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from fastapi import UploadFile, HTTPException
 
+logger = logging.getLogger(__name__)
+
 UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "..", "static", "uploads")
 
 # ✅ File validation constants
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 MAX_FILES = 5  # Maximum number of files per upload
+# ✅ NEW: Streaming upload - mỗi lần chỉ giữ một chunk trong memory
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
 
 def ensure_upload_dir():
     """Create upload directory if not exists."""
@@ -28,6 +34,112 @@ def validate_file_extension(filename: str) -> str:
         )
     return ext
 
+def _too_large_message() -> str:
+    return f"File too large. Max size: {MAX_FILE_SIZE // (1024*1024)}MB"
+
+def _verify_image(path: str):
+    """PIL header + integrity check, đọc từ file (chạy trong worker thread)."""
+    from PIL import Image
+    with Image.open(path) as img:
+        img.verify()
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class StagedUpload:
+    """Upload đã ghi ra file tạm + kiểm tra xong, chờ `commit_uploads` đổi tên."""
+
+    __slots__ = ("filename", "ext", "temp_path", "sha256", "size")
+
+    def __init__(self, filename: str, ext: str, temp_path: str, sha256: str, size: int):
+        self.filename = filename
+        self.ext = ext
+        self.temp_path = temp_path
+        self.sha256 = sha256
+        self.size = size
+
+    @property
+    def stored_name(self) -> str:
+        # Tên theo nội dung: ảnh gửi lại (retry) không tạo thêm file
+        return f"{self.sha256[:32]}{self.ext}"
+
+async def stage_upload(file: UploadFile, chunk_size: int = UPLOAD_CHUNK_SIZE) -> StagedUpload:
+    """
+    ✅ NEW: Stream one upload to a temp file in UPLOAD_DIR.
+
+    - Đọc từng chunk, dừng ngay khi vượt MAX_FILE_SIZE
+    - Hash SHA-256 trong lúc đọc, ghi file bằng worker thread (không block event loop)
+    - Kiểm tra ảnh (PIL verify) trong worker thread, đọc từ file tạm
+
+    Raises:
+        HTTPException 400: Sai định dạng, quá lớn hoặc ảnh hỏng (file tạm bị xóa)
+    """
+    ext = validate_file_extension(file.filename)
+    # Client gửi kèm kích thước → từ chối trước khi đọc byte nào
+    if file.size is not None and file.size > MAX_FILE_SIZE:
+        raise HTTPException(400, _too_large_message())
+
+    ensure_upload_dir()
+    temp_path = os.path.join(UPLOAD_DIR, f".upload-{uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    out = await asyncio.to_thread(open, temp_path, "wb")
+    try:
+        try:
+            while True:
+                chunk = await file.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise HTTPException(400, _too_large_message())
+                digest.update(chunk)
+                await asyncio.to_thread(out.write, chunk)
+        finally:
+            await asyncio.to_thread(out.close)
+        try:
+            await asyncio.to_thread(_verify_image, temp_path)
+        except Exception:
+            raise HTTPException(400, "Invalid or corrupted image file")
+    except BaseException:
+        _remove_quietly(temp_path)
+        raise
+    return StagedUpload(file.filename, ext, temp_path, digest.hexdigest(), size)
+
+async def commit_uploads(staged: List[StagedUpload], base_url: str) -> List[str]:
+    """Atomically rename staged uploads into UPLOAD_DIR. Returns public URLs."""
+    urls = []
+    for upload in staged:
+        await asyncio.to_thread(os.replace, upload.temp_path, os.path.join(UPLOAD_DIR, upload.stored_name))
+        urls.append(f"{base_url}/static/uploads/{upload.stored_name}")
+    return urls
+
+def discard_uploads(staged: List[StagedUpload]):
+    """Xóa file tạm của các upload chưa commit."""
+    for upload in staged:
+        _remove_quietly(upload.temp_path)
+
+async def store_images(files: List[UploadFile], base_url: str) -> List[str]:
+    """
+    ✅ NEW: Validate every image first, then publish all of them.
+
+    Ảnh nào lỗi → không ảnh nào được lưu (giống validate trước, lưu sau).
+    """
+    staged: List[StagedUpload] = []
+    try:
+        for f in files:
+            staged.append(await stage_upload(f))
+        urls = await commit_uploads(staged, base_url)
+    except BaseException:
+        discard_uploads(staged)
+        raise
+    for upload in staged:
+        logger.debug(f"Stored upload {upload.filename} ({upload.size} bytes, sha256={upload.sha256})")
+    return urls
+
 def save_files_local(files: List[UploadFile], base_url: str) -> List[str]:
     """
     Save uploaded files to local storage.
@@ -64,38 +176,14 @@ async def validate_and_save_files(
     errors = []
     
     for f in files:
+        # 1. Validate extension (sai định dạng → 400 cho cả request)
+        validate_file_extension(f.filename)
         try:
-            # 1. Validate extension
-            ext = validate_file_extension(f.filename)
-            
-            # 2. Read content
-            content = await f.read()
-            
-            # 3. Check size
-            if len(content) > MAX_FILE_SIZE:
-                errors.append(f"{f.filename}: File too large (max {MAX_FILE_SIZE // (1024*1024)}MB)")
-                continue
-            
-            # 4. Verify it's a real image
-            try:
-                from PIL import Image
-                img = Image.open(io.BytesIO(content))
-                img.verify()
-            except Exception:
-                errors.append(f"{f.filename}: Invalid or corrupted image")
-                continue
-            
-            # 5. Save file
-            filename = f"{uuid4().hex}{ext}"
-            filepath = os.path.join(UPLOAD_DIR, filename)
-            
-            with open(filepath, "wb") as out:
-                out.write(content)
-            
-            urls.append(f"{base_url}/static/uploads/{filename}")
-            
-        except HTTPException:
-            raise
+            # ✅ OPTIMIZED: stream theo chunk (giới hạn size) → verify → rename
+            staged = await stage_upload(f)
+            urls.extend(await commit_uploads([staged], base_url))
+        except HTTPException as e:
+            errors.append(f"{f.filename}: {e.detail}")
         except Exception as e:
             errors.append(f"{f.filename}: {str(e)}")
     
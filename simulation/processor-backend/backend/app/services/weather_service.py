@@ -13,7 +13,7 @@ from datetime import datetime, timezone
 from typing import List, Dict, Any, Optional
 from dataclasses import dataclass
 import httpx
-from cachetools import TTLCache
+from .cache import TieredCache
 
 logger = logging.getLogger(__name__)
 
@@ -25,7 +25,8 @@ OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY", "4cfeed8e0b19a6b8886060e9
 OPENWEATHER_BASE_URL = "https://api.openweathermap.org/data/2.5"
 
 # Cache thời tiết 10 phút (OpenWeather free tier limit)
-weather_cache = TTLCache(maxsize=50, ttl=600)
+# ✅ L1 trong process + L2 Redis (nếu có REDIS_URL) → mọi worker dùng chung quota
+weather_cache = TieredCache(namespace="weather", ttl=600, maxsize=50)
 
 # ======================================================
 # HCMC DISTRICTS DATA
@@ -101,11 +102,12 @@ def get_day_name_vi(dt: datetime) -> str:
 # ======================================================
 
 async def fetch_current_weather(lat: float, lon: float) -> Optional[Dict[str, Any]]:
-    """Fetch current weather from OpenWeather API."""
-    cache_key = f"current_{lat}_{lon}"
-    if cache_key in weather_cache:
-        return weather_cache[cache_key]
-    
+    """Fetch current weather from OpenWeather API (cached, shared across workers)."""
+    return await weather_cache.get_or_load(
+        f"current_{lat}_{lon}", lambda: _request_current_weather(lat, lon)
+    )
+
+async def _request_current_weather(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     try:
         async with httpx.AsyncClient(timeout=10.0) as client:
             response = await client.get(
@@ -119,19 +121,18 @@ async def fetch_current_weather(lat: float, lon: float) -> Optional[Dict[str, An
                 }
             )
             response.raise_for_status()
-            data = response.json()
-            weather_cache[cache_key] = data
-            return data
+            return response.json()
     except Exception as e:
         logger.error(f"OpenWeather current API error: {e}")
         return None
 
 async def fetch_forecast(lat: float, lon: float) -> Optional[Dict[str, Any]]:
-    """Fetch 5-day forecast from OpenWeather API (3-hour intervals)."""
-    cache_key = f"forecast_{lat}_{lon}"
-    if cache_key in weather_cache:
-        return weather_cache[cache_key]
-    
+    """Fetch 5-day forecast from OpenWeather API (3-hour intervals, cached)."""
+    return await weather_cache.get_or_load(
+        f"forecast_{lat}_{lon}", lambda: _request_forecast(lat, lon)
+    )
+
+async def _request_forecast(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     try:
         async with httpx.AsyncClient(timeout=10.0) as client:
             response = await client.get(
@@ -146,9 +147,7 @@ async def fetch_forecast(lat: float, lon: float) -> Optional[Dict[str, Any]]:
                 }
             )
             response.raise_for_status()
-            data = response.json()
-            weather_cache[cache_key] = data
-            return data
+            return response.json()
     except Exception as e:
         logger.error(f"OpenWeather forecast API error: {e}")
         return None
@@ -319,6 +318,6 @@ def get_all_districts() -> List[Dict[str, Any]]:
     return HCMC_DISTRICTS
 
 def clear_weather_cache():
-    """Clear weather cache."""
+    """Clear weather cache (trong event loop: cả L2 và L1 của các worker khác)."""
     weather_cache.clear()
     logger.info("Weather cache cleared")
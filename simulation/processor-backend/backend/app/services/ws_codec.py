@@ -0,0 +1,148 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Binary WebSocket Protocol (MessagePack)
+# Field dictionary gửi một lần + delta theo từng record cho /ws/map
+# ======================================================
+
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # msgpack là tùy chọn - không có thì chỉ hỗ trợ JSON
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL_JSON = "json"
+PROTOCOL_MSGPACK = "msgpack"
+PROTOCOL_VERSION = 1
+
+# Field dictionary ban đầu (id = vị trí). Field mới được cấp id tiếp theo và
+# gửi kèm frame đầu tiên dùng tới nó (khóa "f").
+FIELDS = (
+    "entity_id", "entity_type", "sensorinstanceid", "lat", "lng",
+    "waterlevel", "severity", "district", "watertrend", "zoneid",
+    "zonename", "updatedat", "riskscore", "risklevel", "address",
+    "calculatedat", "distance_km",
+)
+
+# Loại entry trong frame: record đầy đủ (thay thế) hoặc delta (chỉ field đổi)
+FULL = 0
+DELTA = 1
+
+
+def available_protocols() -> List[str]:
+    return [PROTOCOL_JSON, PROTOCOL_MSGPACK] if msgpack is not None else [PROTOCOL_JSON]
+
+
+class MsgpackEncoder:
+    """
+    Per-connection MessagePack encoder.
+
+    Frame: {"t": type, "d": {stream: [[ref, kind, {field_id: value}]]}, ...meta}
+    - `ref`: số nguyên thay cho key của record, cấp một lần cho mỗi connection
+    - `kind`: FULL (record đầy đủ) hoặc DELTA (chỉ các field thay đổi so với
+      lần gửi trước trên connection này); tombstone (`removed`) luôn FULL
+    - Tên field chỉ xuất hiện trong frame `schema` và khóa "f" của frame
+      đầu tiên dùng field mới
+
+    Trạng thái delta là riêng của mỗi connection nên frame binary được encode
+    theo từng socket (frame JSON vẫn dùng chung).
+    """
+
+    def __init__(self, key_funcs: Dict[str, Callable[[Dict[str, Any]], Optional[str]]]):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed")
+        self.key_funcs = key_funcs
+        self._fields: Dict[str, int] = {name: i for i, name in enumerate(FIELDS)}
+        self._refs: Dict[Tuple[str, Any], int] = {}
+        self._next_ref = 0
+        # Bản ghi đã gửi gần nhất theo ref (tham chiếu, không copy)
+        self._sent: Dict[int, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._sent)
+
+    def schema(self) -> bytes:
+        """First frame after negotiation: field dictionary + stream names."""
+        return msgpack.packb({
+            "t": "schema",
+            "v": PROTOCOL_VERSION,
+            "fields": list(FIELDS),
+            "streams": list(self.key_funcs),
+        })
+
+    def _field_id(self, name: str, new_fields: List[str]) -> int:
+        field_id = self._fields.get(name)
+        if field_id is None:
+            field_id = self._fields[name] = len(self._fields)
+            new_fields.append(name)
+        return field_id
+
+    def encode(self, frame_type: str, streams: Dict[str, List[Dict[str, Any]]], **meta) -> bytes:
+        """
+        Encode one frame. Frame `snapshot` luôn gửi record đầy đủ; các frame
+        khác gửi delta cho record connection này đã nhận trước đó.
+        """
+        full = frame_type == "snapshot"
+        new_fields: List[str] = []
+        data = {}
+        for stream, records in streams.items():
+            key_func = self.key_funcs.get(stream)
+            entries = []
+            for record in records:
+                key = key_func(record) if key_func else None
+                ref = self._refs.get((stream, key)) if key is not None else None
+                if ref is None:
+                    ref = self._next_ref
+                    self._next_ref += 1
+                    if key is not None:
+                        self._refs[(stream, key)] = ref
+                previous = None if full else self._sent.get(ref)
+                if previous is None or record.get("removed"):
+                    kind, fields = FULL, record
+                else:
+                    kind = DELTA
+                    fields = {k: v for k, v in record.items() if k not in previous or previous[k] != v}
+                    if not fields:
+                        continue
+                if record.get("removed"):
+                    # Tombstone: record xuất hiện lại sau đó được gửi đầy đủ
+                    self._sent.pop(ref, None)
+                elif key is not None:
+                    self._sent[ref] = record
+                entries.append([ref, kind, {self._field_id(k, new_fields): v for k, v in fields.items()}])
+            data[stream] = entries
+
+        frame = {"t": frame_type, "d": data, **meta}
+        if new_fields:
+            frame["f"] = new_fields
+        return msgpack.packb(frame, default=str)
+
+
+def decode(frame: bytes, fields: List[str], state: Dict[str, Dict[int, Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    Reference decoder (dùng cho test và làm mẫu cho client).
+
+    `fields` (field dictionary) và `state` (stream → ref → record) được cập
+    nhật tại chỗ. Trả về frame với `d` là danh sách record đầy đủ theo stream.
+    """
+    message = msgpack.unpackb(frame, strict_map_key=False)
+    if message["t"] == "schema":
+        fields[:] = message["fields"]
+        return message
+    fields.extend(message.get("f", ()))
+    records = {}
+    for stream, entries in message.get("d", {}).items():
+        known = state.setdefault(stream, {})
+        records[stream] = []
+        for ref, kind, values in entries:
+            named = {fields[int(i)]: v for i, v in values.items()}
+            record = named if kind == FULL else {**known.get(ref, {}), **named}
+            known[ref] = record
+            records[stream].append(record)
+    message["d"] = records
+    return message
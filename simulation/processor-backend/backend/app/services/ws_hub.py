@@ -0,0 +1,680 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - WebSocket Hub cho /ws/map
+# Một broadcaster tính update mỗi tick (hoặc khi có ingest) rồi fan-out cho mọi socket
+# Update được lọc theo vùng (bbox / bán kính) mà mỗi socket subscribe
+# Mỗi update có `seq`; ring buffer cho phép client reconnect nhận lại phần bị lỡ
+# Ingest event đi qua Redis pub/sub → hub của mọi worker / replica đều push được
+# ======================================================
+
+import os
+import json
+import math
+import time
+import uuid
+import asyncio
+import logging
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+
+from .cache import REDIS_KEY_PREFIX, get_backend
+from .geo_index import bounding_box, haversine_km
+from .payloads import dumps
+from .read_models import LatestReadingStore
+from .ws_codec import MsgpackEncoder
+
+logger = logging.getLogger(__name__)
+
+# Chu kỳ broadcast (giây) khi không có ingest event đánh thức sớm hơn
+WS_BROADCAST_INTERVAL = float(os.getenv("WS_BROADCAST_INTERVAL", "2"))
+# Ô grid của index subscription: 0.05° ≈ 5.5km (viewport một quận phủ vài ô)
+SUBSCRIPTION_CELL_DEG = 0.05
+# Vùng phủ nhiều ô hơn thế này (zoom xa) được kiểm tra tuyến tính
+SUBSCRIPTION_MAX_CELLS = 256
+# Số update gần nhất giữ lại để replay cho client `resume_from`
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "512"))
+# Channel pub/sub chia sẻ ingest event giữa các worker (cùng Redis với cache L2)
+WS_EVENTS_CHANNEL = f"{REDIS_KEY_PREFIX}:ws:ingest"
+# Số record/frame tối đa chờ gửi cho một socket (sau khi đã coalesce)
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "1000"))
+# Socket vượt giới hạn liên tục quá số giây này bị ngắt kèm `resync`
+WS_SLOW_CONSUMER_GRACE = float(os.getenv("WS_SLOW_CONSUMER_GRACE", "5"))
+
+
+@dataclass(frozen=True)
+class Region:
+    """Vùng subscribe của một socket: bbox, hoặc vòng tròn `lat/lng/radius_km`."""
+
+    south: float
+    west: float
+    north: float
+    east: float
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    radius_km: Optional[float] = None
+
+    @classmethod
+    def circle(cls, lat: float, lng: float, radius_km: float) -> "Region":
+        return cls(*bounding_box(lat, lng, radius_km), lat=lat, lng=lng, radius_km=radius_km)
+
+    @classmethod
+    def from_message(cls, data: Dict[str, Any]) -> Optional["Region"]:
+        """
+        Region từ message `init`/`move`: `bbox` = [south, west, north, east]
+        hoặc `lat`/`lng`/`radius` (km). Không có → None (toàn thành phố).
+
+        Raises:
+            ValueError: tham số không hợp lệ
+        """
+        bbox = data.get("bbox")
+        if bbox is not None:
+            try:
+                south, west, north, east = (float(v) for v in bbox)
+            except (TypeError, ValueError):
+                raise ValueError("bbox must be [south, west, north, east]")
+            if south > north or west > east:
+                raise ValueError("bbox must be [south, west, north, east]")
+            return cls(south, west, north, east)
+
+        lat, lng, radius = data.get("lat"), data.get("lng"), data.get("radius")
+        if lat is None or lng is None or not radius:
+            return None
+        try:
+            return cls.circle(float(lat), float(lng), float(radius))
+        except (TypeError, ValueError):
+            raise ValueError("lat, lng and radius must be numbers")
+
+    def contains(self, lat: float, lng: float) -> bool:
+        if not (self.south <= lat <= self.north and self.west <= lng <= self.east):
+            return False
+        if self.radius_km is None:
+            return True
+        return haversine_km(self.lat, self.lng, lat, lng) <= self.radius_km
+
+    def includes(self, record: Dict[str, Any]) -> bool:
+        """Record thuộc vùng? Record không có tọa độ không lọc được → True."""
+        lat, lng = record.get("lat"), record.get("lng")
+        return lat is None or lng is None or self.contains(lat, lng)
+
+
+class _RecordFrame:
+    """
+    Records chờ gửi cho một connection, serialize khi writer lấy ra.
+
+    `records`: stream → {key: record}. Frame `update` còn nằm trong queue nhận
+    thêm update mới (coalesce): record cùng key bị thay bằng bản mới nhất.
+    `text` là frame JSON dùng chung giữa các socket; bỏ đi khi đã gộp thêm.
+    """
+
+    __slots__ = ("frame_type", "records", "meta", "text")
+
+    def __init__(self, frame_type: str, records: Dict[str, Dict[Any, Dict[str, Any]]],
+                 meta: Dict[str, Any], text: Optional[str] = None):
+        self.frame_type = frame_type
+        self.records = records
+        self.meta = meta
+        self.text = text
+
+    def __len__(self) -> int:
+        return sum(len(records) for records in self.records.values())
+
+
+class MapSubscriber:
+    """
+    One /ws/map connection.
+
+    Message ra ngoài đi qua queue + một writer task riêng: thứ tự gửi được giữ
+    nguyên và broadcaster không bao giờ phải chờ socket chậm.
+
+    Queue có giới hạn (`max_depth` record/frame đang chờ):
+    - Update tới khi frame update trước chưa được gửi → gộp vào frame đó, mỗi
+      entity chỉ giữ trạng thái mới nhất (`coalesced` đếm bản bị thay thế)
+    - Vẫn vượt giới hạn liên tục quá `grace` giây → `lagging()`; hub gỡ socket
+      và `evict()` gửi `resync` rồi đóng connection
+    """
+
+    def __init__(
+        self,
+        ws: WebSocket,
+        key_funcs: Optional[Dict[str, Callable[[Dict[str, Any]], Optional[str]]]] = None,
+        max_depth: int = WS_SEND_QUEUE_MAX,
+        grace: float = WS_SLOW_CONSUMER_GRACE
+    ):
+        self.ws = ws
+        self.key_funcs = key_funcs or {}
+        self.max_depth = max_depth
+        self.grace = grace
+        # Chỉ nhận update sau khi đã gửi snapshot (`init`)
+        self.active = False
+        # None = nhận mọi update
+        self.region: Optional[Region] = None
+        # None = JSON text frame; MsgpackEncoder = binary frame (opt-in khi `init`)
+        self.encoder: Optional[MsgpackEncoder] = None
+        self.closed = False
+        self.evicted = False
+        # Số record (hoặc frame dựng sẵn) đang chờ gửi
+        self.depth = 0
+        self.peak_depth = 0
+        self.coalesced = 0
+        self._over_since: Optional[float] = None
+        self._queue: deque = deque()
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._write())
+
+    def _push(self, item, size: int):
+        self._queue.append(item)
+        self._grow(size)
+        self._ready.set()
+
+    def _grow(self, size: int):
+        self.depth += size
+        self.peak_depth = max(self.peak_depth, self.depth)
+        if self.depth > self.max_depth:
+            if self._over_since is None:
+                self._over_since = time.monotonic()
+        else:
+            self._over_since = None
+
+    def send(self, frame):
+        """Queue a frame - str → text, bytes → binary (không chờ socket)."""
+        if not self.closed and not self.evicted:
+            self._push(frame, 1)
+
+    def send_records(
+        self,
+        frame_type: str,
+        streams: Dict[str, List[Dict[str, Any]]],
+        text: Optional[str] = None,
+        **meta
+    ):
+        """
+        Queue records in this connection's protocol (JSON hoặc MessagePack).
+
+        `text`: frame JSON đã serialize sẵn (dùng chung giữa các socket).
+        Frame `update` được gộp vào update trước đó nếu nó vẫn chưa gửi.
+        """
+        if self.closed or self.evicted:
+            return
+        last = self._queue[-1] if self._queue else None
+        if frame_type == "update" and isinstance(last, _RecordFrame) and last.frame_type == "update":
+            added = 0
+            for name, records in streams.items():
+                pending = last.records.setdefault(name, {})
+                for record in records:
+                    key = self._key(name, record)
+                    if key in pending:
+                        self.coalesced += 1
+                    else:
+                        added += 1
+                    pending[key] = record
+            last.meta = meta
+            last.text = None
+            self._grow(added)
+            return
+        records = {name: {self._key(name, r): r for r in rs} for name, rs in streams.items()}
+        frame = _RecordFrame(frame_type, records, meta, text if self.encoder is None else None)
+        self._push(frame, len(frame))
+
+    def _key(self, stream: str, record: Dict[str, Any]) -> Any:
+        key_func = self.key_funcs.get(stream)
+        key = key_func(record) if key_func else None
+        # Không xác định được key → không gộp với record nào khác
+        return key if key is not None else ("id", id(record))
+
+    def _serialize(self, frame: _RecordFrame):
+        if frame.text is not None:
+            return frame.text
+        streams = {name: list(records.values()) for name, records in frame.records.items()}
+        if self.encoder is not None:
+            # Encode lúc gửi: delta tính theo đúng những gì socket đã nhận
+            return self.encoder.encode(frame.frame_type, streams, **frame.meta)
+        return dumps({"type": frame.frame_type, **streams, **frame.meta}).decode("utf-8")
+
+    def lagging(self) -> bool:
+        """Queue vượt `max_depth` liên tục lâu hơn `grace` giây."""
+        return self._over_since is not None and time.monotonic() - self._over_since >= self.grace
+
+    def evict(self, notice: Dict[str, Any]):
+        """Bỏ các frame đang chờ, gửi `notice` (resync) rồi đóng socket."""
+        if self.closed or self.evicted:
+            return
+        self.active = False
+        self._queue.clear()
+        self.depth = 0
+        self._over_since = None
+        self._push(dumps(notice).decode("utf-8"), 1)
+        self.evicted = True
+
+    async def _write(self):
+        try:
+            while True:
+                if not self._queue:
+                    if self.evicted:
+                        # 1013 = Try Again Later: client kết nối lại + snapshot/resume
+                        await self.ws.close(code=1013)
+                        self.closed = True
+                        return
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                item = self._queue.popleft()
+                if isinstance(item, _RecordFrame):
+                    size, frame = len(item), self._serialize(item)
+                else:
+                    size, frame = 1, item
+                self.depth -= size
+                if self.depth <= self.max_depth:
+                    self._over_since = None
+                if isinstance(frame, bytes):
+                    await self.ws.send_bytes(frame)
+                else:
+                    await self.ws.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Socket đã đóng: handler sẽ nhận disconnect và gỡ subscriber
+            logger.debug(f"WebSocket writer stopped: {e}")
+            self.closed = True
+
+    async def close(self):
+        self.closed = True
+        self._writer.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._writer
+
+
+class SubscriptionIndex:
+    """
+    Spatial index of subscriber regions.
+
+    Grid ô → các subscriber có vùng giao với ô, nên mỗi bản ghi thay đổi chỉ
+    được so với vài subscriber gần nó thay vì với mọi socket.
+    """
+
+    def __init__(self, cell_deg: float = SUBSCRIPTION_CELL_DEG, max_cells: int = SUBSCRIPTION_MAX_CELLS):
+        self.cell_deg = cell_deg
+        self.max_cells = max_cells
+        self._cells: Dict[Tuple[int, int], Set[MapSubscriber]] = {}
+        self._large: Set[MapSubscriber] = set()
+        self._placed: Dict[MapSubscriber, List[Tuple[int, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._placed)
+
+    def _cell(self, value: float) -> int:
+        return math.floor(value / self.cell_deg)
+
+    def add(self, subscriber: MapSubscriber, region: Region):
+        self.remove(subscriber)
+        rows = range(self._cell(region.south), self._cell(region.north) + 1)
+        cols = range(self._cell(region.west), self._cell(region.east) + 1)
+        if len(rows) * len(cols) > self.max_cells:
+            self._large.add(subscriber)
+            self._placed[subscriber] = []
+            return
+        cells = [(row, col) for row in rows for col in cols]
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(subscriber)
+        self._placed[subscriber] = cells
+
+    def remove(self, subscriber: MapSubscriber):
+        for cell in self._placed.pop(subscriber, ()):
+            members = self._cells.get(cell)
+            if members is not None:
+                members.discard(subscriber)
+                if not members:
+                    del self._cells[cell]
+        self._large.discard(subscriber)
+
+    def candidates(self, lat: float, lng: float) -> Iterable[MapSubscriber]:
+        """Subscribers whose region may contain the point (cần kiểm tra `contains`)."""
+        cell = self._cells.get((self._cell(lat), self._cell(lng)), ())
+        if not self._large:
+            return cell
+        return [*cell, *self._large]
+
+
+class MapHub:
+    """
+    Single broadcaster for /ws/map.
+
+    - Mỗi tick: refresh store (SWR, dùng chung với REST) → `changed_since_version`
+      một lần → serialize một lần → đưa cùng bytes vào queue của mọi subscriber
+    - Ingest gọi `notify()` để broadcast ngay thay vì chờ hết tick
+    - Số query DB / serialize không phụ thuộc số client đang kết nối
+    - Socket có `region` chỉ nhận bản ghi nằm trong vùng (tra qua
+      `SubscriptionIndex`); các socket nhận cùng tập bản ghi dùng chung một frame
+    - Mỗi update mang `seq` tăng đơn điệu (kèm `epoch` của process); các delta
+      gần nhất nằm trong ring buffer để `resume()` replay thay cho snapshot
+    - Socket chậm không làm chậm broadcaster: update dồn lại được coalesce theo
+      entity trong queue của socket; socket vẫn quá tải bị ngắt kèm `resync`
+    - Nhiều worker: `publish()` gửi record vừa ingest qua pub/sub, hub của worker
+      khác (`listen()`) upsert vào store local rồi broadcast - không cần query DB
+    """
+
+    def __init__(
+        self,
+        streams: Dict[str, LatestReadingStore],
+        refresh: Optional[Callable[[], Awaitable[Any]]] = None,
+        interval: float = WS_BROADCAST_INTERVAL,
+        replay_size: int = WS_REPLAY_BUFFER,
+        backend: Any = None
+    ):
+        self.streams = streams
+        self.refresh = refresh
+        self.interval = interval
+        self._subscribers: Set[MapSubscriber] = set()
+        self._regions = SubscriptionIndex()
+        # Version của mỗi store đã broadcast tới
+        self._cursor: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        # seq của process này; epoch đổi sau restart → seq cũ không còn ý nghĩa
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        # (seq, changes, timestamp) liên tục; không resume được từ seq < _floor
+        self._history: deque = deque(maxlen=replay_size)
+        self._floor = 0
+        # None = backend dùng chung của cache (Redis nếu có `REDIS_URL`)
+        self._backend = backend
+        self._origin = uuid.uuid4().hex
+        self.ticks = 0
+        self.broadcasts = 0
+        self.frames = 0
+        self.resumes = 0
+        self.resume_misses = 0
+        self.evictions = 0
+        self.events_published = 0
+        self.events_received = 0
+        self.publish_errors = 0
+        # Bộ đếm của các socket đã đóng (socket đang mở đọc trực tiếp)
+        self._retired_coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        # Task của event loop khác (vd. TestClient tạo loop mới) → tạo lại
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wake = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    def connect(self, ws: WebSocket) -> MapSubscriber:
+        """Register a socket (chưa nhận update cho tới `start()`)."""
+        subscriber = MapSubscriber(ws, {name: store.key_of for name, store in self.streams.items()})
+        self._subscribers.add(subscriber)
+        self._ensure_running()
+        return subscriber
+
+    def start(self, subscriber: MapSubscriber, versions: Dict[str, int], region: Optional[Region] = None):
+        """
+        Bắt đầu (hoặc đổi vùng - `move`) gửi update cho subscriber vừa nhận
+        snapshot của `region` tại `versions`.
+
+        Cursor của hub lùi về version của snapshot nếu cần, nên tick kế tiếp
+        luôn bao phủ mọi thay đổi sau snapshot (có thể trùng, không bao giờ thiếu).
+        """
+        if any(s.active for s in self._subscribers if s is not subscriber):
+            for name, version in versions.items():
+                self._cursor[name] = min(self._cursor.get(name, version), version)
+        elif any(self._cursor.get(name) != version for name, version in versions.items()):
+            # Không socket nào cần delta từ cursor cũ: nhảy tới version snapshot.
+            # Lịch sử không còn liên tục → seq mới, không resume được từ seq cũ.
+            if self._cursor:
+                self._history.clear()
+                self.seq += 1
+                self._floor = self.seq
+            self._cursor.update(versions)
+        self._attach(subscriber, region)
+
+    def resume(
+        self,
+        subscriber: MapSubscriber,
+        seq: Any,
+        epoch: Optional[str],
+        region: Optional[Region] = None
+    ) -> Optional[int]:
+        """
+        Replay các update sau `seq` (lọc theo `region`) thay cho snapshot.
+
+        Returns:
+            Số update đã replay, hoặc None nếu không resume được (khác epoch,
+            seq không hợp lệ hoặc đã bị đẩy khỏi ring buffer) → client cần snapshot.
+        """
+        if epoch != self.epoch or isinstance(seq, bool) or not isinstance(seq, int) \
+                or not self._floor <= seq <= self.seq:
+            self.resume_misses += 1
+            return None
+        missed = [entry for entry in self._history if entry[0] > seq]
+        if len(missed) != self.seq - seq:
+            self.resume_misses += 1
+            return None
+
+        for entry_seq, changes, timestamp in missed:
+            body = changes if region is None else {
+                name: [r for r in records if region.includes(r)] for name, records in changes.items()
+            }
+            if any(body.values()):
+                subscriber.send_records("update", body, seq=entry_seq, timestamp=timestamp)
+        # Client đã đồng bộ tới cursor hiện tại → tick kế tiếp tiếp tục từ đây
+        self._attach(subscriber, region)
+        self.resumes += 1
+        return len(missed)
+
+    def _attach(self, subscriber: MapSubscriber, region: Optional[Region]):
+        if subscriber.evicted:
+            # Đã bị ngắt: chờ handler nhận disconnect
+            return
+        subscriber.region = region
+        if region is None:
+            self._regions.remove(subscriber)
+        else:
+            self._regions.add(subscriber, region)
+        subscriber.active = True
+
+    def _detach(self, subscriber: MapSubscriber):
+        if subscriber in self._subscribers:
+            self._subscribers.discard(subscriber)
+            self._retired_coalesced += subscriber.coalesced
+        self._regions.remove(subscriber)
+
+    async def disconnect(self, subscriber: MapSubscriber):
+        self._detach(subscriber)
+        await subscriber.close()
+
+    def _evict(self, subscriber: MapSubscriber):
+        """Slow consumer: gỡ khỏi hub, báo client `resync` (resume hoặc snapshot lại)."""
+        self._detach(subscriber)
+        # Không kèm `seq`: client giữ seq cuối đã nhận và resume từ đó
+        subscriber.evict({"type": "resync", "reason": "slow_consumer", "epoch": self.epoch})
+        self.evictions += 1
+        logger.warning(f"WebSocket slow consumer evicted (queue depth {subscriber.peak_depth})")
+
+    def notify(self):
+        """Wake the broadcaster now (gọi sau khi ingest upsert store)."""
+        task = self._task
+        if task is None or task.done():
+            return
+        with suppress(RuntimeError):
+            if task.get_loop() is asyncio.get_running_loop():
+                self._wake.set()
+
+    @property
+    def backend(self):
+        return self._backend if self._backend is not None else get_backend()
+
+    async def publish(self, stream: str, records: List[Dict[str, Any]]):
+        """
+        Ingest event (gọi sau khi đã upsert `records` vào store local): đánh thức
+        broadcaster và gửi records cho hub của các worker khác (một message / batch).
+        """
+        if not records:
+            return
+        self.notify()
+        backend = self.backend
+        if backend is None:
+            return
+        try:
+            await backend.publish(WS_EVENTS_CHANNEL, dumps({
+                "origin": self._origin, "stream": stream, "records": records
+            }).decode("utf-8"))
+            self.events_published += 1
+        except Exception as e:
+            self.publish_errors += 1
+            logger.warning(f"WebSocket event publish failed: {e}")
+
+    def handle_event(self, message: str):
+        """Apply an ingest event published by another worker to the local store."""
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+        if not isinstance(event, dict) or event.get("origin") == self._origin:
+            return
+        store = self.streams.get(event.get("stream"))
+        records = event.get("records")
+        if store is None or not isinstance(records, list):
+            return
+        self.events_received += 1
+        changed = [store.upsert(r) for r in records if isinstance(r, dict)]
+        if any(changed):
+            self.notify()
+
+    async def listen(self):
+        """Subscribe to ingest events from other workers (gọi khi startup)."""
+        backend = self.backend
+        if backend is None:
+            return
+        try:
+            await backend.subscribe(WS_EVENTS_CHANNEL, self.handle_event)
+        except Exception as e:
+            logger.warning(f"Cannot subscribe to WebSocket events: {e}")
+
+    async def _run(self):
+        # Dừng khi không còn socket nào; connect() sau đó khởi động lại
+        while self._subscribers:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            self._wake.clear()
+            try:
+                await self.broadcast_once()
+            except Exception as e:
+                logger.error(f"WebSocket broadcast error: {e}", exc_info=True)
+
+    async def broadcast_once(self) -> int:
+        """Compute one update and fan it out. Returns number of sockets reached."""
+        if self.refresh is not None and any(s.active for s in self._subscribers):
+            await self.refresh()
+        self.ticks += 1
+
+        # Từ đây không còn await: subscriber `start()` trong lúc refresh vẫn được tính
+        active = [s for s in self._subscribers if s.active and not s.closed]
+        if not active:
+            # Giữ cursor: delta tick sau vẫn liên tục cho client resume
+            return 0
+
+        changes = {}
+        for name, store in self.streams.items():
+            version = store.version
+            since = self._cursor.get(name, version)
+            changes[name] = store.changed_since_version(since) if since != version else []
+            self._cursor[name] = version
+
+        if not any(changes.values()):
+            return 0
+
+        self.seq += 1
+        timestamp = datetime.now(timezone.utc).isoformat()
+        self._history.append((self.seq, changes, timestamp))
+        routes = self._route(changes, {s for s in active if s.region is not None})
+        # Serialize JSON một lần cho mỗi tập bản ghi khác nhau (None = toàn bộ);
+        # connection binary encode riêng vì delta phụ thuộc những gì socket đã nhận
+        frames: Dict[Optional[Tuple[Tuple[int, ...], ...]], str] = {}
+        reached = 0
+        for subscriber in active:
+            selection = routes.get(subscriber)
+            if selection is not None and not any(selection):
+                continue
+            if selection is None:
+                body = changes
+            else:
+                body = {name: [changes[name][i] for i in idx] for name, idx in zip(changes, selection)}
+            text = None
+            if subscriber.encoder is None:
+                text = frames.get(selection)
+                if text is None:
+                    text = frames[selection] = dumps({
+                        "type": "update", **body, "seq": self.seq, "timestamp": timestamp
+                    }).decode("utf-8")
+            subscriber.send_records("update", body, text=text, seq=self.seq, timestamp=timestamp)
+            if subscriber.lagging():
+                self._evict(subscriber)
+                continue
+            reached += 1
+
+        self.broadcasts += 1
+        self.frames += len(frames)
+        return reached
+
+    def _route(
+        self,
+        changes: Dict[str, List[Dict[str, Any]]],
+        regional: Set[MapSubscriber]
+    ) -> Dict[MapSubscriber, Tuple[Tuple[int, ...], ...]]:
+        """Indices of changed records inside each regional subscriber's region."""
+        if not regional:
+            return {}
+        routed = {s: tuple([] for _ in changes) for s in regional}
+        for n, records in enumerate(changes.values()):
+            for i, record in enumerate(records):
+                lat, lng = record.get("lat"), record.get("lng")
+                if lat is None or lng is None:
+                    # Không có tọa độ → không lọc được, gửi cho mọi vùng
+                    targets = regional
+                else:
+                    targets = [
+                        s for s in self._regions.candidates(lat, lng)
+                        if s in regional and s.region.contains(lat, lng)
+                    ]
+                for subscriber in targets:
+                    routed[subscriber][n].append(i)
+        return {s: tuple(tuple(idx) for idx in lists) for s, lists in routed.items()}
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            with suppress(asyncio.CancelledError, RuntimeError):
+                await self._task
+        for subscriber in list(self._subscribers):
+            with suppress(RuntimeError):
+                await self.disconnect(subscriber)
+
+    def stats(self) -> dict:
+        depths = [s.depth for s in self._subscribers]
+        return {
+            "connections": len(self._subscribers),
+            "active": sum(1 for s in self._subscribers if s.active),
+            "regional": len(self._regions),
+            "ticks": self.ticks,
+            "broadcasts": self.broadcasts,
+            "frames": self.frames,
+            "seq": self.seq,
+            "replay_buffer": len(self._history),
+            "resumes": self.resumes,
+            "resume_misses": self.resume_misses,
+            "queue_depth": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "coalesced": self._retired_coalesced + sum(s.coalesced for s in self._subscribers),
+            "evictions": self.evictions,
+            "events_published": self.events_published,
+            "events_received": self.events_received,
+            "publish_errors": self.publish_errors,
+        }
@@ -0,0 +1,185 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+# ======================================================
+# FloodWatch - Zone Lookup (point-in-polygon)
+# Gán điểm (crowd report, tọa độ bất kỳ) vào polygon FLOOD_ZONES
+# ======================================================
+
+import os
+import math
+import logging
+import importlib.util
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Thư mục chứa flood_zones.py (simulation/water_level_sensor). Trong Docker được mount vào
+# /app/flood_zones; khi chạy từ source thì tìm theo đường dẫn tương đối trong repo.
+FLOOD_ZONES_DIR = os.getenv(
+    "FLOOD_ZONES_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "..", "..", "..", "water_level_sensor")
+)
+# Ô grid 0.01° ≈ 1.1km (zone là đoạn đường/khu vực vài trăm mét)
+ZONE_GRID_DEG = 0.01
+
+
+class ZoneLookup:
+    """
+    Point-in-polygon engine over flood zone polygons.
+
+    - Bounding box của từng polygon dựng sẵn → loại nhanh điểm ở xa
+    - Grid index: ô → các zone có bbox giao với ô (tra một điểm O(1);
+      batch điểm được gom theo ô, mỗi ô chỉ thử zone ứng viên của nó)
+    - Ray casting vectorized (NumPy) cho cả batch điểm
+    - Zone khai báo trước thắng nếu các polygon chồng nhau
+    """
+
+    def __init__(self, zones: Sequence[Dict[str, Any]], cell_deg: float = ZONE_GRID_DEG):
+        self.cell_deg = cell_deg
+        self.zones: List[Dict[str, Any]] = []
+        self._polygons: List[Tuple[np.ndarray, np.ndarray]] = []
+        bboxes = []
+
+        for zone in zones:
+            polygon = np.asarray(zone["polygon"], dtype=np.float64)
+            if polygon.ndim != 2 or len(polygon) < 3:
+                logger.warning(f"Zone {zone.get('id')} has an invalid polygon - skipped")
+                continue
+            self.zones.append({k: zone.get(k) for k in ("id", "name", "district")})
+            self._polygons.append((polygon[:, 0], polygon[:, 1]))
+            bboxes.append((polygon[:, 0].min(), polygon[:, 0].max(), polygon[:, 1].min(), polygon[:, 1].max()))
+
+        self._bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        self._grid: Dict[Tuple[int, int], List[int]] = {}
+        for i, (lat_min, lat_max, lng_min, lng_max) in enumerate(self._bboxes):
+            for row in range(self._cell(lat_min), self._cell(lat_max) + 1):
+                for col in range(self._cell(lng_min), self._cell(lng_max) + 1):
+                    self._grid.setdefault((row, col), []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.zones)
+
+    def _cell(self, value: float) -> int:
+        return math.floor(value / self.cell_deg)
+
+    def _contains(self, i: int, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+        """Vectorized ray casting: mask of points inside polygon `i`."""
+        poly_lat, poly_lng = self._polygons[i]
+        lat1, lng1 = poly_lat, poly_lng
+        lat2, lng2 = np.roll(poly_lat, -1), np.roll(poly_lng, -1)
+        py, px = lats[:, None], lngs[:, None]
+        crosses = (lat1 > py) != (lat2 > py)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_at = (lng2 - lng1) * (py - lat1) / (lat2 - lat1) + lng1
+        return np.count_nonzero(crosses & (px < x_at), axis=1) % 2 == 1
+
+    def lookup_many(self, lats: Sequence[float], lngs: Sequence[float]) -> List[Optional[Dict[str, Any]]]:
+        """
+        Zone (id/name/district) for each point, or None if outside every zone.
+
+        Điểm được gom theo ô grid; mỗi ô chỉ thử các zone có bbox giao với ô
+        đó (ray casting vectorized cho cả nhóm điểm trong ô).
+        """
+        lats = np.asarray(lats, dtype=np.float64).reshape(-1)
+        lngs = np.asarray(lngs, dtype=np.float64).reshape(-1)
+        result = np.full(len(lats), -1, dtype=np.int64)
+
+        points = np.flatnonzero(np.isfinite(lats) & np.isfinite(lngs))
+        if len(points) and self._grid:
+            cells = np.stack([
+                np.floor(lats[points] / self.cell_deg),
+                np.floor(lngs[points] / self.cell_deg),
+            ], axis=1).astype(np.int64)
+            unique_cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            # Điểm sắp theo ô: điểm của ô c nằm trong order[bounds[c]:bounds[c + 1]]
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.searchsorted(inverse[order], np.arange(len(unique_cells) + 1))
+
+            for c, (row, col) in enumerate(unique_cells.tolist()):
+                zone_ids = self._grid.get((row, col))
+                if not zone_ids:
+                    continue
+                members = points[order[bounds[c]:bounds[c + 1]]]
+                # Zone khai báo trước thắng: grid giữ thứ tự khai báo
+                for i in zone_ids:
+                    lat_min, lat_max, lng_min, lng_max = self._bboxes[i]
+                    pending = members[result[members] < 0]
+                    candidates = pending[
+                        (lats[pending] >= lat_min) & (lats[pending] <= lat_max)
+                        & (lngs[pending] >= lng_min) & (lngs[pending] <= lng_max)
+                    ]
+                    if len(candidates):
+                        inside = self._contains(i, lats[candidates], lngs[candidates])
+                        result[candidates[inside]] = i
+
+        return [self.zones[i] if i >= 0 else None for i in result.tolist()]
+
+    def lookup(self, lat: float, lng: float) -> Optional[Dict[str, Any]]:
+        """Zone containing one point (grid → candidate zones → ray casting)."""
+        if lat is None or lng is None:
+            return None
+        point_lat, point_lng = np.array([lat], dtype=np.float64), np.array([lng], dtype=np.float64)
+        for i in self._grid.get((self._cell(lat), self._cell(lng)), ()):
+            lat_min, lat_max, lng_min, lng_max = self._bboxes[i]
+            if lat_min <= lat <= lat_max and lng_min <= lng <= lng_max and self._contains(i, point_lat, point_lng)[0]:
+                return self.zones[i]
+        return None
+
+    def assign(self, records: List[Dict[str, Any]]) -> int:
+        """
+        Set `zoneid`/`zonename`/`district` on records (lat/lng) that fall in a zone.
+        Field đã có giá trị được giữ nguyên. Returns number of records assigned.
+        """
+        located = [r for r in records if r.get("lat") is not None and r.get("lng") is not None]
+        if not located or not self.zones:
+            return 0
+        zones = self.lookup_many([r["lat"] for r in located], [r["lng"] for r in located])
+        assigned = 0
+        for record, zone in zip(located, zones):
+            if zone is None:
+                continue
+            record.setdefault("zoneid", zone["id"])
+            record.setdefault("zonename", zone["name"])
+            record.setdefault("district", zone["district"])
+            assigned += 1
+        return assigned
+
+
+def load_flood_zones(directory: str = FLOOD_ZONES_DIR) -> List[Dict[str, Any]]:
+    """
+    Load zone polygons from `flood_zones.py` (FLOOD_ZONES dataclasses).
+
+    Không tìm thấy file → [] (gán zone bị tắt, backend vẫn chạy).
+    """
+    path = os.path.join(directory, "flood_zones.py")
+    if not os.path.exists(path):
+        logger.warning(f"flood_zones.py not found at {path} - zone lookup disabled")
+        return []
+    try:
+        spec = importlib.util.spec_from_file_location("floodwatch_flood_zones", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except Exception as e:
+        logger.error(f"Cannot load flood zones from {path}: {e}")
+        return []
+    return [
+        {"id": zone.id, "name": zone.name, "district": zone.district,
+         "polygon": zone.polygon, "center": zone.center}
+        for zone in module.FLOOD_ZONES.values()
+    ]
+
+
+_zone_lookup: Optional[ZoneLookup] = None
+
+
+def get_zone_lookup() -> ZoneLookup:
+    """Shared ZoneLookup built once from FLOOD_ZONES_DIR."""
+    global _zone_lookup
+    if _zone_lookup is None:
+        _zone_lookup = ZoneLookup(load_flood_zones())
+        logger.info(f"Zone lookup ready: {len(_zone_lookup)} polygons")
+    return _zone_lookup
@@ -11,6 +11,7 @@ Chạy tests:
     pytest tests/test_api.py -v
 """
 
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
 import sys
@@ -47,6 +48,16 @@ class TestHealthEndpoints:
         assert data["status"] in ["healthy", "degraded", "unhealthy"]
         assert "timestamp" in data
 
+    def test_metrics_endpoint(self):
+        """Test metrics endpoint trả về thống kê cache"""
+        response = client.get("/api/metrics")
+        assert response.status_code == 200
+
+        data = response.json()
+        assert "snapshot" in data["caches"]
+        assert "hits" in data["caches"]["snapshot"]
+        assert "stores" in data
+
 
 class TestDashboardEndpoints:
     """Test dashboard statistics endpoints."""
@@ -82,6 +93,16 @@ class TestDashboardEndpoints:
         response = client.get("/api/dashboard/districts")
         
         assert response.status_code in [200, 500]
+    
+    def test_dashboard_stats_etag_not_modified(self):
+        """Test If-None-Match với ETag hiện tại → 304"""
+        response = client.get("/api/dashboard/stats")
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        
+        cached = client.get("/api/dashboard/stats", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        assert cached.headers["etag"] == etag
 
 
 class TestFloodDataEndpoints:
@@ -122,6 +143,320 @@ class TestFloodDataEndpoints:
         """Test nearby floods thiếu params bắt buộc"""
         response = client.get("/api/flood/nearby")
         assert response.status_code == 422  # Validation error
+    
+    def test_map_clusters_tile(self):
+        """Test tile cluster: tile hợp lệ → 200 + ETag, tile ngoài phạm vi → 400"""
+        response = client.get("/api/map/clusters/12/3261/1913")
+        assert response.status_code in [200, 500]
+        if response.status_code == 200:
+            data = response.json()
+            assert "clusters" in data
+            assert "points" in data
+            assert "etag" in response.headers
+        
+        response = client.get("/api/map/clusters/2/4/0")
+        assert response.status_code == 400
+    
+    def test_nearby_floods_db_source(self, monkeypatch):
+        """Test source=db: lọc trong CrateDB, dedupe tọa độ, distance m → km"""
+        from app import main
+        queries = []
+        
+        async def fake_fetch(query, *args, **kwargs):
+            queries.append((query, args))
+            if "etfloodriskcrowd" in query:
+                return [
+                    {"entity_id": "new", "lat": 10.7627, "lng": 106.6602, "calculatedat": 2000, "distance_m": 12.0},
+                    {"entity_id": "old", "lat": 10.7627, "lng": 106.6602, "calculatedat": 1000, "distance_m": 12.0},
+                ]
+            return []
+        
+        monkeypatch.setattr(main.cratedb, "fetch", fake_fetch)
+        response = client.get(
+            "/api/flood/nearby",
+            params={"lat": 10.762622, "lng": 106.660172, "radius": 2.0, "source": "db"}
+        )
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert [r["entity_id"] for r in data["crowd_reports"]] == ["new"]
+        assert data["crowd_reports"][0]["distance_km"] == 0.01
+        assert all("distance(" in q for q, _ in queries)
+        assert queries[0][1][:2] == ("POINT(106.660172 10.762622)", 2000.0)
+    
+    def test_nearby_db_source_sensor_fallback(self, monkeypatch):
+        """Test source=db: chưa có bảng WaterLevelObserved → FloodRiskSensor trong bán kính"""
+        import asyncpg
+        from app import main
+        queried = []
+        
+        async def fake_fetch(query, *args, **kwargs):
+            if "etwaterlevelobserved" in query:
+                raise asyncpg.UndefinedTableError("Relation 'doc.etwaterlevelobserved' unknown")
+            if "etfloodrisksensor" in query:
+                queried.append(query)
+                return [
+                    {"entity_id": "s-new", "zoneid": "zone-a", "lat": 10.763, "lng": 106.661,
+                     "severity": "High", "updatedat": 2000, "distance_m": 150.0},
+                    {"entity_id": "s-old", "zoneid": "zone-a", "lat": 10.763, "lng": 106.661,
+                     "severity": "Low", "updatedat": 1000, "distance_m": 150.0},
+                ]
+            return []
+        
+        monkeypatch.setattr(main.cratedb, "fetch", fake_fetch)
+        response = client.get(
+            "/api/flood/nearby",
+            params={"lat": 10.762622, "lng": 106.660172, "radius": 2.0, "source": "db"}
+        )
+        
+        assert response.status_code == 200
+        sensors = response.json()["sensor_data"]
+        assert [(r["entity_id"], r["distance_km"]) for r in sensors] == [("s-new", 0.15)]
+        assert "distance(" in queried[0]
+    
+    def test_stats_db_source_requires_radius(self):
+        """Test source=db thiếu lat/lng/radius → 400"""
+        response = client.get("/api/dashboard/stats", params={"source": "db"})
+        assert response.status_code == 400
+
+
+class FakeOrion:
+    """Orion-LD giả: ghi lại các lô upsert."""
+
+    def __init__(self, reject=()):
+        self.batches = []
+        self.reject = set(reject)
+
+    async def upsert_entities(self, entities):
+        self.batches.append(entities)
+        errors = [{"entityId": e["id"], "error": "BadRequestData"} for e in entities if e["id"] in self.reject]
+        return {
+            "status": 207 if errors else 201,
+            "success": [e["id"] for e in entities if e["id"] not in self.reject],
+            "errors": errors,
+        }
+
+    def stats(self):
+        return {"upsert_batches": len(self.batches)}
+
+
+class TestIngestBatch:
+    """Test xử lý cả notification `data[]` + batch upsert."""
+
+    def sensor_entity(self, zone, level, lng=106.70, observed_at="2025-01-01T10:00:00Z"):
+        return {
+            "id": f"urn:ngsi-ld:WaterLevelObserved:{zone}",
+            "type": "WaterLevelObserved",
+            "waterLevel": {"value": level, "observedAt": observed_at},
+            "alertThreshold": {"value": 0.5},
+            "zoneId": {"value": zone},
+            "location": {"type": "GeoProperty", "value": {"type": "Point", "coordinates": [lng, 10.77]}},
+        }
+
+    def test_sensor_notification_single_upsert(self, monkeypatch):
+        """3 entity (1 thiếu waterLevel) → 202, queue ghi 1 request upsert gồm 2 entity, read model có cả 2"""
+        from app import main
+        orion = FakeOrion()
+        monkeypatch.setattr(main, "get_orion", lambda: orion)
+        invalid = {"id": "urn:ngsi-ld:WaterLevelObserved:broken", "location": {}}
+
+        response = client.post("/flood/sensor", json={"data": [
+            self.sensor_entity("batch-a", 0.7), invalid, self.sensor_entity("batch-b", 0.2, 106.71)
+        ]})
+
+        assert response.status_code == 202
+        data = response.json()
+        assert data["status"] == "partial"
+        assert data["queued"] == 2
+        assert [s["id"] for s in data["skipped"]] == ["urn:ngsi-ld:WaterLevelObserved:broken"]
+        assert data["entity_id"] == data["entities"][0]["entity_id"]
+
+        # Worker nền chạy trên loop của request; flush phần còn lại ở đây
+        asyncio.run(main.ingest_queue.drain())
+        assert len(orion.batches) == 1 and len(orion.batches[0]) == 2
+        zones = {r["zoneid"]: r["waterlevel"] for r in main.sensor_state.snapshot()}
+        assert zones["batch-a"] == 0.7 and zones["batch-b"] == 0.2
+
+    def test_repeated_notifications_upsert_same_entity(self, monkeypatch):
+        """Hai notification của cùng sensor → cùng entity id; trong một batch chỉ gửi một lần"""
+        from app import main
+        orion = FakeOrion()
+        monkeypatch.setattr(main, "get_orion", lambda: orion)
+        first = client.post("/flood/sensor", json={"data": [self.sensor_entity("stable-a", 0.3)]}).json()
+        second = client.post("/flood/sensor", json={"data": [
+            self.sensor_entity("stable-a", 0.6, observed_at="2025-01-01T10:05:00Z")
+        ]}).json()
+        assert first["entity_id"] == second["entity_id"] == "urn:ngsi-ld:FloodRiskSensor:stable-a"
+
+        asyncio.run(main.ingest_queue.drain())
+        sent = [e for batch in orion.batches for e in batch]
+        assert [e["waterLevel"]["value"] for e in sent if e["id"] == first["entity_id"]][-1] == 0.6
+        assert all(len({e["id"] for e in batch}) == len(batch) for batch in orion.batches)
+
+    def test_resent_notification_suppressed(self, monkeypatch):
+        """Orion-LD gửi lại cùng lần đo → 202 "duplicate", không tính lại / ghi lại Orion-LD"""
+        from app import main
+        orion = FakeOrion()
+        monkeypatch.setattr(main, "get_orion", lambda: orion)
+        suppressed = main.ingest_dedup.suppressed
+        notification = {"data": [self.sensor_entity("dedup-a", 0.4, observed_at="2025-01-02T08:00:00Z")]}
+
+        first = client.post("/flood/sensor", json=notification).json()
+        monkeypatch.setattr(main, "build_flood_sensor", lambda data: pytest.fail("duplicate was rescored"))
+        second = client.post("/flood/sensor", json=notification)
+
+        assert first["queued"] == 1 and first["duplicates"] == 0
+        assert second.status_code == 202
+        assert second.json()["status"] == "duplicate"
+        assert second.json()["entity_id"] == first["entity_id"]
+        asyncio.run(main.ingest_queue.drain())
+        assert sum(len(batch) for batch in orion.batches) == 1
+        metrics = client.get("/api/metrics").json()
+        assert metrics["ingest"]["dedup"]["suppressed"] == suppressed + 1
+
+    def test_rejected_entity_releases_dedup_key(self, monkeypatch):
+        """Orion-LD từ chối entity (207) → bỏ đánh dấu dedup, lần gửi lại được xử lý"""
+        from app import main
+        notification = {"data": [self.sensor_entity("dedup-rejected", 0.4, observed_at="2025-01-03T08:00:00Z")]}
+        derived_id = main.derived_entity_id("FloodRiskSensor", notification["data"][0]["id"])
+        orion = FakeOrion(reject=[derived_id])
+        monkeypatch.setattr(main, "get_orion", lambda: orion)
+
+        first = client.post("/flood/sensor", json=notification).json()
+        asyncio.run(main.ingest_queue.drain())
+        orion.reject.clear()
+        second = client.post("/flood/sensor", json=notification).json()
+        asyncio.run(main.ingest_queue.drain())
+
+        assert first["queued"] == 1 and second["queued"] == 1 and second["duplicates"] == 0
+        assert [[e["id"] for e in batch] for batch in orion.batches] == [[derived_id], [derived_id]]
+        assert any(r.get("zoneid") == "dedup-rejected" for r in main.sensor_state.snapshot())
+
+    def test_failed_chunk_requeues_only_unwritten(self, monkeypatch):
+        """Lô upsert thứ 2 lỗi tạm thời → lô 1 vào read model, chỉ item lô 2 được queue thử lại"""
+        from app import main
+        from app.services.ingest_queue import PartialFlush
+        from app.services.orion_client import OrionUnavailable
+
+        class ChunkFailingOrion(FakeOrion):
+            async def upsert_entities(self, entities):
+                self.batches.append(entities)
+                error = OrionUnavailable("Orion-LD 503", 503)
+                error.partial = {"status": 201, "success": [entities[0]["id"]], "errors": []}
+                raise error
+
+        monkeypatch.setattr(main, "get_orion", lambda: ChunkFailingOrion())
+        items = []
+        for zone in ("chunk-a", "chunk-b"):
+            entity = self.sensor_entity(zone, 0.3, observed_at="2025-01-05T08:00:00Z")
+            key = main.notification_key(entity, "2025-01-05T08:00:00Z")
+            assert main.ingest_dedup.claim(key)
+            derived, record = main.build_flood_sensor(entity)
+            items.append(("sensor", derived, record, key))
+
+        with pytest.raises(PartialFlush) as raised:
+            asyncio.run(main.flush_ingest(items))
+
+        assert raised.value.unsent == [items[1]]
+        zones = {r["zoneid"] for r in main.sensor_state.snapshot()}
+        assert "chunk-a" in zones and "chunk-b" not in zones
+        # Cả hai vẫn giữ dedup: a đã ghi, b sẽ được thử lại
+        assert items[0][3] in main.ingest_dedup and items[1][3] in main.ingest_dedup
+
+    def test_photo_derivatives_update_not_rescored(self, monkeypatch):
+        """Notification chỉ do backend ghi photoDerivatives → "duplicate", không tính lại report"""
+        from app import main
+        orion = FakeOrion()
+        monkeypatch.setattr(main, "get_orion", lambda: orion)
+        monkeypatch.setattr(main, "build_flood_crowd", lambda entity: pytest.fail("derivative update was rescored"))
+        created = "2025-01-04T08:00:00.000Z"
+        report = {
+            "id": "urn:ngsi-ld:CrowdReport:derived-only",
+            "type": "CrowdReport",
+            "modifiedAt": "2025-01-04T08:00:03.000Z",
+            "waterLevel": {"type": "Property", "value": 0.4, "modifiedAt": created},
+            "description": {"type": "Property", "value": "Ngập 40cm", "modifiedAt": created},
+            "location": {"type": "GeoProperty", "value": {"type": "Point", "coordinates": [106.70, 10.77]},
+                         "modifiedAt": created},
+            "https://uri.etsi.org/ngsi-ld/default-context/photoDerivatives": {
+                "type": "Property", "value": [], "modifiedAt": "2025-01-04T08:00:03.000Z"
+            },
+        }
+
+        response = client.post("/flood/crowd", json={"data": [report]})
+
+        assert response.status_code == 202
+        assert response.json()["status"] == "duplicate"
+        asyncio.run(main.ingest_queue.drain())
+        assert orion.batches == []
+
+    def test_ingest_invalidates_snapshot_rows(self, monkeypatch):
+        """Ingest ghi sensor → row snapshot sensor trong cache bị xóa, crowd giữ nguyên"""
+        from app import main
+        orion = FakeOrion()
+        monkeypatch.setattr(main, "get_orion", lambda: orion)
+
+        async def seed():
+            await main.snapshot_rows_cache.set("sensor", [{"zoneid": "stale"}])
+            await main.snapshot_rows_cache.set("crowd", [{"id": "stale"}])
+
+        asyncio.run(seed())
+        client.post("/flood/sensor", json={"data": [self.sensor_entity("rows-a", 0.3)]})
+        asyncio.run(main.ingest_queue.drain())
+
+        assert asyncio.run(main.snapshot_rows_cache.get("sensor")) is None
+        assert asyncio.run(main.snapshot_rows_cache.get("crowd")) == [{"id": "stale"}]
+        main.snapshot_rows_cache.clear()
+
+    def test_sensor_notification_all_invalid(self, monkeypatch):
+        """Không entity hợp lệ → 400, không gọi Orion-LD"""
+        from app import main
+        orion = FakeOrion()
+        monkeypatch.setattr(main, "get_orion", lambda: orion)
+        response = client.post("/flood/sensor", json={"data": [{"id": "x"}]})
+        assert response.status_code == 400
+        assert orion.batches == []
+
+
+class TestWebSocketMap:
+    """Test /ws/map."""
+    
+    def test_init_snapshot_then_pushed_update(self):
+        """Test init → snapshot; ingest upsert → update được server push (không cần poll)"""
+        from app import main
+        
+        with client.websocket_connect("/ws/map") as ws:
+            ws.send_json({"type": "init"})
+            snapshot = ws.receive_json()
+            assert snapshot["type"] == "snapshot"
+            assert "crowd" in snapshot and "sensor" in snapshot
+            assert "seq" in snapshot and "epoch" in snapshot
+            
+            ws.send_json({"type": "poll"})
+            main.sensor_state.upsert({
+                "entity_id": "ws-test", "zoneid": "ws-test-zone",
+                "lat": 10.77, "lng": 106.69, "waterlevel": 0.5, "updatedat": main.now_ms()
+            })
+            update = ws.receive_json()
+            assert update["type"] == "update"
+            assert any(r["zoneid"] == "ws-test-zone" for r in update["sensor"])
+            assert update["seq"] > snapshot["seq"]
+    
+    def test_msgpack_protocol_negotiation(self):
+        """Test init với protocol=msgpack → frame schema rồi snapshot binary"""
+        msgpack = pytest.importorskip("msgpack")
+        
+        with client.websocket_connect("/ws/map") as ws:
+            ws.send_json({"type": "init", "protocol": "msgpack"})
+            schema = msgpack.unpackb(ws.receive_bytes())
+            assert schema["t"] == "schema"
+            assert "waterlevel" in schema["fields"]
+            snapshot = msgpack.unpackb(ws.receive_bytes(), strict_map_key=False)
+            assert snapshot["t"] == "snapshot"
+            assert set(snapshot["d"]) == {"crowd", "sensor"}
+            
+            ws.send_json({"type": "move", "bbox": [10.8, 106.6, 10.7, 106.7]})
+            assert ws.receive_json()["type"] == "error"
 
 
 class TestPredictionEndpoints:
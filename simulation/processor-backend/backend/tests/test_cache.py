@@ -0,0 +1,238 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Cache Layer
+===========================
+Kiểm tra stale-while-revalidate và single-flight của SWRCache,
+cache hai tầng TieredCache (L1 + L2 dùng chung).
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_cache.py -v
+"""
+
+import asyncio
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services import cache as cache_module
+from app.services.cache import MemoryBackend, SWRCache, TieredCache
+
+
+class CountingLoader:
+    """Loader giả lập query chậm, đếm số lần được gọi."""
+
+    def __init__(self, delay: float = 0.01, fail: bool = False):
+        self.calls = 0
+        self.delay = delay
+        self.fail = fail
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("db down")
+        return self.calls
+
+
+class TestSWRCache:
+    """Test class cho SWRCache."""
+
+    def test_single_flight_on_miss(self):
+        """Nhiều request đồng thời khi cache trống → chỉ một lần load"""
+        cache = SWRCache(ttl=30)
+        loader = CountingLoader()
+
+        async def run():
+            return await asyncio.gather(*(cache.get("sensor", loader) for _ in range(20)))
+
+        results = asyncio.run(run())
+        assert loader.calls == 1
+        assert results == [1] * 20
+        stats = cache.stats()
+        assert stats["misses"] == 20
+        assert stats["refreshes"] == 1
+
+    def test_fresh_entry_is_hit(self):
+        """Entry còn mới → không gọi loader"""
+        cache = SWRCache(ttl=30)
+        loader = CountingLoader()
+
+        async def run():
+            await cache.get("sensor", loader)
+            return await cache.get("sensor", loader)
+
+        assert asyncio.run(run()) == 1
+        assert loader.calls == 1
+        assert cache.stats()["hits"] == 1
+
+    def test_stale_served_while_refreshing(self):
+        """Entry cũ → trả dữ liệu cũ ngay, refresh chạy nền một lần"""
+        cache = SWRCache(ttl=0)
+        loader = CountingLoader()
+
+        async def run():
+            await cache.get("sensor", loader)
+            stale = await asyncio.gather(*(cache.get("sensor", loader) for _ in range(5)))
+            await asyncio.sleep(0.05)
+            return stale
+
+        assert asyncio.run(run()) == [1] * 5
+        assert loader.calls == 2
+        assert cache.stats()["stale_hits"] == 5
+
+    def test_expired_beyond_stale_ttl_waits(self):
+        """Quá stale_ttl → chờ load mới thay vì trả dữ liệu cũ"""
+        cache = SWRCache(ttl=0, stale_ttl=0)
+        loader = CountingLoader()
+
+        async def run():
+            await cache.get("sensor", loader)
+            return await cache.get("sensor", loader)
+
+        assert asyncio.run(run()) == 2
+
+    def test_refresh_error_keeps_stale_value(self):
+        """Refresh lỗi → vẫn phục vụ dữ liệu cũ, đếm lỗi"""
+        cache = SWRCache(ttl=0)
+        loader = CountingLoader()
+
+        async def run():
+            await cache.get("sensor", loader)
+            loader.fail = True
+            value = await cache.get("sensor", loader)
+            await asyncio.sleep(0.05)
+            return value
+
+        assert asyncio.run(run()) == 1
+        assert cache.stats()["errors"] == 1
+
+    def test_miss_error_propagates(self):
+        """Load lần đầu lỗi → exception cho caller"""
+        cache = SWRCache(ttl=30)
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(cache.get("sensor", CountingLoader(fail=True)))
+        assert cache.stats()["inflight"] == 0
+
+    def test_stats_report_age(self):
+        """stats() có tuổi dữ liệu theo từng key"""
+        cache = SWRCache(ttl=30, name="snapshot")
+        asyncio.run(cache.get("crowd", CountingLoader(delay=0)))
+        stats = cache.stats()
+        assert stats["name"] == "snapshot"
+        assert stats["age_seconds"]["crowd"] >= 0
+
+
+class BrokenBackend(MemoryBackend):
+    """L2 luôn lỗi (Redis mất kết nối)."""
+
+    async def get(self, key):
+        raise ConnectionError("redis down")
+
+    async def set(self, key, value, ttl):
+        raise ConnectionError("redis down")
+
+
+class TestTieredCache:
+    """Test class cho TieredCache (L1 per worker + L2 dùng chung)."""
+
+    def test_l2_shared_between_workers(self):
+        """Worker thứ hai đọc từ L2 → loader chỉ chạy một lần cho cả cluster"""
+        backend = MemoryBackend()
+        worker_a = TieredCache("weather_a", ttl=60, backend=backend)
+        worker_b = TieredCache("weather_a", ttl=60, backend=backend)
+        loader = CountingLoader()
+
+        async def run():
+            first = await worker_a.get_or_load("q1", lambda: loader())
+            second = await worker_b.get_or_load("q1", lambda: loader())
+            return first, second
+
+        assert asyncio.run(run()) == (1, 1)
+        assert loader.calls == 1
+        assert worker_b.stats()["l2_hits"] == 1
+
+    def test_versioned_keys_isolated(self):
+        """Đổi version → không đọc dữ liệu format cũ"""
+        backend = MemoryBackend()
+        v1 = TieredCache("weather_v", ttl=60, version=1, backend=backend)
+        v2 = TieredCache("weather_v", ttl=60, version=2, backend=backend)
+
+        async def run():
+            await v1.set("q1", {"temp": 30})
+            return await v2.get("q1")
+
+        assert asyncio.run(run()) is None
+
+    def test_empty_value_not_cached(self):
+        """Loader trả None (lỗi upstream) → lần sau gọi lại"""
+        cache = TieredCache("weather_none", ttl=60, backend=MemoryBackend())
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            return None
+
+        async def run():
+            await cache.get_or_load("q1", loader)
+            await cache.get_or_load("q1", loader)
+
+        asyncio.run(run())
+        assert len(calls) == 2
+
+    def test_invalidation_reaches_other_workers(self):
+        """invalidate() xóa L2 và L1 của worker khác qua pub/sub"""
+        backend = MemoryBackend()
+        cache = TieredCache("weather_inv", ttl=60, backend=backend)
+
+        async def run():
+            await cache.set("q1", {"temp": 30})
+            # Mô phỏng message từ một worker khác
+            cache_module.handle_invalidation(
+                '{"origin": "other-worker", "namespace": "weather_inv", "key": "q1"}'
+            )
+            local_after_remote = "q1" in cache._l1
+            await cache.set("q1", {"temp": 31})
+            await cache.invalidate("q1")
+            return local_after_remote, await cache.get("q1")
+
+        assert asyncio.run(run()) == (False, None)
+
+    def test_sync_clear(self):
+        """clear() đồng bộ: xóa L1 ngay, trong event loop xóa cả L2 + báo worker khác"""
+        backend = MemoryBackend()
+        cache = TieredCache("weather_clear", ttl=60, backend=backend)
+        published = []
+
+        async def run():
+            await backend.subscribe(cache_module.CACHE_INVALIDATION_CHANNEL, published.append)
+            await cache.set("q1", {"temp": 30})
+            cache.clear()
+            local_cleared = "q1" not in cache._l1
+            await asyncio.sleep(0)
+            return local_cleared, await cache.get("q1")
+
+        assert asyncio.run(run()) == (True, None)
+        assert len(published) == 1
+        cache.clear()  # ngoài event loop: chỉ L1, không raise
+
+    def test_l2_failure_falls_back_to_l1(self):
+        """Redis lỗi → vẫn phục vụ từ L1, không raise"""
+        cache = TieredCache("weather_broken", ttl=60, backend=BrokenBackend())
+
+        async def run():
+            await cache.set("q1", {"temp": 30})
+            return await cache.get("q1")
+
+        assert asyncio.run(run()) == {"temp": 30}
+        assert cache.stats()["l2_errors"] == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
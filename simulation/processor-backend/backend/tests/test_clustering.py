@@ -0,0 +1,129 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Map Clustering
+==============================
+Kiểm tra cluster theo tile (count, maxSeverity, meanWaterLevel, lồng nhau theo zoom).
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_clustering.py -v
+"""
+
+import math
+import random
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.clustering import ClusterIndex, VersionedClusterIndex, MAX_CLUSTER_ZOOM
+
+
+def tile_of(lat, lng, z):
+    """Tile XYZ chứa điểm (công thức slippy map chuẩn)."""
+    n = 2 ** z
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+def random_records(n=300, seed=7):
+    rng = random.Random(seed)
+    crowd = [
+        {"entity_id": f"c{i}", "lat": 10.7 + rng.random() * 0.1, "lng": 106.6 + rng.random() * 0.1,
+         "risklevel": rng.choice(["Low", "Moderate", "High"]), "waterlevel": rng.random()}
+        for i in range(n)
+    ]
+    sensor = [
+        {"entity_id": f"s{i}", "lat": 10.7 + rng.random() * 0.1, "lng": 106.6 + rng.random() * 0.1,
+         "severity": "Severe", "waterlevel": 1.5}
+        for i in range(n // 10)
+    ]
+    return crowd, sensor
+
+
+def tile_total(index, z, x, y):
+    tile = index.tile(z, x, y)
+    return sum(c["count"] for c in tile["clusters"]) + len(tile["points"])
+
+
+class TestClusterIndex:
+    """Test class cho ClusterIndex."""
+
+    @pytest.mark.parametrize("zoom", [0, 8, 12, 14])
+    def test_tiles_cover_every_point(self, zoom):
+        """Tổng count của các tile có dữ liệu = tổng số điểm ở mọi zoom"""
+        crowd, sensor = random_records()
+        index = ClusterIndex(crowd, sensor)
+        tiles = {tile_of(r["lat"], r["lng"], zoom) for r in crowd + sensor}
+        assert sum(tile_total(index, zoom, x, y) for x, y in tiles) == len(crowd) + len(sensor)
+
+    def test_cluster_aggregates(self):
+        """Cluster gồm crowd + sensor: count, severity cao nhất, mực nước trung bình"""
+        crowd = [
+            {"entity_id": "a", "lat": 10.7626, "lng": 106.6601, "risklevel": "Low", "waterlevel": 0.2},
+            {"entity_id": "b", "lat": 10.7627, "lng": 106.6602, "risklevel": "High", "waterlevel": 0.4},
+        ]
+        sensor = [{"entity_id": "s", "lat": 10.7628, "lng": 106.6603, "severity": "Moderate"}]
+        index = ClusterIndex(crowd, sensor)
+
+        tile = index.tile(10, *tile_of(10.7627, 106.6602, 10))
+        assert tile["points"] == []
+        [cluster] = tile["clusters"]
+        assert cluster["count"] == 3
+        assert (cluster["crowdCount"], cluster["sensorCount"]) == (2, 1)
+        assert cluster["maxSeverity"] == "High"
+        assert cluster["meanWaterLevel"] == pytest.approx(0.3)
+        assert cluster["lat"] == pytest.approx(10.7627)
+
+    def test_high_zoom_returns_points(self):
+        """Từ MAX_CLUSTER_ZOOM trở lên trả về từng điểm (copy, kèm type)"""
+        crowd = [{"entity_id": "a", "lat": 10.7626, "lng": 106.6601}]
+        sensor = [{"entity_id": "s", "lat": 10.76261, "lng": 106.66011}]
+        index = ClusterIndex(crowd, sensor)
+
+        tile = index.tile(MAX_CLUSTER_ZOOM, *tile_of(10.7626, 106.6601, MAX_CLUSTER_ZOOM))
+        assert tile["clusters"] == []
+        assert sorted((p["entity_id"], p["type"]) for p in tile["points"]) == [("a", "crowd"), ("s", "sensor")]
+        tile["points"][0]["entity_id"] = "changed"
+        assert crowd[0]["entity_id"] == "a"
+
+    def test_empty_tile_and_missing_coordinates(self):
+        """Tile không có dữ liệu → rỗng; record thiếu tọa độ bị bỏ qua"""
+        index = ClusterIndex([{"entity_id": "x", "lat": None, "lng": 106.6}])
+        assert len(index) == 0
+        assert index.tile(5, 0, 0) == {"clusters": [], "points": []}
+
+    def test_versioned_rebuild(self):
+        """Chỉ build lại khi version (crowd, sensor) thay đổi"""
+        holder = VersionedClusterIndex(min_interval=0)
+        crowd, sensor = random_records(20)
+        holder.get((1, 1), lambda: (crowd, sensor))
+        holder.get((1, 1), lambda: (crowd, sensor))
+        assert holder.builds == 1
+        holder.get((2, 1), lambda: (crowd, sensor))
+        assert holder.builds == 2 and holder.version == (2, 1)
+
+    def test_rebuild_throttled(self):
+        """Version đổi liên tục → tối đa một lần build mỗi min_interval, giữa chừng dùng index cũ"""
+        now = [100.0]
+        holder = VersionedClusterIndex(min_interval=2, clock=lambda: now[0])
+        crowd, sensor = random_records(20)
+        first = holder.get((1, 1), lambda: (crowd, sensor))
+
+        for version in range(2, 12):
+            now[0] += 0.1
+            assert holder.get((version, 1), lambda: (crowd, sensor)) is first
+        assert holder.builds == 1 and holder.version == (1, 1) and holder.deferred == 10
+
+        now[0] += 2
+        assert holder.get((11, 1), lambda: (crowd, sensor)) is not first
+        assert holder.builds == 2 and holder.version == (11, 1)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,154 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Async CrateDB Access Layer
+==========================================
+Kiểm tra decode kiểu dữ liệu và hành vi khi CrateDB không khả dụng.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_cratedb.py -v
+"""
+
+import asyncio
+import pytest
+import sys
+import os
+from datetime import datetime, timezone
+from decimal import Decimal
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services import cratedb
+
+
+class TestRowDecoding:
+    """Test decode giá trị trả về từ asyncpg."""
+
+    def test_decode_timestamp_to_epoch_ms(self):
+        """Timestamp -> epoch milliseconds (giống crate HTTP client)"""
+        ts = datetime(2025, 1, 1, 10, 0, 0, tzinfo=timezone.utc)
+        assert cratedb.decode_value(ts) == 1735725600000
+
+    def test_decode_decimal_to_float(self):
+        """Numeric -> float"""
+        assert cratedb.decode_value(Decimal("0.45")) == 0.45
+        assert isinstance(cratedb.decode_value(Decimal("1")), float)
+
+    def test_decode_passthrough(self):
+        """Các kiểu khác giữ nguyên"""
+        assert cratedb.decode_value("Quận 1") == "Quận 1"
+        assert cratedb.decode_value(None) is None
+        assert cratedb.decode_value(0.3) == 0.3
+
+    def test_decode_row_json_fields(self):
+        """Cột object (JSON string) được parse thành dict"""
+        record = {"entity_id": "x", "factors": '{"photoFactor": 0.25}', "address": None}
+        row = cratedb.decode_row(record, json_fields=("factors", "address"))
+        assert row["factors"] == {"photoFactor": 0.25}
+        assert row["address"] is None
+
+
+class TestTimestampCursor:
+    """Test chuyển đổi cursor timestamp cho tham số query."""
+
+    def test_epoch_ms_roundtrip(self):
+        """Epoch ms -> datetime -> epoch ms không đổi"""
+        ts = cratedb.to_timestamp(1735725600000)
+        assert ts.tzinfo is not None
+        assert cratedb.decode_value(ts) == 1735725600000
+
+    def test_iso_string(self):
+        """ISO string (có Z) -> aware datetime"""
+        ts = cratedb.to_timestamp("2025-01-01T10:00:00Z")
+        assert ts == datetime(2025, 1, 1, 10, 0, 0, tzinfo=timezone.utc)
+
+    def test_naive_iso_assumed_utc(self):
+        """ISO string không timezone -> UTC"""
+        ts = cratedb.to_timestamp("2025-01-01T10:00:00")
+        assert ts.tzinfo == timezone.utc
+
+    def test_invalid_type(self):
+        """Kiểu không hỗ trợ -> TypeError"""
+        with pytest.raises(TypeError):
+            cratedb.to_timestamp([1, 2])
+
+
+class TestUnavailableDatabase:
+    """Test hành vi khi không kết nối được CrateDB."""
+
+    def test_fetch_raises_unavailable_and_backs_off(self, monkeypatch):
+        """Không tạo được pool -> CrateDBUnavailable, lần sau không connect lại ngay"""
+        calls = []
+
+        async def failing_create_pool(*args, **kwargs):
+            calls.append(1)
+            raise OSError("connection refused")
+
+        monkeypatch.setattr(cratedb.asyncpg, "create_pool", failing_create_pool)
+        monkeypatch.setattr(cratedb, "_retry_at", 0.0)
+
+        async def run():
+            for _ in range(3):
+                with pytest.raises(cratedb.CrateDBUnavailable):
+                    await cratedb.fetch("SELECT 1")
+
+        asyncio.run(run())
+        assert len(calls) == 1
+
+
+class FakePool:
+    """Pool giả: ghi lại query và terminate()."""
+
+    def __init__(self):
+        self.queries = []
+        self.terminated = False
+
+    async def fetchrow(self, query, *args, timeout=None):
+        self.queries.append(("fetchrow", query, args))
+        return {"zoneid": "zone-a", "waterlevel": Decimal("0.5")}
+
+    async def fetch(self, query, *args, timeout=None):
+        self.queries.append(("fetch", query, args))
+        return []
+
+    def terminate(self):
+        self.terminated = True
+
+
+class TestPool:
+    """Test pool theo event loop."""
+
+    @pytest.fixture
+    def pools(self, monkeypatch):
+        pools = []
+
+        async def create_pool(*args, **kwargs):
+            pools.append(FakePool())
+            return pools[-1]
+
+        monkeypatch.setattr(cratedb.asyncpg, "create_pool", create_pool)
+        monkeypatch.setattr(cratedb, "_pool", None)
+        monkeypatch.setattr(cratedb, "_pool_loop", None)
+        monkeypatch.setattr(cratedb, "_pool_lock", None)
+        monkeypatch.setattr(cratedb, "_retry_at", 0.0)
+        return pools
+
+    def test_fetchrow_uses_single_row_query(self, pools):
+        """fetchrow → pool.fetchrow (không lấy mọi row rồi bỏ)"""
+        row = asyncio.run(cratedb.fetchrow("SELECT * FROM t WHERE zoneid = $1", "zone-a"))
+        assert row == {"zoneid": "zone-a", "waterlevel": 0.5}
+        assert [q[0] for q in pools[0].queries] == ["fetchrow"]
+
+    def test_pool_of_old_loop_terminated(self, pools):
+        """Event loop mới → tạo pool mới, pool của loop cũ bị terminate"""
+        asyncio.run(cratedb.fetch("SELECT 1"))
+        asyncio.run(cratedb.fetch("SELECT 1"))
+        assert len(pools) == 2
+        assert pools[0].terminated and not pools[1].terminated
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
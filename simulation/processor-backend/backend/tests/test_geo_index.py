@@ -0,0 +1,111 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Spatial Index
+=============================
+Kiểm tra truy vấn bán kính / top-k của GeoIndex so với haversine thuần Python.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_geo_index.py -v
+"""
+
+import random
+import pytest
+import sys
+import os
+from math import radians, cos, sin, asin, sqrt
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.geo_index import GeoIndex, VersionedGeoIndex, filter_by_radius
+
+CENTER = (10.762622, 106.660172)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(radians, [lat1, lng1, lat2, lng2])
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+    return 6371 * 2 * asin(sqrt(a))
+
+
+def random_records(n=500, seed=42):
+    rng = random.Random(seed)
+    return [
+        {"entity_id": f"e{i}", "lat": 10.6 + rng.random() * 0.4, "lng": 106.5 + rng.random() * 0.4}
+        for i in range(n)
+    ]
+
+
+class TestGeoIndex:
+    """Test class cho GeoIndex."""
+
+    @pytest.mark.parametrize("radius", [0.5, 3.0, 15.0, 100.0])
+    def test_within_matches_brute_force(self, radius):
+        """Kết quả giống duyệt toàn bộ bằng haversine Python"""
+        records = random_records()
+        expected = sorted(
+            (haversine(*CENTER, r["lat"], r["lng"]), r["entity_id"]) for r in records
+            if haversine(*CENTER, r["lat"], r["lng"]) <= radius
+        )
+        result = GeoIndex(records).within(*CENTER, radius)
+        assert [r["entity_id"] for r in result] == [e for _, e in expected]
+
+    @pytest.mark.parametrize("bbox", [(10.7, 106.6, 10.75, 106.68), (10.0, 106.0, 11.0, 107.0), (9.0, 105.0, 9.1, 105.1)])
+    def test_within_bbox_matches_brute_force(self, bbox):
+        """Truy vấn bbox giống lọc tuyến tính"""
+        south, west, north, east = bbox
+        records = random_records()
+        expected = [
+            r["entity_id"] for r in records
+            if south <= r["lat"] <= north and west <= r["lng"] <= east
+        ]
+        result = GeoIndex(records).within_bbox(*bbox)
+        assert [r["entity_id"] for r in result] == expected
+
+    def test_top_k_nearest_first(self):
+        """limit → k điểm gần nhất, sắp xếp theo khoảng cách"""
+        records = random_records()
+        result = GeoIndex(records).within(*CENTER, 100.0, limit=10)
+        distances = [r["distance_km"] for r in result]
+        assert len(result) == 10
+        assert distances == sorted(distances)
+        all_distances = sorted(round(haversine(*CENTER, r["lat"], r["lng"]), 2) for r in records)
+        assert distances == all_distances[:10]
+
+    def test_nearest_without_radius(self):
+        """nearest(k) không giới hạn bán kính"""
+        records = [{"lat": 10.0, "lng": 106.0}, {"lat": 11.0, "lng": 107.0}]
+        result = GeoIndex(records).nearest(10.9, 106.9, 1)
+        assert result[0]["lat"] == 11.0
+
+    def test_returns_copies(self):
+        """Không ghi distance_km vào record gốc"""
+        records = [{"lat": CENTER[0], "lng": CENTER[1]}]
+        result = filter_by_radius(records, *CENTER, 1.0)
+        assert result[0]["distance_km"] == 0.0
+        assert "distance_km" not in records[0]
+
+    def test_skips_missing_coordinates(self):
+        """Record thiếu lat/lng bị bỏ qua"""
+        records = [{"lat": None, "lng": 106.6}, {"lat": CENTER[0], "lng": CENTER[1]}]
+        assert len(GeoIndex(records).within(*CENTER, 5.0)) == 1
+        assert GeoIndex([]).within(*CENTER, 5.0) == []
+
+
+class TestVersionedGeoIndex:
+    """Test build lại index theo version."""
+
+    def test_rebuild_only_on_new_version(self):
+        holder = VersionedGeoIndex()
+        records = random_records(10)
+        first = holder.get(1, lambda: records)
+        assert holder.get(1, lambda: []) is first
+        holder.get(2, lambda: records)
+        assert holder.builds == 2
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,119 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Image Derivative Pipeline
+=========================================
+Kiểm tra resize + WebP, xoay theo EXIF rồi bỏ EXIF, và job queue chạy
+trên ProcessPoolExecutor (callback nhận tên file biến thể).
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_image_derivatives.py -v
+"""
+
+import asyncio
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from PIL import Image
+
+from app.services import storage
+from app.services.image_derivatives import DerivativePipeline, render_derivatives
+
+SIZES = {"thumbnail": 320, "medium": 1280}
+
+
+def save_photo(path, size=(2000, 1000), orientation=None):
+    exif = Image.Exif()
+    exif[0x010F] = "FloodCam"  # Make
+    if orientation:
+        exif[0x0112] = orientation
+    Image.new("RGB", size, (200, 80, 40)).save(path, format="JPEG", exif=exif.tobytes())
+
+
+class TestRenderDerivatives:
+    """Test class cho render_derivatives."""
+
+    def test_resized_webp_without_exif(self, tmp_path):
+        """Cạnh dài ≤ kích thước biến thể, xoay theo Orientation, output không còn EXIF"""
+        source = tmp_path / "abc.jpg"
+        save_photo(source, orientation=6)  # chụp dọc: cần xoay 90°
+
+        names = render_derivatives(str(source), str(tmp_path / "derived"), SIZES, "webp", 80)
+
+        assert names == {"thumbnail": "abc-thumbnail.webp", "medium": "abc-medium.webp"}
+        with Image.open(tmp_path / "derived" / names["thumbnail"]) as thumb:
+            assert thumb.format == "WEBP"
+            assert thumb.size == (160, 320)
+            assert not thumb.getexif()
+        with Image.open(tmp_path / "derived" / names["medium"]) as medium:
+            assert max(medium.size) == 1280
+        assert sorted(os.listdir(tmp_path / "derived")) == ["abc-medium.webp", "abc-thumbnail.webp"]
+
+    def test_concurrent_jobs_same_image(self, tmp_path):
+        """Hai job cùng một ảnh (tên theo nội dung) chạy song song → file tạm không đè nhau"""
+        from concurrent.futures import ThreadPoolExecutor
+        source = tmp_path / "same.jpg"
+        save_photo(source, size=(800, 600))
+        out_dir = str(tmp_path / "derived")
+
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(
+                lambda _: render_derivatives(str(source), out_dir, SIZES, "webp", 80), range(8)
+            ))
+
+        assert all(names == results[0] for names in results)
+        assert sorted(os.listdir(out_dir)) == ["same-medium.webp", "same-thumbnail.webp"]
+
+
+class TestDerivativePipeline:
+    """Test class cho DerivativePipeline."""
+
+    def test_process_pool_job_reports_results(self, tmp_path, monkeypatch):
+        """Job chạy trên process pool; ảnh hỏng → None, ảnh tốt → tên file biến thể"""
+        monkeypatch.setattr(storage, "UPLOAD_DIR", str(tmp_path))
+        save_photo(tmp_path / "good.jpg")
+        (tmp_path / "bad.jpg").write_bytes(b"not an image")
+        completed = []
+
+        async def on_complete(job_id, results):
+            completed.append((job_id, results))
+
+        async def run():
+            pipeline = DerivativePipeline(on_complete, workers=1, sizes=SIZES, fmt="webp")
+            assert pipeline.submit("urn:ngsi-ld:CrowdReport:1", ["good.jpg", "bad.jpg"])
+            await pipeline.close()
+            return pipeline.stats()
+
+        stats = asyncio.run(run())
+        [(job_id, results)] = completed
+        assert job_id == "urn:ngsi-ld:CrowdReport:1"
+        assert results[0] == ("good.jpg", {"thumbnail": "good-thumbnail.webp", "medium": "good-medium.webp"})
+        assert results[1] == ("bad.jpg", None)
+        assert stats["images"] == 1 and stats["failed_images"] == 1 and stats["pending"] == 0
+
+    def test_bounded_queue(self, tmp_path, monkeypatch):
+        """Quá max_pending job đang chờ → bỏ qua job mới (report vẫn dùng ảnh gốc)"""
+        from concurrent.futures import ThreadPoolExecutor
+        monkeypatch.setattr(storage, "UPLOAD_DIR", str(tmp_path))
+        save_photo(tmp_path / "a.jpg", size=(64, 64))
+
+        async def run():
+            pipeline = DerivativePipeline(workers=1, max_pending=1, sizes=SIZES, fmt="webp",
+                                          executor_factory=lambda: ThreadPoolExecutor(1))
+            accepted = [pipeline.submit("r1", ["a.jpg"]), pipeline.submit("r2", ["a.jpg"])]
+            await pipeline.close()
+            return accepted, pipeline.stats()
+
+        accepted, stats = asyncio.run(run())
+        assert accepted == [True, False]
+        assert stats["dropped"] == 1 and stats["completed"] == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,136 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Write-behind Ingest Queue
+=========================================
+Kiểm tra micro-batch theo kích thước / thời gian, giới hạn queue, thử lại batch lỗi,
+cửa sổ chống trùng notification.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_ingest_queue.py -v
+"""
+
+import asyncio
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.ingest_queue import DedupWindow, IngestQueue, PartialFlush
+
+
+class TestIngestQueue:
+    """Test class cho IngestQueue."""
+
+    def test_micro_batches_by_size_then_time(self):
+        """7 item, batch 3 → hai batch đủ kích thước ngay, item lẻ flush sau max_wait"""
+        batches = []
+
+        async def flush(values):
+            batches.append(values)
+
+        async def run():
+            queue = IngestQueue(flush, batch_size=3, max_wait=0.05)
+            assert queue.offer(list(range(7)))
+            await asyncio.sleep(0.01)
+            early = [len(b) for b in batches]
+            await asyncio.sleep(0.1)
+            stats = queue.stats()
+            await queue.close()
+            return early, stats
+
+        early, stats = asyncio.run(run())
+        assert early == [3, 3]
+        assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+        assert stats["depth"] == 0 and stats["batches"] == 3
+        assert stats["lag_ms"]["max"] >= 40
+
+    def test_bounded_queue_rejects_whole_notification(self):
+        """Không đủ chỗ cho cả notification → từ chối toàn bộ, không nhận một phần"""
+
+        async def flush(values):
+            pass
+
+        async def run():
+            queue = IngestQueue(flush, max_size=5, max_wait=60)
+            accepted = [queue.offer([1, 2, 3, 4]), queue.offer([5, 6])]
+            stats = queue.stats()
+            await queue.close()
+            return accepted, stats
+
+        accepted, stats = asyncio.run(run())
+        assert accepted == [True, False]
+        assert stats["rejected"] == 2 and stats["max_depth"] == 4
+
+    def test_failed_batch_retried_in_order_then_dropped(self):
+        """Batch lỗi quay lại đầu queue (giữ thứ tự); quá max_attempts → bỏ + on_drop"""
+        calls, dropped = [], []
+
+        async def flush(values):
+            calls.append(values)
+            if values[0] == "poison" or len(calls) == 1:
+                raise RuntimeError("Orion-LD down")
+
+        async def run():
+            queue = IngestQueue(flush, batch_size=2, max_wait=0, max_attempts=2, retry_delay=0,
+                                on_drop=dropped.extend)
+            queue.offer(["a", "b", "c"])
+            await asyncio.sleep(0.05)
+            queue.offer(["poison"])
+            await asyncio.sleep(0.05)
+            stats = queue.stats()
+            await queue.close()
+            return stats
+
+        stats = asyncio.run(run())
+        assert calls[:3] == [["a", "b"], ["a", "b"], ["c"]]
+        assert calls[3:] == [["poison"], ["poison"]]
+        assert stats["flushed"] == 3 and stats["dropped"] == 1 and stats["failed_batches"] == 3
+        assert dropped == ["poison"]
+
+    def test_partial_flush_retries_only_unsent(self):
+        """flush raise PartialFlush → chỉ item chưa ghi được thử lại, phần đã ghi tính là flushed"""
+        calls = []
+
+        async def flush(values):
+            calls.append(list(values))
+            if len(calls) == 1:
+                raise PartialFlush(values[2:], RuntimeError("chunk 2 failed"))
+
+        async def run():
+            queue = IngestQueue(flush, batch_size=4, max_wait=0, retry_delay=0)
+            queue.offer(["a", "b", "c", "d"])
+            await asyncio.sleep(0.05)
+            stats = queue.stats()
+            await queue.close()
+            return stats
+
+        stats = asyncio.run(run())
+        assert calls == [["a", "b", "c", "d"], ["c", "d"]]
+        assert stats["flushed"] == 4 and stats["failed_batches"] == 1 and stats["dropped"] == 0
+
+
+class TestDedupWindow:
+    """Test class cho DedupWindow."""
+
+    def test_claim_release_and_bounds(self):
+        """Key đã nhận → trùng; release → nhận lại được; vượt maxsize → bỏ key cũ nhất"""
+        window = DedupWindow(maxsize=2, ttl=60)
+        key = ("urn:ngsi-ld:WaterLevelObserved:z1", "2025-01-01T10:00:00Z")
+        assert window.claim(key) and not window.claim(key)
+        assert window.claim(None) and window.claim(None)
+
+        window.release([key])
+        assert window.claim(key)
+        window.claim(("z2", "t"))
+        window.claim(("z3", "t"))
+        assert key not in window and len(window) == 2
+        assert window.stats()["suppressed"] == 1 and window.stats()["checked"] == 5
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
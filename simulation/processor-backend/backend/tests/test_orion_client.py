@@ -0,0 +1,233 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Orion-LD Client
+===============================
+Kiểm tra retry (jitter + budget), circuit breaker, không retry lỗi 4xx,
+batch upsert, id cố định của entity dẫn xuất và compaction.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_orion_client.py -v
+"""
+
+import asyncio
+import json
+import pytest
+import sys
+import os
+
+import httpx
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.orion_client import (
+    CircuitBreaker, OrionClient, OrionError, OrionUnavailable, RetryBudget, derived_entity_id
+)
+from app.scripts.compact_entities import plan_compaction
+
+ENTITY = {"id": "urn:ngsi-ld:FloodRiskSensor:1", "type": "FloodRiskSensor"}
+
+
+def scripted_client(statuses, retries=2):
+    """Client với transport giả trả lần lượt các status (hoặc exception)."""
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        status = statuses[min(len(calls), len(statuses)) - 1]
+        if isinstance(status, Exception):
+            raise status
+        return httpx.Response(status)
+
+    async def no_sleep(delay):
+        pass
+
+    client = OrionClient(
+        "http://orion/ngsi-ld/v1/entities",
+        retries=retries,
+        transport=httpx.MockTransport(handler),
+        sleep=no_sleep
+    )
+    return client, calls
+
+
+async def send(client, times=1):
+    results = []
+    for _ in range(times):
+        try:
+            results.append((await client.create_entity(ENTITY)).status_code)
+        except OrionError as e:
+            results.append(type(e).__name__)
+    await client.close()
+    return results
+
+
+class TestOrionClient:
+    """Test class cho OrionClient."""
+
+    def test_retries_transient_errors(self):
+        """503 / lỗi kết nối → retry, thành công ở lần thử thứ 3"""
+        client, calls = scripted_client([503, httpx.ConnectError("refused"), 201])
+        assert asyncio.run(send(client)) == [201]
+        assert len(calls) == 3
+        assert client.stats()["retries"] == 2
+
+    def test_client_errors_not_retried(self):
+        """400 → OrionError ngay, không retry và không tính là Orion-LD lỗi"""
+        client, calls = scripted_client([400])
+        assert asyncio.run(send(client)) == ["OrionError"]
+        assert len(calls) == 1
+        assert client.breaker.failures == 0
+
+    def test_create_conflict_after_retry_is_success(self):
+        """POST tạo entity đã ghi nhưng mất response → 409 ở lần retry = đã tạo; 409 lần đầu vẫn là lỗi"""
+        client, calls = scripted_client([httpx.ReadTimeout("lost"), 409])
+        assert asyncio.run(send(client)) == [409]
+        assert len(calls) == 2
+        assert client.stats()["conflicts_after_retry"] == 1
+
+        client, calls = scripted_client([409])
+        assert asyncio.run(send(client)) == ["OrionError"]
+        assert len(calls) == 1
+
+    def test_breaker_opens_and_rejects_fast(self):
+        """Lỗi liên tiếp đủ ngưỡng → circuit mở, request sau không chạm tới Orion-LD"""
+        client, calls = scripted_client([503], retries=0)
+        client.breaker.threshold = 3
+        assert asyncio.run(send(client, times=5)) == ["OrionUnavailable"] * 5
+        assert len(calls) == 3
+        assert client.stats()["circuit"] == "open"
+        assert client.stats()["rejected"] == 2
+
+    def test_retry_budget_caps_retries(self):
+        """Hết token → không retry nữa dù còn lượt"""
+        client, calls = scripted_client([503], retries=5)
+        client.budget = RetryBudget(ratio=0.1, reserve=2)
+        client.breaker.threshold = 100
+        asyncio.run(send(client, times=4))
+        # 2 token ban đầu + 0.1 mỗi request → chỉ 2 retry cho cả 4 request
+        assert client.stats()["retries"] == 2
+        assert len(calls) == 6
+
+
+class TestBatchUpsert:
+    """Test class cho /entityOperations/upsert."""
+
+    def test_chunks_and_partial_errors(self):
+        """250 entity, lô 100 → 3 request; entity bị từ chối trong 207 nằm ở `errors`"""
+        bodies = []
+
+        def handler(request):
+            chunk = json.loads(request.content)
+            bodies.append((request.url.path, len(chunk)))
+            if len(bodies) == 2:
+                return httpx.Response(207, json={
+                    "success": [e["id"] for e in chunk[1:]],
+                    "errors": [{"entityId": chunk[0]["id"], "error": {"title": "Bad Request"}}],
+                })
+            return httpx.Response(201, json=[e["id"] for e in chunk])
+
+        async def run():
+            client = OrionClient("http://orion/ngsi-ld/v1/entities", transport=httpx.MockTransport(handler))
+            entities = [{"id": f"urn:ngsi-ld:FloodRiskSensor:{i}", "type": "FloodRiskSensor"} for i in range(250)]
+            result = await client.upsert_entities(entities, batch_size=100)
+            await client.close()
+            return result
+
+        result = asyncio.run(run())
+        assert bodies == [("/ngsi-ld/v1/entityOperations/upsert", n) for n in (100, 100, 50)]
+        assert result["status"] == 207
+        assert len(result["success"]) == 249
+        assert [e["entityId"] for e in result["errors"]] == ["urn:ngsi-ld:FloodRiskSensor:100"]
+
+    def test_failed_chunk_keeps_earlier_results(self):
+        """Lô thứ 2 lỗi → OrionError mang `partial` = kết quả lô 1 (đã ghi)"""
+        def handler(request):
+            chunk = json.loads(request.content)
+            if chunk[0]["id"].endswith(":2"):
+                return httpx.Response(400, json={"title": "Bad Request"})
+            return httpx.Response(201, json=[e["id"] for e in chunk])
+
+        async def run():
+            client = OrionClient("http://orion/ngsi-ld/v1/entities", transport=httpx.MockTransport(handler))
+            entities = [{"id": f"urn:ngsi-ld:FloodRiskSensor:{i}", "type": "FloodRiskSensor"} for i in range(4)]
+            try:
+                await client.upsert_entities(entities, batch_size=2)
+            except OrionError as e:
+                return e
+            finally:
+                await client.close()
+
+        error = asyncio.run(run())
+        assert error.status_code == 400
+        assert error.partial["success"] == ["urn:ngsi-ld:FloodRiskSensor:0", "urn:ngsi-ld:FloodRiskSensor:1"]
+
+
+class TestCircuitBreaker:
+    """Test class cho CircuitBreaker."""
+
+    def test_half_open_trial(self):
+        """Sau reset_timeout cho đúng một request thử; thành công → closed, thất bại → open"""
+        now = [0.0]
+        breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.state == "open" and not breaker.allow()
+
+        now[0] = 10
+        assert breaker.allow() and not breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == "open"
+
+        now[0] = 20
+        assert breaker.allow()
+        breaker.record_success()
+        assert breaker.state == "closed" and breaker.allow()
+
+
+
+def risk_sensor(entity_id, source, updated_at):
+    return {
+        "id": entity_id,
+        "type": "FloodRiskSensor",
+        "sourceSensor": {"type": "Relationship", "object": source},
+        "updatedAt": {"type": "Property", "value": updated_at},
+    }
+
+
+class TestDerivedEntities:
+    """Test class cho id cố định + compaction."""
+
+    def test_derived_entity_id_is_stable(self):
+        """Cùng nguồn → cùng id; id không phải URN vẫn dùng được"""
+        source = "urn:ngsi-ld:WaterLevelObserved:q1-01"
+        assert derived_entity_id("FloodRiskSensor", source) == "urn:ngsi-ld:FloodRiskSensor:q1-01"
+        assert derived_entity_id("FloodRiskSensor", source) == derived_entity_id("FloodRiskSensor", source)
+        assert derived_entity_id("FloodRiskCrowd", "report-7") == "urn:ngsi-ld:FloodRiskCrowd:report-7"
+
+    def test_plan_keeps_latest_per_source(self):
+        """Mỗi sensor nguồn giữ bản mới nhất dưới id cố định, xóa mọi bản UUID"""
+        a, b = "urn:ngsi-ld:WaterLevelObserved:a", "urn:ngsi-ld:WaterLevelObserved:b"
+        entities = [
+            risk_sensor("urn:ngsi-ld:FloodRiskSensor:1111", a, "2025-01-01T10:00:00Z"),
+            risk_sensor("urn:ngsi-ld:FloodRiskSensor:2222", a, "2025-01-01T11:00:00Z"),
+            risk_sensor("urn:ngsi-ld:FloodRiskSensor:b", b, "2025-01-01T12:00:00Z"),
+            risk_sensor("urn:ngsi-ld:FloodRiskSensor:3333", b, "2025-01-01T09:00:00Z"),
+            {"id": "urn:ngsi-ld:FloodRiskSensor:manual", "type": "FloodRiskSensor"},
+        ]
+        upserts, deletes = plan_compaction("FloodRiskSensor", entities)
+        assert [(e["id"], e["updatedAt"]["value"]) for e in upserts] == [
+            ("urn:ngsi-ld:FloodRiskSensor:a", "2025-01-01T11:00:00Z")
+        ]
+        assert sorted(deletes) == [
+            "urn:ngsi-ld:FloodRiskSensor:1111",
+            "urn:ngsi-ld:FloodRiskSensor:2222",
+            "urn:ngsi-ld:FloodRiskSensor:3333",
+        ]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,79 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Pre-serialized Payloads
+=======================================
+Kiểm tra cache payload theo version và so khớp ETag.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_payloads.py -v
+"""
+
+import json
+import pytest
+import sys
+import os
+from decimal import Decimal
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.payloads import PayloadCache, dumps, etag_matches
+
+
+class TestPayloadCache:
+    """Test class cho PayloadCache."""
+
+    def test_built_once_per_version(self):
+        """Cùng key + version → không build lại"""
+        cache = PayloadCache()
+        builds = []
+
+        def build():
+            builds.append(1)
+            return {"total": len(builds)}
+
+        first = cache.get_or_build("stats", (1, 1), build)
+        second = cache.get_or_build("stats", (1, 1), build)
+        assert first is second
+        assert len(builds) == 1
+
+        third = cache.get_or_build("stats", (2, 1), build)
+        assert len(builds) == 2
+        assert third.etag != first.etag
+
+    def test_etag_depends_on_content(self):
+        """Nội dung giống nhau → ETag giống nhau (strong ETag)"""
+        cache = PayloadCache()
+        a = cache.get_or_build("a", 1, lambda: {"x": 1})
+        b = cache.get_or_build("b", 1, lambda: {"x": 1})
+        assert a.etag == b.etag
+        assert a.etag.startswith('"') and a.etag.endswith('"')
+
+    def test_dumps_matches_json(self):
+        """orjson bytes có cùng nội dung như json.dumps(default=str)"""
+        data = {"district": "Quận 1", "waterlevel": 0.35, "factors": None, "zones": [1, 2]}
+        assert json.loads(dumps(data)) == data
+
+    def test_dumps_unknown_type_as_str(self):
+        """Kiểu không hỗ trợ → str() (giống default=str)"""
+        assert json.loads(dumps({"value": Decimal("0.5")})) == {"value": "0.5"}
+
+class TestEtagMatching:
+    """Test so khớp If-None-Match."""
+
+    def test_exact_and_list(self):
+        assert etag_matches('"abc"', '"abc"')
+        assert etag_matches('"x", "abc"', '"abc"')
+        assert not etag_matches('"x"', '"abc"')
+
+    def test_weak_and_wildcard(self):
+        assert etag_matches('W/"abc"', '"abc"')
+        assert etag_matches("*", '"abc"')
+        assert not etag_matches(None, '"abc"')
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
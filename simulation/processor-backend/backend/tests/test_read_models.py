@@ -0,0 +1,211 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Read Model "latest reading per zone"
+====================================================
+Kiểm tra upsert, bootstrap và đọc incremental của LatestReadingStore.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_read_models.py -v
+"""
+
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.read_models import LatestReadingStore, coordinate_key, to_epoch_ms
+
+
+def reading(zone, level, ts, **extra):
+    return {
+        "entity_id": f"urn:ngsi-ld:WaterLevelObserved:{zone}",
+        "zoneid": zone,
+        "waterlevel": level,
+        "updatedat": ts,
+        **extra,
+    }
+
+
+class TestLatestReadingStore:
+    """Test class cho LatestReadingStore."""
+
+    def test_upsert_keeps_one_record_per_zone(self):
+        """Nhiều reading cùng zone → chỉ giữ reading mới nhất"""
+        store = LatestReadingStore()
+        store.upsert(reading("zone-a", 0.1, 1000))
+        store.upsert(reading("zone-a", 0.3, 2000))
+        store.upsert(reading("zone-b", 0.2, 1500))
+
+        snapshot = store.snapshot()
+        assert len(snapshot) == 2
+        assert snapshot[0]["zoneid"] == "zone-a"
+        assert snapshot[0]["waterlevel"] == 0.3
+
+    def test_out_of_order_reading_ignored(self):
+        """Reading cũ hơn đến sau → bỏ qua"""
+        store = LatestReadingStore()
+        store.upsert(reading("zone-a", 0.5, 2000))
+        assert store.upsert(reading("zone-a", 0.1, 1000)) is False
+        assert store.snapshot()[0]["waterlevel"] == 0.5
+
+    def test_notification_without_zone_merges_by_entity_id(self):
+        """Notification thiếu zoneId → gộp theo entity_id, giữ các field cũ"""
+        store = LatestReadingStore()
+        store.bootstrap([reading("zone-a", 0.1, 1000, zonename="Trần Xuân Soạn")])
+
+        store.upsert({
+            "entity_id": "urn:ngsi-ld:WaterLevelObserved:zone-a",
+            "zoneid": None,
+            "waterlevel": 0.4,
+            "updatedat": 3000,
+        })
+
+        snapshot = store.snapshot()
+        assert len(snapshot) == 1
+        assert snapshot[0]["waterlevel"] == 0.4
+        assert snapshot[0]["zonename"] == "Trần Xuân Soạn"
+
+    def test_bootstrap_after_notification_does_not_duplicate(self):
+        """Notification đến trước bootstrap → không tạo bản ghi trùng"""
+        store = LatestReadingStore()
+        store.upsert({
+            "entity_id": "urn:ngsi-ld:WaterLevelObserved:zone-a",
+            "waterlevel": 0.6,
+            "updatedat": 5000,
+        })
+        store.bootstrap([reading("zone-a", 0.1, 1000, zonename="Zone A")])
+
+        snapshot = store.snapshot()
+        assert len(snapshot) == 1
+        assert snapshot[0]["waterlevel"] == 0.6
+        assert snapshot[0]["zoneid"] == "zone-a"
+        assert store.bootstrapped
+
+    def test_changed_since(self):
+        """changed_since chỉ trả các zone cập nhật sau cursor"""
+        store = LatestReadingStore()
+        store.upsert(reading("zone-a", 0.1, 1000))
+        store.upsert(reading("zone-b", 0.2, 2000))
+        store.upsert(reading("zone-c", 0.3, 3000))
+
+        changed = store.changed_since(1500)
+        assert [r["zoneid"] for r in changed] == ["zone-b", "zone-c"]
+        assert store.latest_timestamp() == 3000
+
+    def test_snapshot_returns_copies(self):
+        """Sửa record trả về không ảnh hưởng store"""
+        store = LatestReadingStore()
+        store.upsert(reading("zone-a", 0.1, 1000))
+        store.snapshot()[0]["distance_km"] = 1.2
+        assert "distance_km" not in store.snapshot()[0]
+
+    def test_iso_timestamps_normalized(self):
+        """Timestamp ISO (observedAt) được chuẩn hóa về epoch ms"""
+        store = LatestReadingStore()
+        store.upsert(reading("zone-a", 0.1, "2025-01-01T10:00:00Z"))
+        assert store.snapshot()[0]["updatedat"] == to_epoch_ms("2025-01-01T10:00:00+00:00")
+
+
+class TestSnapshotStoreVersioning:
+    """Test version và delta của write-through snapshot store."""
+
+    def crowd_store(self):
+        return LatestReadingStore(
+            key_func=coordinate_key,
+            time_field="calculatedat",
+            order_by="calculatedat",
+            descending=True
+        )
+
+    def test_version_monotonic(self):
+        """Mỗi delta được áp dụng → version tăng"""
+        store = LatestReadingStore()
+        assert store.version == 0
+        store.upsert(reading("zone-a", 0.1, 1000))
+        v1 = store.version
+        store.upsert(reading("zone-a", 0.2, 2000))
+        assert store.version > v1
+        store.upsert(reading("zone-a", 0.0, 500))  # reading cũ, không đổi
+        assert store.version == v1 + 1
+
+    def test_reconcile_unchanged_rows_keeps_version(self):
+        """Bootstrap lại cùng dữ liệu (reconcile) → không tạo delta"""
+        store = LatestReadingStore()
+        rows = [reading("zone-a", 0.1, 1000), reading("zone-b", 0.2, 1000)]
+        store.bootstrap(rows)
+        version = store.version
+        store.bootstrap([dict(r) for r in rows])
+        assert store.version == version
+
+    def test_changed_since_version(self):
+        """Delta theo version chỉ chứa record thay đổi"""
+        store = LatestReadingStore()
+        store.upsert(reading("zone-a", 0.1, 1000))
+        store.upsert(reading("zone-b", 0.2, 1000))
+        cursor = store.version
+        store.upsert(reading("zone-b", 0.5, 2000))
+
+        changed = store.changed_since_version(cursor)
+        assert [r["zoneid"] for r in changed] == ["zone-b"]
+        assert store.changed_since_version(store.version) == []
+
+    def test_crowd_keyed_by_coordinates(self):
+        """Crowd report cùng tọa độ → thay thế, sắp xếp mới nhất trước"""
+        store = self.crowd_store()
+        store.upsert({"entity_id": "c1", "lat": 10.762622, "lng": 106.660172, "calculatedat": 1000})
+        store.upsert({"entity_id": "c2", "lat": 10.762622, "lng": 106.660172, "calculatedat": 2000})
+        store.upsert({"entity_id": "c3", "lat": 10.80, "lng": 106.70, "calculatedat": 1500})
+
+        snapshot = store.snapshot()
+        assert [r["entity_id"] for r in snapshot] == ["c2", "c3"]
+
+    def test_evict_older_than(self):
+        """Crowd report quá cửa sổ thời gian bị loại khỏi store"""
+        store = self.crowd_store()
+        store.upsert({"entity_id": "old", "lat": 10.70, "lng": 106.60, "calculatedat": 1000})
+        store.upsert({"entity_id": "new", "lat": 10.80, "lng": 106.70, "calculatedat": 5000})
+        version = store.version
+
+        assert store.evict_older_than(2000) == 1
+        assert [r["entity_id"] for r in store.snapshot()] == ["new"]
+        assert store.version > version
+
+    def test_evicted_keys_leave_tombstones(self):
+        """Key bị loại → tombstone trong delta theo version; upsert lại → record thay tombstone"""
+        store = self.crowd_store()
+        store.upsert({"entity_id": "old", "lat": 10.70, "lng": 106.60, "calculatedat": 1000})
+        cursor = store.version
+        store.evict_older_than(2000)
+
+        [tombstone] = store.changed_since_version(cursor)
+        assert tombstone["removed"] is True
+        assert tombstone["entity_id"] == "old" and store.key_of(tombstone) == "10.7,106.6"
+        assert store.changed_since_version(store.version) == []
+
+        store.upsert({"entity_id": "old", "lat": 10.70, "lng": 106.60, "calculatedat": 3000})
+        assert [r.get("removed") for r in store.changed_since_version(cursor)] == [None]
+
+    def test_tombstones_bounded(self):
+        """Chỉ giữ `max_tombstones` tombstone mới nhất"""
+        store = LatestReadingStore(max_tombstones=2)
+        for i, zone in enumerate(["zone-a", "zone-b", "zone-c"]):
+            store.upsert(reading(zone, 0.1, 1000 + i))
+            store.evict_older_than(5000)
+
+        assert [r["zoneid"] for r in store.changed_since_version(0)] == ["zone-b", "zone-c"]
+
+    def test_missing_coordinates_falls_back_to_entity_id(self):
+        """Record không có tọa độ → key theo entity_id"""
+        store = self.crowd_store()
+        assert coordinate_key({"lat": None, "lng": 106.7}) is None
+        assert store.upsert({"entity_id": "c1", "calculatedat": 1000}) is True
+        assert store.upsert({"calculatedat": 1000}) is False
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,127 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Flood Scoring Engine
+====================================
+Kiểm tra API batch (NumPy) cho kết quả giống hệt hàm từng phần tử,
+dữ liệu thiếu (None) trong mảng, keyword matcher (có dấu / không dấu)
+và parse độ sâu từ mô tả.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_scoring.py -v
+"""
+
+import pytest
+import sys
+import os
+import unicodedata
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services import scoring
+
+
+class TestSensorSeverityBatch:
+    """Test class cho sensor_severities."""
+
+    def test_batch_matches_scalar(self):
+        """Lưới mức nước × threshold × trend: batch == từng phần tử"""
+        levels, thresholds, trends = [], [], []
+        for level in [0, 0.15, 0.199, 0.2, 0.3, 0.49, 0.5, 0.99, 1.0, 2.0]:
+            for threshold in [None, 0, 0.25, 0.5]:
+                for trend in [None, -0.1, 0.04, 0.06, 0.15]:
+                    levels.append(level)
+                    thresholds.append(threshold)
+                    trends.append(trend)
+
+        batch = scoring.sensor_severities(levels, thresholds, trends).tolist()
+        assert batch == [scoring.sensor_severity(l, th, tr) for l, th, tr in zip(levels, thresholds, trends)]
+
+    def test_scalar_thresholds_broadcast(self):
+        """threshold/trend có thể là một giá trị cho cả mảng"""
+        assert scoring.sensor_severities([0.1, 0.3, 0.6], thresholds=0.25).tolist() == ["Low", "High", "High"]
+        assert scoring.sensor_severities([0.1, 1.2], trends=0.1).tolist() == ["Moderate", "Severe"]
+
+
+class TestCrowdRiskBatch:
+    """Test class cho crowd_risk_scores."""
+
+    def test_batch_matches_scalar(self):
+        """Batch score/level/factors == crowd_risk_score của từng report"""
+        reports = [
+            (0.1, "", 0, False),
+            (0.4, "Ngập sâu, nguy hiểm, kẹt xe", 2, True),
+            (0.9, "Nước lên nhanh ở đầu hẻm, xe máy chết máy nhiều", 1, False),
+            (1.5, "help", 5, True),
+            (1.07, "", 5, False),
+        ]
+        levels, descriptions, photos, verified = zip(*reports)
+        matches, lengths = scoring.crowd_text_features(descriptions)
+        scores, levels_out, factors = scoring.crowd_risk_scores(levels, matches, lengths, photos, verified)
+
+        for i, (level, description, photo_count, is_verified) in enumerate(reports):
+            score, risk_level, expected = scoring.crowd_risk_score(level, description, [None] * photo_count, is_verified)
+            assert scores[i] == score and levels_out[i] == risk_level
+            assert {name: values[i] for name, values in factors.items()} == expected
+
+    def test_depth_from_description(self):
+        """Độ sâu ghi trong mô tả (cm hoặc m); không có → None"""
+        assert scoring.depth_from_description("Ngập 30cm trước nhà") == 0.3
+        assert scoring.depth_from_description("nước sâu 1.2 mét") == 1.2
+        assert scoring.depth_from_description("ngập 1,5m") == 1.5
+        assert scoring.depth_from_description("ngập nặng") is None
+
+    def test_score_reports_fills_missing_level_from_description(self):
+        """Report lịch sử không có mức nước → dùng độ sâu trong mô tả"""
+        scores, _, _ = scoring.score_crowd_reports(["ngập 50cm", "ngập 50cm"], [None, 0.5])
+        assert scores[0] == scores[1]
+
+    def test_depth_ignores_numbers_before_words(self):
+        """Số quận / số lượng đứng trước chữ bắt đầu bằng "m" không phải độ sâu"""
+        assert scoring.depth_from_description("Quận 7 mưa lớn, ngập") is None
+        assert scoring.depth_from_description("Ngập 2 máy bơm hỏng") is None
+        assert scoring.depth_from_description("Quận 7 mưa lớn, ngập 40cm") == 0.4
+        assert scoring.depth_from_description(unicodedata.normalize("NFD", "ngập 2 MÉT")) == 2.0
+
+
+class TestKeywordMatcher:
+    """Test class cho KeywordMatcher."""
+
+    def test_counts_like_substring_scan(self):
+        """Số keyword giống kiểm tra `keyword in text` từng cái (kể cả keyword lồng nhau)"""
+        texts = [
+            "", "Ngập sâu, NGUY HIỂM, cần cứu", "very dangerous flood, help!",
+            "nước chảy mạnh tràn bờ kẹt xe không qua được", "ngậpsâukhẩncấp",
+        ]
+        for text in texts:
+            expected = sum(1 for keyword in scoring.SEVERITY_KEYWORDS if keyword in text.lower())
+            assert scoring.count_keywords(text) == expected
+        assert scoring.SEVERITY_MATCHER.matches("dangerous") == {"danger", "dangerous"}
+
+    def test_non_diacritic_and_decomposed_text(self):
+        """Gõ không dấu hoặc Unicode NFD vẫn khớp keyword có dấu"""
+        assert scoring.SEVERITY_MATCHER.matches("ngap sau, nguy hiem") == {"ngập sâu", "nguy hiểm"}
+        assert scoring.count_keywords(unicodedata.normalize("NFD", "Khẩn cấp")) == 1
+
+
+# Bản vendored trong processor/flood_risk_engine (không có trong image backend)
+VENDORED_SCORING = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "..", "processor", "flood_risk_engine", "scoring.py"
+)
+
+
+class TestVendoredCopy:
+    """Test class cho bản scoring.py của processor."""
+
+    @pytest.mark.skipif(not os.path.exists(VENDORED_SCORING), reason="processor tree not present")
+    def test_processor_copy_in_sync(self):
+        """processor/flood_risk_engine/scoring.py giống hệt app/services/scoring.py"""
+        with open(scoring.__file__, encoding="utf-8") as source, open(VENDORED_SCORING, encoding="utf-8") as copy:
+            assert copy.read() == source.read(), "copy app/services/scoring.py to processor/flood_risk_engine/"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
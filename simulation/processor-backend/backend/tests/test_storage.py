@@ -0,0 +1,91 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Streaming Image Upload
+======================================
+Kiểm tra stream theo chunk ra file tạm, giới hạn kích thước, hash nội dung,
+rename atomic và dọn file tạm khi ảnh lỗi.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_storage.py -v
+"""
+
+import asyncio
+import hashlib
+import io
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+from app.services import storage
+
+
+def png_bytes(size=(64, 64)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (30, 120, 200)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def upload(content, filename="photo.png", size=None):
+    return UploadFile(file=io.BytesIO(content), filename=filename, size=size)
+
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "UPLOAD_DIR", str(tmp_path))
+    return tmp_path
+
+
+class TestStreamingUpload:
+    """Test class cho store_images / stage_upload."""
+
+    def test_streams_hashes_and_renames(self, upload_dir):
+        """Ảnh hợp lệ đọc theo chunk nhỏ → file tên theo SHA-256, không còn file tạm"""
+        content = png_bytes()
+
+        async def run():
+            staged = await storage.stage_upload(upload(content), chunk_size=100)
+            return staged, await storage.commit_uploads([staged], "http://api")
+
+        staged, urls = asyncio.run(run())
+        digest = hashlib.sha256(content).hexdigest()
+        assert staged.size == len(content) and staged.sha256 == digest
+        assert urls == [f"http://api/static/uploads/{digest[:32]}.png"]
+        assert os.listdir(upload_dir) == [f"{digest[:32]}.png"]
+        assert (upload_dir / f"{digest[:32]}.png").read_bytes() == content
+
+    def test_size_cutoff_while_streaming(self, upload_dir, monkeypatch):
+        """Vượt MAX_FILE_SIZE giữa chừng → 400, file tạm bị xóa; size khai báo → từ chối trước khi đọc"""
+        monkeypatch.setattr(storage, "MAX_FILE_SIZE", 1000)
+        content = png_bytes((256, 256)) + b"\0" * 2000
+
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(storage.stage_upload(upload(content), chunk_size=256))
+        assert exc.value.status_code == 400 and "too large" in exc.value.detail
+        assert os.listdir(upload_dir) == []
+
+        declared = upload(content, size=len(content))
+        with pytest.raises(HTTPException):
+            asyncio.run(storage.stage_upload(declared))
+        assert declared.file.tell() == 0
+
+    def test_corrupt_image_rejects_whole_report(self, upload_dir):
+        """Một ảnh hỏng → 400, không ảnh nào của report được lưu"""
+        files = [upload(png_bytes()), upload(b"not an image", filename="bad.jpg")]
+
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(storage.store_images(files, "http://api"))
+        assert exc.value.detail == "Invalid or corrupted image file"
+        assert os.listdir(upload_dir) == []
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
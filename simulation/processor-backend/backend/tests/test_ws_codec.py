@@ -0,0 +1,168 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Binary WebSocket Protocol
+=========================================
+Kiểm tra MsgpackEncoder: field dictionary, delta theo record, decode ngược.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_ws_codec.py -v
+"""
+
+import asyncio
+import json
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+pytest.importorskip("msgpack")
+
+from app.services.read_models import LatestReadingStore
+from app.services.ws_codec import MsgpackEncoder, decode, DELTA, FULL
+from app.services.ws_hub import MapHub
+
+
+def sensor(zone, level, ts=1000):
+    return {
+        "entity_id": f"urn:ngsi-ld:WaterLevelObserved:{zone}",
+        "entity_type": "WaterLevelObserved",
+        "sensorinstanceid": zone,
+        "lat": 10.7769,
+        "lng": 106.7009,
+        "waterlevel": level,
+        "severity": "Moderate",
+        "district": "Quận 1",
+        "zoneid": zone,
+        "zonename": "Nguyễn Hữu Cảnh",
+        "updatedat": ts,
+    }
+
+
+def new_encoder():
+    return MsgpackEncoder({"sensor": lambda r: r.get("zoneid")})
+
+
+class TestMsgpackEncoder:
+    """Test class cho MsgpackEncoder."""
+
+    def test_round_trip_snapshot_then_delta(self):
+        """Snapshot đầy đủ → delta chỉ chứa field đổi, decode ra record đầy đủ"""
+        encoder = new_encoder()
+        fields, state = [], {}
+        decode(encoder.schema(), fields, state)
+
+        snapshot = decode(encoder.encode("snapshot", {"sensor": [sensor("z1", 0.3)]}, seq=1), fields, state)
+        assert snapshot["d"]["sensor"] == [sensor("z1", 0.3)]
+        assert snapshot["seq"] == 1
+
+        frame = encoder.encode("update", {"sensor": [sensor("z1", 0.5, 2000)]}, seq=2)
+        update = decode(frame, fields, state)
+        assert update["d"]["sensor"] == [sensor("z1", 0.5, 2000)]
+
+    def test_delta_carries_only_changed_fields(self):
+        """Chỉ waterlevel đổi → entry DELTA với đúng các field đó"""
+        import msgpack
+        encoder = new_encoder()
+        encoder.encode("snapshot", {"sensor": [sensor("z1", 0.3)]})
+        raw = msgpack.unpackb(encoder.encode("update", {"sensor": [sensor("z1", 0.5)]}), strict_map_key=False)
+        [[ref, kind, values]] = raw["d"]["sensor"]
+        assert kind == DELTA
+        assert list(values.values()) == [0.5]
+
+        # Record không đổi → không gửi gì
+        raw = msgpack.unpackb(encoder.encode("update", {"sensor": [sensor("z1", 0.5)]}), strict_map_key=False)
+        assert raw["d"]["sensor"] == []
+
+    def test_delta_order_of_magnitude_smaller_than_json(self):
+        """Update waterlevel cho 200 sensor: binary delta nhỏ hơn JSON ≥ 10 lần"""
+        encoder = new_encoder()
+        zones = [f"zone-{i:03d}" for i in range(200)]
+        encoder.encode("snapshot", {"sensor": [sensor(z, 0.3) for z in zones]})
+        updated = [sensor(z, 0.45) for z in zones]
+
+        binary = encoder.encode("update", {"sensor": updated}, seq=2)
+        text = json.dumps({"type": "update", "sensor": updated, "seq": 2}).encode("utf-8")
+        assert len(binary) * 10 <= len(text)
+
+    def test_new_field_sent_once(self):
+        """Field ngoài dictionary → gửi tên trong "f" một lần, frame sau dùng id"""
+        encoder = new_encoder()
+        fields, state = [], {}
+        decode(encoder.schema(), fields, state)
+
+        first = decode(encoder.encode("update", {"sensor": [{**sensor("z1", 0.3), "battery": 80}]}), fields, state)
+        assert first["f"] == ["battery"]
+        second = decode(encoder.encode("update", {"sensor": [{**sensor("z1", 0.3), "battery": 79}]}), fields, state)
+        assert "f" not in second
+        assert second["d"]["sensor"][0]["battery"] == 79
+
+    def test_snapshot_always_full(self):
+        """Snapshot (vd. sau `move`) luôn gửi record đầy đủ"""
+        import msgpack
+        encoder = new_encoder()
+        encoder.encode("snapshot", {"sensor": [sensor("z1", 0.3)]})
+        raw = msgpack.unpackb(encoder.encode("snapshot", {"sensor": [sensor("z1", 0.3)]}), strict_map_key=False)
+        assert raw["d"]["sensor"][0][1] == FULL
+
+    def test_tombstone_full_then_reappears_full(self):
+        """Tombstone (`removed`) gửi FULL thay record ở client; record xuất hiện lại → FULL"""
+        encoder = new_encoder()
+        fields, state = [], {}
+        decode(encoder.schema(), fields, state)
+        decode(encoder.encode("snapshot", {"sensor": [sensor("z1", 0.3)]}), fields, state)
+
+        tombstone = {"zoneid": "z1", "entity_id": sensor("z1", 0)["entity_id"], "updatedat": 3000, "removed": True}
+        removed = decode(encoder.encode("update", {"sensor": [tombstone]}), fields, state)
+        assert removed["d"]["sensor"] == [tombstone]
+
+        again = decode(encoder.encode("update", {"sensor": [sensor("z1", 0.2, 4000)]}), fields, state)
+        assert again["d"]["sensor"] == [sensor("z1", 0.2, 4000)]
+
+
+class BinaryWebSocket:
+    """WebSocket giả nhận frame binary."""
+
+    def __init__(self):
+        self.frames = []
+
+    async def send_bytes(self, data):
+        self.frames.append(data)
+
+
+class TestBinarySubscribers:
+    """Test class cho MapHub với connection binary."""
+
+    def test_hub_sends_binary_deltas(self):
+        """Connection msgpack nhận delta binary, connection JSON giữ nguyên"""
+        store = LatestReadingStore()
+        store.upsert(sensor("z1", 0.3))
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            ws = BinaryWebSocket()
+            subscriber = hub.connect(ws)
+            subscriber.encoder = MsgpackEncoder({"sensor": store.key_of})
+            subscriber.send(subscriber.encoder.schema())
+            hub.start(subscriber, {"sensor": store.version})
+            subscriber.send_records("snapshot", {"sensor": store.snapshot()}, seq=hub.seq)
+            store.upsert(sensor("z1", 0.6, 2000))
+            await hub.broadcast_once()
+            await asyncio.sleep(0.01)
+            await hub.close()
+            return ws.frames
+
+        frames = asyncio.run(run())
+        fields, state = [], {}
+        messages = [decode(frame, fields, state) for frame in frames]
+        assert [m["t"] for m in messages] == ["schema", "snapshot", "update"]
+        assert messages[2]["d"]["sensor"][0]["waterlevel"] == 0.6
+        assert messages[2]["d"]["sensor"][0]["zonename"] == "Nguyễn Hữu Cảnh"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,468 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho WebSocket Hub
+=============================
+Kiểm tra broadcaster /ws/map: một lần tính update cho mọi socket, thứ tự snapshot → update,
+lọc update theo vùng subscribe, resume bằng seq + ring buffer, queue gửi có giới hạn,
+fan-out giữa các worker qua pub/sub.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_ws_hub.py -v
+"""
+
+import asyncio
+import itertools
+import json
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.cache import MemoryBackend
+from app.services.read_models import LatestReadingStore
+from app.services.ws_hub import MapHub, Region
+
+
+class FakeWebSocket:
+    """WebSocket giả: ghi lại các frame đã gửi."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.delay)
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+def reading(zone, level, ts, lat=10.77, lng=106.70):
+    return {"entity_id": zone, "zoneid": zone, "waterlevel": level, "updatedat": ts, "lat": lat, "lng": lng}
+
+# Quận 1 và Thủ Đức (cách nhau ~10km)
+DISTRICT_1 = (10.776, 106.700)
+THU_DUC = (10.850, 106.770)
+
+
+class CountingStore(LatestReadingStore):
+    """Store đếm số lần đọc delta."""
+
+    def __init__(self):
+        super().__init__()
+        self.delta_reads = 0
+
+    def changed_since_version(self, version):
+        self.delta_reads += 1
+        return super().changed_since_version(version)
+
+
+class TestMapHub:
+    """Test class cho MapHub."""
+
+    def test_one_delta_read_for_all_sockets(self):
+        """100 socket → delta chỉ được tính một lần mỗi tick, refresh một lần"""
+        store = CountingStore()
+        refreshes = []
+
+        async def refresh():
+            refreshes.append(1)
+
+        async def run():
+            hub = MapHub({"sensor": store}, refresh=refresh, interval=60)
+            sockets = [FakeWebSocket() for _ in range(100)]
+            for ws in sockets:
+                hub.start(hub.connect(ws), {"sensor": store.version})
+            store.upsert(reading("zone-a", 0.4, 1000))
+            reached = await hub.broadcast_once()
+            await asyncio.sleep(0.01)
+            await hub.close()
+            return reached, sockets
+
+        reached, sockets = asyncio.run(run())
+        assert reached == 100
+        assert store.delta_reads == 1
+        assert len(refreshes) == 1
+        assert all(ws.sent[0]["sensor"][0]["waterlevel"] == 0.4 for ws in sockets)
+
+    def test_snapshot_before_updates_and_no_gap(self):
+        """Thay đổi sau version snapshot luôn được gửi, sau frame snapshot"""
+        store = LatestReadingStore()
+        store.upsert(reading("zone-a", 0.1, 1000))
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            await hub.broadcast_once()
+            # Client nhận snapshot ở version hiện tại, store đổi trước tick kế tiếp
+            ws = FakeWebSocket()
+            subscriber = hub.connect(ws)
+            subscriber.send(json.dumps({"type": "snapshot"}))
+            hub.start(subscriber, {"sensor": store.version})
+            store.upsert(reading("zone-b", 0.2, 1000))
+            await hub.broadcast_once()
+            await asyncio.sleep(0.01)
+            await hub.close()
+            return ws.sent
+
+        sent = asyncio.run(run())
+        assert [m["type"] for m in sent] == ["snapshot", "update"]
+        assert [r["zoneid"] for r in sent[1]["sensor"]] == ["zone-b"]
+
+    def test_evicted_record_pushed_as_removal(self):
+        """Record bị loại khỏi store → update mang tombstone, chỉ tới socket có vùng chứa nó"""
+        store = LatestReadingStore()
+        store.upsert(reading("zone-a", 0.1, 1000, *DISTRICT_1))
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            near, far = FakeWebSocket(), FakeWebSocket()
+            hub.start(hub.connect(near), {"sensor": store.version}, Region.circle(*DISTRICT_1, 2))
+            hub.start(hub.connect(far), {"sensor": store.version}, Region.circle(*THU_DUC, 2))
+            store.evict_older_than(2000)
+            await hub.broadcast_once()
+            await asyncio.sleep(0.01)
+            await hub.close()
+            return near.sent, far.sent
+
+        near, far = asyncio.run(run())
+        [update] = near
+        assert update["sensor"][0]["zoneid"] == "zone-a" and update["sensor"][0]["removed"] is True
+        assert far == []
+
+    def test_inactive_sockets_and_empty_ticks(self):
+        """Socket chưa init không nhận update; tick không có thay đổi → không gửi"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            ws = FakeWebSocket()
+            hub.connect(ws)
+            store.upsert(reading("zone-a", 0.1, 1000))
+            first = await hub.broadcast_once()
+            second = await hub.broadcast_once()
+            await hub.close()
+            return first, second, ws.sent
+
+        assert asyncio.run(run()) == (0, 0, [])
+
+    def test_notify_wakes_broadcaster(self):
+        """Ingest gọi notify() → broadcast ngay, không chờ hết interval"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            ws = FakeWebSocket()
+            hub.start(hub.connect(ws), {"sensor": store.version})
+            await asyncio.sleep(0)
+            store.upsert(reading("zone-a", 0.3, 1000))
+            hub.notify()
+            await asyncio.sleep(0.05)
+            await hub.close()
+            return ws.sent
+
+        sent = asyncio.run(run())
+        assert len(sent) == 1
+        assert sent[0]["type"] == "update"
+
+    def test_slow_socket_does_not_block_broadcast(self):
+        """Socket chậm không làm broadcaster phải chờ"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            slow, fast = FakeWebSocket(delay=1.0), FakeWebSocket()
+            for ws in (slow, fast):
+                hub.start(hub.connect(ws), {"sensor": store.version})
+            store.upsert(reading("zone-a", 0.3, 1000))
+            await asyncio.wait_for(hub.broadcast_once(), timeout=0.1)
+            await asyncio.sleep(0.01)
+            await hub.close()
+            return slow.sent, fast.sent
+
+        slow_sent, fast_sent = asyncio.run(run())
+        assert slow_sent == []
+        assert len(fast_sent) == 1
+
+
+class TestRegionSubscriptions:
+    """Test class cho subscription theo vùng."""
+
+    def test_region_from_message(self):
+        """bbox / bán kính / không có vùng; tham số sai → ValueError"""
+        assert Region.from_message({"type": "init"}) is None
+        assert Region.from_message({"bbox": [10.7, 106.6, 10.8, 106.7]}).contains(10.75, 106.65)
+        circle = Region.from_message({"lat": DISTRICT_1[0], "lng": DISTRICT_1[1], "radius": 2})
+        assert circle.contains(*DISTRICT_1)
+        assert not circle.contains(*THU_DUC)
+        # Góc bbox nằm ngoài vòng tròn
+        assert not circle.contains(circle.north - 1e-6, circle.east - 1e-6)
+        with pytest.raises(ValueError):
+            Region.from_message({"bbox": [10.8, 106.6, 10.7, 106.7]})
+        with pytest.raises(ValueError):
+            Region.from_message({"bbox": "city"})
+
+    def test_updates_routed_by_region(self):
+        """Bản ghi chỉ đến socket có vùng chứa nó; socket không có vùng nhận tất cả"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            district_1, thu_duc, everything = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+            hub.start(hub.connect(district_1), {"sensor": 0}, Region.circle(*DISTRICT_1, 3))
+            mover = hub.connect(thu_duc)
+            hub.start(mover, {"sensor": 0}, Region.circle(*THU_DUC, 3))
+            hub.start(hub.connect(everything), {"sensor": 0})
+            store.upsert(reading("q1", 0.4, 1000, *DISTRICT_1))
+            store.upsert(reading("td", 0.2, 1000, *THU_DUC))
+            reached = await hub.broadcast_once()
+            await asyncio.sleep(0.01)
+
+            # Thủ Đức → Quận 1: chỉ còn nhận update của Quận 1
+            hub.start(mover, {"sensor": store.version}, Region.circle(*DISTRICT_1, 3))
+            store.upsert(reading("td", 0.3, 2000, *THU_DUC))
+            second = await hub.broadcast_once()
+            await asyncio.sleep(0.01)
+            await hub.close()
+            return reached, second, district_1.sent, thu_duc.sent, everything.sent
+
+        reached, second, district_1, thu_duc, everything = asyncio.run(run())
+        assert reached == 3
+        assert [r["zoneid"] for r in district_1[0]["sensor"]] == ["q1"]
+        assert [r["zoneid"] for r in thu_duc[0]["sensor"]] == ["td"]
+        assert sorted(r["zoneid"] for r in everything[0]["sensor"]) == ["q1", "td"]
+        # Sau move không socket vùng nào chứa "td" → chỉ socket toàn thành phố nhận
+        assert second == 1
+        assert len(thu_duc) == 1 and len(district_1) == 1 and len(everything) == 2
+
+    def test_same_selection_shares_frame(self):
+        """Nhiều socket cùng vùng → serialize một frame"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            for _ in range(50):
+                hub.start(hub.connect(FakeWebSocket()), {"sensor": 0}, Region.circle(*DISTRICT_1, 3))
+            store.upsert(reading("q1", 0.4, 1000, *DISTRICT_1))
+            reached = await hub.broadcast_once()
+            await hub.close()
+            return reached, hub.frames
+
+        assert asyncio.run(run()) == (50, 1)
+
+
+class TestResume:
+    """Test class cho seq + replay ring buffer."""
+
+    clock = itertools.count(1000)
+
+    async def broadcast_levels(self, hub, store, levels, zone="q1", where=DISTRICT_1):
+        for level in levels:
+            # Client nhận kịp giữa hai update (không bị coalesce)
+            await asyncio.sleep(0)
+            store.upsert(reading(zone, level, next(self.clock), *where))
+            await hub.broadcast_once()
+
+    def test_resume_replays_only_missed_updates(self):
+        """Reconnect với resume_from → chỉ nhận update sau seq đó, theo thứ tự"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            first = FakeWebSocket()
+            subscriber = hub.connect(first)
+            hub.start(subscriber, {"sensor": store.version})
+            await self.broadcast_levels(hub, store, [0.1, 0.2])
+            await asyncio.sleep(0.01)
+            last_seq = first.sent[-1]["seq"]
+
+            # Mất kết nối; hub vẫn phát cho socket khác
+            other = hub.connect(FakeWebSocket())
+            hub.start(other, {"sensor": store.version})
+            await hub.disconnect(subscriber)
+            await self.broadcast_levels(hub, store, [0.3, 0.4])
+
+            again = FakeWebSocket()
+            replayed = hub.resume(hub.connect(again), last_seq, hub.epoch)
+            await self.broadcast_levels(hub, store, [0.5])
+            await asyncio.sleep(0.01)
+            await hub.close()
+            return first.sent, replayed, again.sent
+
+        first, replayed, again = asyncio.run(run())
+        assert [m["seq"] for m in first] == [1, 2]
+        assert replayed == 2
+        # Hai update bị lỡ của cùng zone được gộp: chỉ gửi trạng thái mới nhất
+        assert [m["seq"] for m in again] == [4, 5]
+        assert [m["sensor"][0]["waterlevel"] for m in again] == [0.4, 0.5]
+
+    def test_resume_falls_back_when_gap_evicted(self):
+        """Gap đã bị đẩy khỏi buffer, sai epoch, seq không hợp lệ → None (cần snapshot)"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60, replay_size=2)
+            hub.start(hub.connect(FakeWebSocket()), {"sensor": store.version})
+            await self.broadcast_levels(hub, store, [0.1, 0.2, 0.3, 0.4])
+            results = [
+                hub.resume(hub.connect(FakeWebSocket()), 1, hub.epoch),
+                hub.resume(hub.connect(FakeWebSocket()), 3, "other-process"),
+                hub.resume(hub.connect(FakeWebSocket()), 99, hub.epoch),
+                hub.resume(hub.connect(FakeWebSocket()), "3", hub.epoch),
+                hub.resume(hub.connect(FakeWebSocket()), 2, hub.epoch),
+            ]
+            await hub.close()
+            return results, hub.stats()
+
+        results, stats = asyncio.run(run())
+        assert results == [None, None, None, None, 2]
+        assert stats["resume_misses"] == 4
+
+    def test_resume_replay_filtered_by_region(self):
+        """Replay chỉ gồm bản ghi trong vùng của client"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            hub.start(hub.connect(FakeWebSocket()), {"sensor": store.version})
+            await self.broadcast_levels(hub, store, [0.1], zone="q1", where=DISTRICT_1)
+            await self.broadcast_levels(hub, store, [0.2], zone="td", where=THU_DUC)
+            ws = FakeWebSocket()
+            hub.resume(hub.connect(ws), 0, hub.epoch, Region.circle(*THU_DUC, 3))
+            await asyncio.sleep(0.01)
+            await hub.close()
+            return ws.sent
+
+        sent = asyncio.run(run())
+        assert [(m["seq"], m["sensor"][0]["zoneid"]) for m in sent] == [(2, "td")]
+
+    def test_cursor_jump_invalidates_old_seq(self):
+        """Không còn socket nào: snapshot mới nhảy cursor → seq cũ không resume được"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            subscriber = hub.connect(FakeWebSocket())
+            hub.start(subscriber, {"sensor": store.version})
+            await self.broadcast_levels(hub, store, [0.1])
+            await hub.disconnect(subscriber)
+            # Thay đổi không được broadcast (không có socket), client mới nhận snapshot
+            store.upsert(reading("q1", 0.9, next(self.clock), *DISTRICT_1))
+            hub.start(hub.connect(FakeWebSocket()), {"sensor": store.version})
+            old = hub.resume(hub.connect(FakeWebSocket()), 1, hub.epoch)
+            current = hub.resume(hub.connect(FakeWebSocket()), hub.seq, hub.epoch)
+            await hub.close()
+            return old, current
+
+        assert asyncio.run(run()) == (None, 0)
+
+
+class TestSlowConsumers:
+    """Test class cho queue gửi của từng socket (coalesce + ngắt socket chậm)."""
+
+    def test_pending_updates_coalesced_per_entity(self):
+        """Socket đang bận gửi → update dồn lại chỉ giữ trạng thái mới nhất mỗi zone"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            slow = FakeWebSocket(delay=0.05)
+            hub.start(hub.connect(slow), {"sensor": store.version})
+            store.upsert(reading("a", 0.1, 1000))
+            await hub.broadcast_once()
+            await asyncio.sleep(0)
+            for zone, level, ts in [("a", 0.2, 2000), ("a", 0.3, 3000), ("b", 0.5, 3000)]:
+                store.upsert(reading(zone, level, ts))
+                await hub.broadcast_once()
+            depth = hub.stats()["queue_depth"]
+            await asyncio.sleep(0.2)
+            stats = hub.stats()
+            await hub.close()
+            return slow.sent, depth, stats
+
+        sent, depth, stats = asyncio.run(run())
+        assert [m["seq"] for m in sent] == [1, 4]
+        assert [(r["zoneid"], r["waterlevel"]) for r in sent[1]["sensor"]] == [("a", 0.3), ("b", 0.5)]
+        assert depth == 2
+        assert stats["coalesced"] == 1
+        assert stats["queue_depth"] == 0
+
+    def test_slow_consumer_evicted_with_resync(self):
+        """Queue vượt giới hạn quá grace → socket nhận `resync` rồi bị đóng; socket khác không bị ảnh hưởng"""
+        store = LatestReadingStore()
+
+        async def run():
+            hub = MapHub({"sensor": store}, interval=60)
+            slow, fast = FakeWebSocket(delay=0.05), FakeWebSocket()
+            lagging = hub.connect(slow)
+            lagging.max_depth, lagging.grace = 1, 0
+            hub.start(lagging, {"sensor": store.version})
+            hub.start(hub.connect(fast), {"sensor": store.version})
+            for i, zone in enumerate(["a", "b", "c"]):
+                store.upsert(reading(zone, 0.4, 1000 + i))
+                await hub.broadcast_once()
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.2)
+            stats = hub.stats()
+            await hub.close()
+            return slow, fast.sent, stats
+
+        slow, fast, stats = asyncio.run(run())
+        assert slow.sent[-1]["type"] == "resync"
+        assert "seq" not in slow.sent[-1]
+        assert slow.close_code == 1013
+        assert [m["seq"] for m in fast] == [1, 2, 3]
+        assert stats["evictions"] == 1
+        assert stats["connections"] == 1
+
+
+
+class TestCrossWorkerFanOut:
+    """Test class cho ingest event qua pub/sub (MemoryBackend thay Redis)."""
+
+    def test_ingest_on_one_worker_reaches_sockets_on_another(self):
+        """Worker A ingest → store + socket của worker B nhận update, A bỏ qua event của chính nó"""
+        backend = MemoryBackend()
+        store_a, store_b = LatestReadingStore(), CountingStore()
+
+        async def run():
+            hub_a = MapHub({"sensor": store_a}, interval=60, backend=backend)
+            hub_b = MapHub({"sensor": store_b}, interval=60, backend=backend)
+            await hub_a.listen()
+            await hub_b.listen()
+            ws = FakeWebSocket()
+            hub_b.start(hub_b.connect(ws), {"sensor": store_b.version})
+
+            record = reading("q1", 0.4, 1000, *DISTRICT_1)
+            store_a.upsert(record)
+            await hub_a.publish("sensor", [record])
+            await hub_b.broadcast_once()
+            await asyncio.sleep(0.01)
+            stats = hub_a.stats(), hub_b.stats()
+            await hub_a.close()
+            await hub_b.close()
+            return ws.sent, stats
+
+        sent, (stats_a, stats_b) = asyncio.run(run())
+        assert store_b.snapshot() == store_a.snapshot()
+        assert [r["waterlevel"] for r in sent[0]["sensor"]] == [0.4]
+        assert stats_a["events_published"] == 1 and stats_a["events_received"] == 0
+        assert stats_b["events_received"] == 1
+
+    def test_malformed_events_ignored(self):
+        """Message hỏng / stream lạ không làm lỗi listener"""
+        store = LatestReadingStore()
+        hub = MapHub({"sensor": store}, interval=60, backend=MemoryBackend())
+        for message in ["not json", "[]", '{"stream": "weather", "records": [{}]}', '{"stream": "sensor", "records": 1}']:
+            hub.handle_event(message)
+        assert len(store) == 0 and hub.events_received == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,103 @@
+# Copyright (c) 2025 FloodWatch Team
+# SPDX-License-Identifier: MIT
+
+"""
+Unit Tests cho Zone Lookup (point-in-polygon)
+==============================================
+Kiểm tra gán tọa độ vào polygon FLOOD_ZONES.
+
+Chạy tests:
+    cd simulation/processor-backend/backend
+    pytest tests/test_zone_lookup.py -v
+"""
+
+import random
+import pytest
+import sys
+import os
+
+# Add app to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.zone_lookup import ZoneLookup, load_flood_zones
+
+SQUARE = {"id": "square", "name": "Square", "district": "Quận 1",
+          "polygon": [(10.0, 106.0), (10.0, 106.1), (10.1, 106.1), (10.1, 106.0)]}
+# Hình chữ L: điểm trong bbox nhưng ngoài polygon
+L_SHAPE = {"id": "l-shape", "name": "L", "district": "Quận 4",
+           "polygon": [(11.0, 106.0), (11.0, 106.2), (11.1, 106.2), (11.1, 106.1), (11.2, 106.1), (11.2, 106.0)]}
+
+
+def point_in_polygon(lat, lng, polygon):
+    """Ray casting thuần Python để đối chiếu."""
+    inside = False
+    for (lat1, lng1), (lat2, lng2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (lat1 > lat) != (lat2 > lat):
+            if lng < (lng2 - lng1) * (lat - lat1) / (lat2 - lat1) + lng1:
+                inside = not inside
+    return inside
+
+
+class TestZoneLookup:
+    """Test class cho ZoneLookup."""
+
+    def test_point_inside_and_outside(self):
+        lookup = ZoneLookup([SQUARE, L_SHAPE])
+        assert lookup.lookup(10.05, 106.05)["id"] == "square"
+        assert lookup.lookup(11.15, 106.05)["id"] == "l-shape"
+        assert lookup.lookup(11.15, 106.15) is None  # trong bbox, ngoài polygon
+        assert lookup.lookup(12.0, 106.0) is None
+
+    def test_batch_matches_reference(self):
+        """lookup_many (vectorized) giống ray casting thuần Python"""
+        lookup = ZoneLookup([SQUARE, L_SHAPE])
+        rng = random.Random(7)
+        points = [(9.95 + rng.random() * 1.3, 105.95 + rng.random() * 0.3) for _ in range(2000)]
+        result = lookup.lookup_many([p[0] for p in points], [p[1] for p in points])
+
+        for (lat, lng), zone in zip(points, result):
+            expected = next(
+                (z["id"] for z in (SQUARE, L_SHAPE) if point_in_polygon(lat, lng, z["polygon"])),
+                None
+            )
+            assert (zone["id"] if zone else None) == expected
+
+    def test_batch_tests_only_candidate_zones(self, monkeypatch):
+        """200 zone rải rác, điểm chỉ nằm trong một ô → ray casting chỉ chạy cho zone của ô đó"""
+        zones = [
+            {"id": f"z{i}", "name": f"Z{i}", "district": "Quận 1",
+             "polygon": [(10.0 + i * 0.05, 106.0), (10.0 + i * 0.05, 106.004),
+                         (10.004 + i * 0.05, 106.004), (10.004 + i * 0.05, 106.0)]}
+            for i in range(200)
+        ]
+        lookup = ZoneLookup(zones)
+        tested = []
+        contains = lookup._contains
+        monkeypatch.setattr(lookup, "_contains", lambda i, lats, lngs: tested.append(i) or contains(i, lats, lngs))
+
+        result = lookup.lookup_many([10.502, 10.503, 10.509, float("nan")], [106.002, 106.001, 106.009, 106.0])
+        assert [z["id"] if z else None for z in result] == ["z10", "z10", None, None]
+        assert tested == [10]
+
+    def test_assign_sets_zone_fields(self):
+        """assign() ghi zoneid/zonename/district cho record trong zone"""
+        lookup = ZoneLookup([SQUARE])
+        records = [{"lat": 10.05, "lng": 106.05}, {"lat": 12.0, "lng": 106.0}, {"lat": None, "lng": None}]
+        assert lookup.assign(records) == 1
+        assert records[0]["zoneid"] == "square"
+        assert records[0]["district"] == "Quận 1"
+        assert "zoneid" not in records[1]
+
+    def test_real_zone_centers(self):
+        """Tâm của mỗi flood zone thực tế nằm trong polygon của chính nó"""
+        zones = load_flood_zones()
+        if not zones:
+            pytest.skip("flood_zones.py not available")
+        lookup = ZoneLookup(zones)
+        assert len(lookup) == len(zones)
+        for zone in zones:
+            assert lookup.lookup(*zone["center"])["id"] == zone["id"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])